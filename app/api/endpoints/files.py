@@ -1,23 +1,64 @@
 from fastapi import APIRouter, Depends, UploadFile, File, Form, HTTPException, status, Request, Header
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, Response, JSONResponse, StreamingResponse
+from starlette.datastructures import UploadFile as StarletteUploadFile
 from app.core.security import get_current_user_id
+from app.core import metrics
 from app.schemas.file import (
     InitSessionRequest, InitSessionResponse, InitSessionResponseData,
-    ChunkUploadResponse, CompleteSessionRequest, CompleteSessionResponse, CompleteSessionResponseData
+    ChunkUploadResponse, CompleteSessionRequest, CompleteSessionResponse, CompleteSessionResponseData,
+    UploadStatusResponse, UploadStatusResponseData, PresignedPart, PresignedPartsResponse,
+    FinalizeStatusResponse, FinalizeStatusData, ChunkBatchResponse, ChunkBatchResult
 )
-from app.services.file_service import file_service
+from app.services.file_service import file_service, IncompleteUploadError
+from app.services.finalize_queue import finalize_queue
+from app.services.download_cache import CacheFill
 from uuid import uuid4
 from app.core.config import settings
+from app.core.conditional import (
+    stat_etag, checksum_etag, version_etag, last_modified, http_date, content_disposition, is_not_modified,
+    requested_range
+)
+from app.services.checksum import parse_checksum_header, ChecksumMismatchError
+from app.services.storage.scheduler import IOSaturatedError
+from botocore.exceptions import BotoCoreError, ClientError
 import os
-from app.core.session import session_map
+import asyncio
+from app.core.session import session_store
 from typing import Optional
 import logging
 import re
-import shutil
 
 logger = logging.getLogger(__name__)
 router = APIRouter()
 
+
+class _MeteredResponse:
+    """Mixin recording the time to send a response and the body bytes actually sent"""
+
+    async def __call__(self, scope, receive, send):
+        sent = 0
+
+        async def counting_send(message):
+            nonlocal sent
+            if message["type"] == "http.response.body":
+                sent += len(message.get("body", b""))
+            await send(message)
+
+        try:
+            with metrics.DOWNLOAD_SECONDS.time():
+                await super().__call__(scope, receive, counting_send)
+        finally:
+            metrics.BYTES_SERVED.inc(sent)
+
+
+class _MeteredFileResponse(_MeteredResponse, FileResponse):
+    pass
+
+
+class _MeteredStreamingResponse(_MeteredResponse, StreamingResponse):
+    pass
+
+
 @router.post("/", response_model=InitSessionResponse)
 async def create_file(
     req: InitSessionRequest,
@@ -25,51 +66,272 @@ async def create_file(
 ):
     """
     POST /files - Initialize a new file upload session
+    In S3 presigned mode the response also carries the part size and upload URLs for the first chunks.
     """
-    session_map[str(req.file_id)] = {
-        "user_id": user_id,
-        "original_file_name": req.original_file_name,
-        "main_service_file_id": req.file_id
-    }
-    return InitSessionResponse(
-        data=InitSessionResponseData(file_id=req.file_id)
-    )
+    try:
+        session = await file_service.create_session(req.file_id, user_id, req.original_file_name, req.file_size, req.chunk_size)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    data = InitSessionResponseData(file_id=req.file_id)
+    if file_service.storage.direct_upload:
+        first_batch = session["planned_parts"] or settings.S3_PRESIGNED_BATCH_SIZE
+        data.part_size = session["part_size"]
+        data.upload_parts = [PresignedPart(**part) for part in await file_service.presigned_parts(str(req.file_id), 0, first_batch)]
+    return InitSessionResponse(data=data)
 
-@router.get("/{file_id}")
+@router.api_route("/{file_id}", methods=["GET", "HEAD"])
 async def get_file(
     file_id: int,
+    request: Request,
     current_user_id: str = Depends(get_current_user_id)
 ):
     """
     GET /files/{file_id} - Download a file
+    Supports Range (single and multiple), If-Range, If-None-Match and If-Modified-Since.
     """
-    user_file_dir = os.path.join(settings.PERSISTENT_LOCAL_STORAGE_PATH, "final", current_user_id, str(file_id))
-    logger.info(f"User file dir: {user_file_dir}")
-    logger.info(f"User file dir exists: {os.path.exists(user_file_dir)}")
-    if not os.path.exists(user_file_dir):
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="File not found.")
-
-    files = [f for f in os.listdir(user_file_dir) if os.path.isfile(os.path.join(user_file_dir, f))]
-    logger.info(f"Files: {files}")
-    if not files:
+    if settings.STORAGE_BACKEND == "s3":
+        return await _get_s3_file(request, current_user_id, file_id)
+    record = await file_service.get_local_file(current_user_id, file_id)
+    if record is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="File not found.")
+    file_path = file_service.local_path(record)
     
-    file_path = os.path.join(user_file_dir, files[0])
-    filename = files[0]
-    logger.info(f"File path: {file_path}")
-    logger.info(f"Filename: {filename}")
-    return FileResponse(
+    try:
+        stat_result = await asyncio.to_thread(os.stat, file_path)
+    except FileNotFoundError:
+        # The layout migration renames the directory before it repoints the record, so the catalog
+        # may still name the old place; look for the file itself in every layout
+        moved_path = await asyncio.to_thread(file_service._find_final_path, current_user_id, file_id)
+        if moved_path is None or moved_path == file_path:
+            # Removed behind the catalog's back; run the catalog rebuild to reconcile
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="File not found.")
+        if os.path.basename(moved_path) != os.path.basename(file_path):
+            # Not the file the record describes, so its checksum doesn't apply
+            record = {**record, "checksum": None}
+        file_path = moved_path
+        try:
+            stat_result = await asyncio.to_thread(os.stat, file_path)
+        except FileNotFoundError:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="File not found.")
+    
+    # The content checksum recorded at upload time; files without one fall back to the stat-based validator
+    etag = checksum_etag(record["checksum"]) if record.get("checksum") else stat_etag(stat_result)
+    validators = {
+        "ETag": etag,
+        "Last-Modified": last_modified(stat_result),
+        "Accept-Ranges": "bytes",
+    }
+    if is_not_modified(request.headers, etag, stat_result.st_mtime):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=validators)
+    
+    # FileResponse handles Range / If-Range / 206 / 416 itself; passing stat_result avoids another stat
+    return _MeteredFileResponse(
         path=file_path,
-        filename=filename,
-        media_type='application/octet-stream'
+        filename=os.path.basename(file_path),
+        media_type='application/octet-stream',
+        headers=validators,
+        stat_result=stat_result
+    )
+
+def _fetch_error(storage_key: str, error: Exception) -> HTTPException:
+    """HTTP error for a failed fetch from S3: 404 when the object is gone, 502 otherwise"""
+    if isinstance(error, ClientError) and error.response.get("Error", {}).get("Code") in ("NoSuchKey", "404", "NotFound"):
+        logger.warning(f"{storage_key} is in the catalog but not in the bucket")
+        return HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="File not found.")
+    logger.error(f"Fetching {storage_key} from S3 failed: {str(error)}")
+    return HTTPException(status_code=status.HTTP_502_BAD_GATEWAY, detail="Storage backend error, retry later.")
+
+async def _get_s3_range(record: dict, byte_range: str, validators: dict):
+    """Answers a Range request for an object the cache won't keep with a ranged GetObject"""
+    try:
+        response = await file_service.download_cache.fetch_range(record["storage_key"], byte_range)
+    except ClientError as e:
+        if e.response.get("Error", {}).get("Code") != "InvalidRange":
+            raise _fetch_error(record["storage_key"], e)
+        headers = dict(validators)
+        if record.get("size") is not None:
+            headers["Content-Range"] = f"bytes */{record['size']}"
+        raise HTTPException(status_code=status.HTTP_416_RANGE_NOT_SATISFIABLE,
+                            detail="Requested range not satisfiable.", headers=headers)
+    except BotoCoreError as e:
+        raise _fetch_error(record["storage_key"], e)
+    headers = {
+        **validators,
+        "Content-Length": str(response["ContentLength"]),
+        "Content-Disposition": content_disposition(record["file_name"]),
+    }
+    if response.get("ContentRange"):
+        headers["Content-Range"] = response["ContentRange"]
+    return _MeteredStreamingResponse(
+        file_service.download_cache.stream_body(response["Body"]),
+        status_code=status.HTTP_206_PARTIAL_CONTENT if response.get("ContentRange") else status.HTTP_200_OK,
+        media_type="application/octet-stream",
+        headers=headers
+    )
+
+async def _get_s3_file(request: Request, user_id: str, file_id: int):
+    """
+    Serves an S3 object through the download cache. A cached copy is served like a local file; on a
+    miss the object is streamed while it is fetched, and a Range request waits for the fetch instead.
+    Range requests for objects the cache won't keep are passed on to S3.
+    """
+    record = await file_service.catalog.aget(user_id, file_id)
+    if record is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="File not found.")
+    # Validators come from the catalog so cached and streamed responses agree
+    etag = checksum_etag(record["checksum"]) if record.get("checksum") else version_etag(record["updated_at"], record["size"])
+    validators = {
+        "ETag": etag,
+        "Last-Modified": http_date(record["updated_at"]),
+        "Accept-Ranges": "bytes",
+    }
+    if is_not_modified(request.headers, etag, record["updated_at"]):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=validators)
+
+    cache = file_service.download_cache
+    if request.method == "HEAD":
+        entry = cache.cached_path(record["storage_key"])
+        if entry is None:
+            # Answered from the catalog; a HEAD never starts a fetch
+            headers = {**validators, "Content-Disposition": content_disposition(record["file_name"])}
+            if record.get("size") is not None:
+                headers["Content-Length"] = str(record["size"])
+            return Response(media_type="application/octet-stream", headers=headers)
+    else:
+        byte_range = requested_range(request.headers, etag, record["updated_at"])
+        if byte_range is not None and not cache.keeps(record.get("size")):
+            return await _get_s3_range(record, byte_range, validators)
+        entry = cache.get(record["storage_key"], record.get("size"))
+        if isinstance(entry, CacheFill) and byte_range is not None and not entry.keep:
+            # Joined a fetch that won't be kept (invalidated meanwhile); waiting for it gains nothing
+            return await _get_s3_range(record, byte_range, validators)
+
+    if isinstance(entry, CacheFill):
+        if "range" in request.headers and entry.keep:
+            try:
+                await entry.completed()
+            except (BotoCoreError, ClientError) as e:
+                raise _fetch_error(record["storage_key"], e)
+            entry = cache.cached_path(record["storage_key"])
+            if entry is None:
+                # Invalidated while it was being fetched
+                raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="File not found.")
+        else:
+            reader = entry.open()
+            try:
+                await entry.started()
+            except BaseException as e:
+                reader.close()
+                if isinstance(e, (BotoCoreError, ClientError)):
+                    raise _fetch_error(record["storage_key"], e)
+                raise
+            headers = {
+                **validators,
+                "Content-Length": str(entry.size),
+                "Content-Disposition": content_disposition(record["file_name"]),
+            }
+            return _MeteredStreamingResponse(entry.stream(reader), media_type="application/octet-stream", headers=headers)
+
+    try:
+        stat_result = await asyncio.to_thread(os.stat, entry)
+    except FileNotFoundError:
+        # Evicted between the lookup and here; the next request fetches it again
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="File is being re-cached, retry later.",
+                            headers={"Retry-After": str(settings.IO_RETRY_AFTER_SECONDS)})
+    return _MeteredFileResponse(
+        path=entry,
+        filename=record["file_name"],
+        media_type='application/octet-stream',
+        headers=validators,
+        stat_result=stat_result
+    )
+
+@router.get("/{file_id}/status", response_model=UploadStatusResponse)
+async def get_upload_status(
+    file_id: str,
+    user_id: str = Depends(get_current_user_id)
+):
+    """
+    GET /files/{file_id}/status - Chunks received so far, so an interrupted client can resume
+    """
+    if not await file_service.check_user_access(str(file_id), user_id):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="File not found or access denied.")
+    upload_status = await file_service.upload_status(str(file_id))
+    if upload_status is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Session not found.")
+    return UploadStatusResponse(data=UploadStatusResponseData(**upload_status))
+
+@router.get("/{file_id}/completion", response_model=FinalizeStatusResponse, name="finalize_status")
+async def get_finalize_status(
+    file_id: str,
+    request: Request,
+    user_id: str = Depends(get_current_user_id)
+):
+    """
+    GET /files/{file_id}/completion - State and progress of an asynchronous completion (FINALIZE_MODE=async)
+    """
+    job_status = await finalize_queue.status(str(file_id), user_id)
+    if job_status is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No completion found for this file.")
+    return FinalizeStatusResponse(data=_finalize_status_data(request, file_id, job_status))
+
+def _finalize_status_data(request: Request, file_id: str, job_status: dict) -> FinalizeStatusData:
+    return FinalizeStatusData(
+        **{key: value for key, value in job_status.items() if key != "updated_at"},
+        status_url=str(request.url_for("finalize_status", file_id=file_id))
     )
 
+async def _enqueue_finalize(request: Request, file_id: str, req: CompleteSessionRequest, user_id: str) -> JSONResponse:
+    session = await session_store.aget(str(file_id))
+    job_status = None
+    if session is not None and session["user_id"] == user_id and session["main_service_file_id"] == req.main_service_file_id:
+        parts = [(part.chunk_index, part.etag) for part in req.parts] if req.parts else None
+        try:
+            job_status = await finalize_queue.submit(
+                str(file_id), session, user_id, req.total_chunks, req.main_service_file_id, parts
+            )
+        except IncompleteUploadError as e:
+            raise HTTPException(
+                status_code=status.HTTP_409_CONFLICT,
+                detail={"message": str(e), "total_chunks": e.total_chunks, "missing_chunks": e.missing}
+            )
+    if job_status is None:
+        # No session, or it went away meanwhile: a repeated PATCH after the job finished reports the finished job
+        job_status = await finalize_queue.status(str(file_id), user_id)
+        if job_status is None or job_status["file_id"] != req.main_service_file_id:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="File not found or access denied.")
+    data = _finalize_status_data(request, file_id, job_status)
+    body = FinalizeStatusResponse(message="File upload completion accepted.", data=data)
+    return JSONResponse(
+        status_code=status.HTTP_202_ACCEPTED,
+        content=body.model_dump(),
+        headers={"Location": data.status_url}
+    )
+
+@router.get("/{file_id}/parts", response_model=PresignedPartsResponse)
+async def get_presigned_parts(
+    file_id: str,
+    first_chunk: int = 0,
+    count: int = settings.S3_PRESIGNED_BATCH_SIZE,
+    user_id: str = Depends(get_current_user_id)
+):
+    """
+    GET /files/{file_id}/parts - Presigned upload URLs for chunks first_chunk.. (S3 presigned mode only)
+    """
+    if not await file_service.check_user_access(str(file_id), user_id):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="File not found or access denied.")
+    try:
+        parts = await file_service.presigned_parts(str(file_id), first_chunk, count)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return PresignedPartsResponse(data=[PresignedPart(**part) for part in parts])
+
 @router.get("/")
 async def list_files(user_id: str = Depends(get_current_user_id)):
     """
     GET /files - List user's files
     """
-    files = file_service.list_user_files(user_id)
+    files = await file_service.list_user_files(user_id)
     return {"status": "success", "files": files}
 
 @router.put("/{file_id}", response_model=ChunkUploadResponse)
@@ -78,93 +340,156 @@ async def upload_chunk_to_file(
     chunk: UploadFile = File(...),
     chunk_index: Optional[int] = Form(None),
     content_range: Optional[str] = Header(None),
+    upload_checksum: Optional[str] = Header(None),
     user_id: str = Depends(get_current_user_id)
 ):
     """
     PUT /files/{file_id} - Upload a chunk to an existing file session
     chunk_index from form data OR Content-Range header format: "bytes start-end/total"
+    Optional Upload-Checksum header: "<algorithm> <base64 digest>" of the chunk
     """
-    if not file_service.check_user_access(str(file_id), user_id):
+    if not await file_service.check_user_access(str(file_id), user_id):
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="File not found or access denied.")
     
+    if not chunk.size:
+        raise HTTPException(status_code=400, detail="Empty chunk received")
+
+    # Parse Content-Range: bytes 0-1023/2048 => byte offset of this chunk
+    offset = None
+    if content_range:
+        match = re.match(r'bytes (\d+)-(\d+)/(\d+)', content_range)
+        if not match:
+            raise HTTPException(status_code=400, detail="Invalid Content-Range header format")
+        start, end, total = (int(group) for group in match.groups())
+        if end < start or end >= total or end - start + 1 != chunk.size:
+            raise HTTPException(status_code=400, detail=f"Content-Range {content_range} doesn't match the {chunk.size} byte chunk")
+        offset = start
+
     # If chunk_index is not provided, calculate it from Content-Range header
     if chunk_index is None:
-        if content_range:
-            # Parse Content-Range: bytes 0-1023/2048 => chunk_index based on chunk size
-            match = re.match(r'bytes (\d+)-(\d+)/(\d+)', content_range)
-            if match:
-                start, end, total = map(int, match.groups())
-                # محاسبه chunk_index بر اساس start position
-                # فرض میکنیم هر chunk حداکثر 1MB باشه
-                chunk_index = start // (1024 * 1024)  # Default chunk size 1MB
-            else:
-                raise HTTPException(status_code=400, detail="Invalid Content-Range header format")
+        if offset is not None:
+            # محاسبه chunk_index بر اساس start position و chunk_size این session
+            try:
+                chunk_index = await file_service.chunk_index_for_range(str(file_id), start, end, total)
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=str(e))
         else:
             # اگر هیچکدوم نباشه، chunk_index رو 0 قرار میدیم
             chunk_index = 0
     
+    expected_checksum = None
+    if upload_checksum:
+        try:
+            expected_checksum = parse_checksum_header(upload_checksum)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+    
     try:
-        chunk_data = await chunk.read()
-        if not chunk_data:
-            raise HTTPException(status_code=400, detail="Empty chunk received")
-        
-        await file_service.save_chunk(str(file_id), chunk_index, chunk_data)
+        # The spooled part is handed over as a file object and copied to storage in bounded blocks
+        await file_service.save_chunk(str(file_id), chunk_index, chunk.file, offset, expected_checksum)
         return ChunkUploadResponse()
+    except ChecksumMismatchError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    except IOSaturatedError:
+        raise
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         logger.error(f"Failed to save chunk: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Failed to save chunk: {str(e)}")
 
+@router.post("/{file_id}/chunks", response_model=ChunkBatchResponse)
+async def upload_chunk_batch(
+    file_id: str,
+    request: Request,
+    user_id: str = Depends(get_current_user_id)
+):
+    """
+    POST /files/{file_id}/chunks - Upload several chunks in one multipart/form-data request
+    Every file part carries its own X-Chunk-Index header, plus optional X-Chunk-Offset (byte offset,
+    required in offset mode) and Upload-Checksum headers. Results are reported per chunk.
+    """
+    if not await file_service.check_user_access(str(file_id), user_id):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="File not found or access denied.")
+    if not request.headers.get("content-type", "").startswith("multipart/form-data"):
+        raise HTTPException(status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE, detail="Content-Type must be multipart/form-data")
+
+    form = await request.form(max_files=settings.CHUNK_BATCH_MAX_CHUNKS, max_fields=settings.CHUNK_BATCH_MAX_CHUNKS)
+    try:
+        chunks = []
+        for _, part in form.multi_items():
+            if not isinstance(part, StarletteUploadFile):
+                continue
+            try:
+                chunk_index = int(part.headers["x-chunk-index"])
+                offset = int(part.headers["x-chunk-offset"]) if "x-chunk-offset" in part.headers else None
+            except (KeyError, ValueError):
+                raise HTTPException(status_code=400, detail="Every chunk part needs a numeric X-Chunk-Index (and X-Chunk-Offset if given)")
+            expected_checksum = None
+            if "upload-checksum" in part.headers:
+                try:
+                    expected_checksum = parse_checksum_header(part.headers["upload-checksum"])
+                except ValueError as e:
+                    raise HTTPException(status_code=400, detail=f"Chunk {chunk_index}: {str(e)}")
+            chunks.append((chunk_index, part.file, offset, expected_checksum))
+        if not chunks:
+            raise HTTPException(status_code=400, detail="No chunk parts in request")
+
+        try:
+            results = await file_service.save_chunks(str(file_id), chunks)
+        except IOSaturatedError:
+            raise
+        except Exception as e:
+            logger.error(f"Failed to save chunk batch: {str(e)}")
+            raise HTTPException(status_code=500, detail=f"Failed to save chunks: {str(e)}")
+    finally:
+        await form.close()
+
+    return ChunkBatchResponse(
+        status="success" if all(result["status"] == "stored" for result in results) else "partial",
+        data=[ChunkBatchResult(**result) for result in results]
+    )
+
 @router.patch("/{file_id}", response_model=CompleteSessionResponse)
 async def complete_file_upload(
     file_id: str,
     req: CompleteSessionRequest,
+    request: Request,
     user_id: str = Depends(get_current_user_id)
 ):
     """
     PATCH /files/{file_id} - Complete the file upload process
+    With FINALIZE_MODE=async the work is queued and 202 is returned with the completion status URL.
     """
-    if not file_service.check_user_access(str(file_id), user_id, req.main_service_file_id):
+    if settings.FINALIZE_MODE == "async":
+        return await _enqueue_finalize(request, file_id, req, user_id)
+
+    if not await file_service.check_user_access(str(file_id), user_id, req.main_service_file_id):
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="File not found or access denied.")
     
-    session = session_map.get(str(file_id))
+    session = await session_store.aget(str(file_id))
     if not session:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Session not found.")
     
-    # استفاده از نام اصلی فایل به جای merged_final_file
-    original_filename = session['original_file_name']
-    merged_file_path = os.path.join(settings.PERSISTENT_LOCAL_STORAGE_PATH, str(file_id), original_filename)
-    
     try:
-        await file_service.merge_chunks(str(file_id), req.total_chunks, merged_file_path)
-
-        # Clean up logic
-        if settings.STORAGE_BACKEND == "s3":
-            s3_key = f"{user_id}/{req.main_service_file_id}/{session['original_file_name']}"
-            file_path_or_key = await file_service.upload_file(merged_file_path, s3_key)
-            await file_service.cleanup_session(str(file_id))  # Delete all chunks
-            await file_service.delete_file(file_path_or_key)  # Delete merged file
-            file_url = f"{settings.S3_ENDPOINT_URL}/{settings.S3_BUCKET_NAME}/{s3_key}"
-            session_map.pop(str(file_id), None)
-        else:
-            # برای local storage، فایل رو به final directory منتقل میکنیم
-            final_dir = os.path.join(settings.PERSISTENT_LOCAL_STORAGE_PATH, "final", user_id, str(file_id))
-            logger.info(f"Final dir: {final_dir}")
-            os.makedirs(final_dir, exist_ok=True)
-            final_file_path = os.path.join(final_dir, original_filename)
-            logger.info(f"Final file path: {final_file_path}")
-            
-            # انتقال فایل merged به final directory
-            shutil.move(merged_file_path, final_file_path)
-            logger.info(f"File moved to final location: {final_file_path}")
-            
-            await file_service.cleanup_session(str(file_id)) # Delete chunks
-            file_url = f"{settings.UPLOAD_SERVICE_BASE_URL}/files/{file_id}"
-            
+        parts = [(part.chunk_index, part.etag) for part in req.parts] if req.parts else None
+        file_url = await file_service.finalize_upload(
+            str(file_id), session, user_id, req.total_chunks, req.main_service_file_id, parts
+        )
         return CompleteSessionResponse(
             status="success",
             message="File upload completed and main service notified.",
             data=CompleteSessionResponseData(file_download_url=file_url)
         )
+    except IncompleteUploadError as e:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail={"message": str(e), "total_chunks": e.total_chunks, "missing_chunks": e.missing}
+        )
+    except ChecksumMismatchError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    except IOSaturatedError:
+        raise
     except Exception as e:
         logger.error(f"File upload failed: {str(e)}")
         raise HTTPException(status_code=500, detail="File upload failed.")
@@ -183,5 +508,7 @@ async def delete_file(
             return {"status": "success", "message": f"File {file_id} deleted successfully."}
         else:
             raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"File {file_id} not found.")
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to delete file {file_id}: {str(e)}")
@@ -0,0 +1,319 @@
+"""
+tus 1.0.0 resumable upload protocol (https://tus.io/protocols/resumable-upload) with the creation,
+termination, checksum and concatenation extensions.
+
+Every tus upload is an upload session and every PATCH is stored as the session's next chunk through
+the configured storage backend, so all backends work unchanged. With concatenation, clients upload
+several partial uploads over parallel connections and a final upload stitches them in order.
+"""
+from fastapi import APIRouter, Depends, HTTPException, status, Request
+from fastapi.responses import Response
+from starlette.datastructures import UploadFile
+from tempfile import SpooledTemporaryFile
+from urllib.parse import urlparse
+from uuid import uuid4
+from app.core.security import get_current_user_id
+from app.core.config import settings
+from app.core.session import session_store
+from app.services.file_service import file_service, IncompleteUploadError
+from app.services.checksum import parse_checksum_header, ChecksumMismatchError, ALGORITHMS
+from app.services.storage.scheduler import IOSaturatedError
+import base64
+import binascii
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+router = APIRouter()
+
+TUS_VERSION = "1.0.0"
+TUS_EXTENSIONS = "creation,termination,checksum,concatenation"
+# tus status code for a body that doesn't match its Upload-Checksum
+HTTP_460_CHECKSUM_MISMATCH = 460
+# A PATCH holds the upload for at most this long, so a crashed request can't wedge it
+PATCH_LOCK_SECONDS = 300
+
+
+def _tus_headers(**headers) -> dict:
+    return {"Tus-Resumable": TUS_VERSION, **headers}
+
+
+def _error(status_code: int, detail: str) -> HTTPException:
+    return HTTPException(status_code=status_code, detail=detail, headers=_tus_headers())
+
+
+def require_tus_resumable(request: Request):
+    if request.headers.get("tus-resumable") != TUS_VERSION:
+        raise HTTPException(
+            status_code=status.HTTP_412_PRECONDITION_FAILED,
+            detail=f"Tus-Resumable: {TUS_VERSION} is required",
+            headers=_tus_headers(**{"Tus-Version": TUS_VERSION})
+        )
+
+
+def _parse_metadata(value: str) -> dict:
+    metadata = {}
+    for pair in value.split(","):
+        pair = pair.strip()
+        if not pair:
+            continue
+        key, _, encoded = pair.partition(" ")
+        try:
+            metadata[key] = base64.b64decode(encoded, validate=True).decode() if encoded else ""
+        except (binascii.Error, UnicodeDecodeError):
+            raise _error(status.HTTP_400_BAD_REQUEST, f"Invalid Upload-Metadata value for '{key}'")
+    return metadata
+
+
+def _file_identity(metadata: dict):
+    """The main service file id and file name of a complete (non-partial) upload"""
+    try:
+        file_id = int(metadata["file_id"])
+    except (KeyError, ValueError):
+        raise _error(status.HTTP_400_BAD_REQUEST, "Upload-Metadata must include a numeric file_id")
+    file_name = metadata.get("filename") or metadata.get("name")
+    if not file_name:
+        raise _error(status.HTTP_400_BAD_REQUEST, "Upload-Metadata must include filename")
+    return file_id, file_name
+
+
+async def _get_upload(upload_id: str, user_id: str) -> dict:
+    session = await session_store.aget(upload_id)
+    if not session or session["user_id"] != user_id or "tus_length" not in session:
+        raise _error(status.HTTP_404_NOT_FOUND, "Upload not found.")
+    return session
+
+
+def _upload_url(request: Request, upload_id: str) -> str:
+    return str(request.url_for("tus_upload_offset", upload_id=upload_id))
+
+
+async def _finalize(upload_id: str, user_id: str) -> None:
+    session = await session_store.aget(upload_id)
+    try:
+        await file_service.finalize_upload(
+            upload_id, session, user_id, session.get("tus_chunks", 0), session["main_service_file_id"]
+        )
+    except IncompleteUploadError as e:
+        raise _error(status.HTTP_409_CONFLICT, str(e))
+    except ChecksumMismatchError as e:
+        raise _error(HTTP_460_CHECKSUM_MISMATCH, str(e))
+    except IOSaturatedError:
+        raise
+    except Exception as e:
+        logger.error(f"tus upload {upload_id} could not be finalized: {str(e)}")
+        raise _error(status.HTTP_500_INTERNAL_SERVER_ERROR, "File upload failed.")
+
+
+@router.options("/")
+async def tus_options():
+    """OPTIONS /tus - Server capabilities"""
+    headers = _tus_headers(**{
+        "Tus-Version": TUS_VERSION,
+        "Tus-Extension": TUS_EXTENSIONS,
+        "Tus-Checksum-Algorithm": ",".join(ALGORITHMS),
+    })
+    return Response(status_code=status.HTTP_204_NO_CONTENT, headers=headers)
+
+
+@router.post("/", dependencies=[Depends(require_tus_resumable)])
+async def tus_create(request: Request, user_id: str = Depends(get_current_user_id)):
+    """
+    POST /tus - Create an upload (creation extension)
+    Upload-Concat: partial creates a partial upload; Upload-Concat: final;<url> <url> ... stitches finished ones.
+    """
+    metadata = _parse_metadata(request.headers.get("upload-metadata", ""))
+    concat = request.headers.get("upload-concat")
+    if concat is not None and concat.startswith("final;"):
+        return await _create_final(request, user_id, metadata, concat[len("final;"):].split())
+    if concat not in (None, "partial"):
+        raise _error(status.HTTP_400_BAD_REQUEST, "Upload-Concat must be 'partial' or 'final;<urls>'")
+    if "upload-defer-length" in request.headers:
+        raise _error(status.HTTP_400_BAD_REQUEST, "Upload-Defer-Length is not supported")
+    try:
+        length = int(request.headers["upload-length"])
+    except (KeyError, ValueError):
+        raise _error(status.HTTP_400_BAD_REQUEST, "Upload-Length is required")
+    if length <= 0:
+        raise _error(status.HTTP_400_BAD_REQUEST, "Upload-Length must be positive")
+
+    if concat == "partial":
+        upload_id = uuid4().hex
+        file_id, file_name = upload_id, "partial"
+    else:
+        file_id, file_name = _file_identity(metadata)
+        upload_id = str(file_id)
+        existing = await session_store.aget(upload_id)
+        if existing and existing["user_id"] != user_id:
+            raise _error(status.HTTP_409_CONFLICT, "Upload already exists.")
+
+    await file_service.create_session(file_id, user_id, file_name, length)
+    await session_store.aupdate(upload_id, tus_length=length, tus_offset=0, tus_chunks=0, tus_concat=concat)
+    return Response(
+        status_code=status.HTTP_201_CREATED,
+        headers=_tus_headers(Location=_upload_url(request, upload_id))
+    )
+
+
+async def _create_final(request: Request, user_id: str, metadata: dict, partial_urls: list):
+    if not partial_urls:
+        raise _error(status.HTTP_400_BAD_REQUEST, "Upload-Concat: final needs at least one partial upload")
+    file_id, file_name = _file_identity(metadata)
+    upload_id = str(file_id)
+    existing = await session_store.aget(upload_id)
+    if existing and existing["user_id"] != user_id:
+        raise _error(status.HTTP_409_CONFLICT, "Upload already exists.")
+
+    sources = []
+    for url in partial_urls:
+        partial_id = urlparse(url).path.rstrip("/").rsplit("/", 1)[-1]
+        partial = await session_store.aget(partial_id)
+        if not partial or partial["user_id"] != user_id or partial.get("tus_concat") != "partial":
+            raise _error(status.HTTP_400_BAD_REQUEST, f"{url} is not a partial upload")
+        if partial["tus_offset"] != partial["tus_length"]:
+            raise _error(status.HTTP_400_BAD_REQUEST, f"Partial upload {url} is not finished")
+        sources.append((partial_id, partial))
+
+    if existing:
+        # A repeated final POST rebuilds the upload from the partials; drop what the last attempt left
+        await file_service.cleanup_session(upload_id)
+    length = sum(partial["tus_length"] for _, partial in sources)
+    await file_service.create_session(file_id, user_id, file_name, length)
+    await session_store.aupdate(upload_id, tus_length=length, tus_offset=length, tus_chunks=0, tus_concat="final")
+    try:
+        chunk_count = await file_service.adopt_uploads(upload_id, sources)
+    except ValueError as e:
+        await file_service.discard_uploads([upload_id])
+        raise _error(status.HTTP_400_BAD_REQUEST, str(e))
+    except IOSaturatedError:
+        await file_service.discard_uploads([upload_id])
+        raise
+    except Exception as e:
+        logger.error(f"Concatenating {len(sources)} partial uploads into {upload_id} failed: {str(e)}")
+        await file_service.discard_uploads([upload_id])
+        raise _error(status.HTTP_500_INTERNAL_SERVER_ERROR, "Concatenation failed.")
+    await session_store.aupdate(upload_id, tus_chunks=chunk_count)
+    await _finalize(upload_id, user_id)
+    # The partial uploads are only released once the final one is complete, so a failed one can be retried
+    await file_service.discard_uploads([partial_id for partial_id, _ in sources])
+    return Response(
+        status_code=status.HTTP_201_CREATED,
+        headers=_tus_headers(Location=_upload_url(request, upload_id))
+    )
+
+
+@router.head("/{upload_id}", name="tus_upload_offset", dependencies=[Depends(require_tus_resumable)])
+async def tus_head(upload_id: str, user_id: str = Depends(get_current_user_id)):
+    """HEAD /tus/{upload_id} - Current offset of an upload"""
+    session = await session_store.aget(upload_id)
+    if session and session["user_id"] == user_id and "tus_length" in session:
+        headers = _tus_headers(**{
+            "Upload-Offset": str(session["tus_offset"]),
+            "Upload-Length": str(session["tus_length"]),
+            "Cache-Control": "no-store",
+        })
+        if session.get("tus_concat"):
+            headers["Upload-Concat"] = session["tus_concat"]
+        return Response(status_code=status.HTTP_200_OK, headers=headers)
+
+    # Finished uploads no longer have a session; report them as complete from the catalog
+    record = await file_service.catalog.aget(user_id, upload_id)
+    if record is None or record.get("size") is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, headers=_tus_headers(**{"Cache-Control": "no-store"}))
+    size = str(record["size"])
+    return Response(
+        status_code=status.HTTP_200_OK,
+        headers=_tus_headers(**{"Upload-Offset": size, "Upload-Length": size, "Cache-Control": "no-store"})
+    )
+
+
+@router.patch("/{upload_id}", dependencies=[Depends(require_tus_resumable)])
+async def tus_patch(upload_id: str, request: Request, user_id: str = Depends(get_current_user_id)):
+    """PATCH /tus/{upload_id} - Append the body at Upload-Offset"""
+    if request.headers.get("content-type") != "application/offset+octet-stream":
+        raise _error(status.HTTP_415_UNSUPPORTED_MEDIA_TYPE, "Content-Type must be application/offset+octet-stream")
+    try:
+        offset = int(request.headers["upload-offset"])
+    except (KeyError, ValueError):
+        raise _error(status.HTTP_400_BAD_REQUEST, "Upload-Offset is required")
+    session = await _get_upload(upload_id, user_id)
+    if session.get("tus_concat") == "final":
+        raise _error(status.HTTP_403_FORBIDDEN, "Final uploads cannot be patched")
+    if offset != session["tus_offset"]:
+        raise _error(status.HTTP_409_CONFLICT, f"Upload-Offset {offset} does not match {session['tus_offset']}")
+    expected_checksum = None
+    if "upload-checksum" in request.headers:
+        try:
+            expected_checksum = parse_checksum_header(request.headers["upload-checksum"])
+        except ValueError as e:
+            raise _error(status.HTTP_400_BAD_REQUEST, str(e))
+
+    remaining = session["tus_length"] - offset
+    body = UploadFile(file=SpooledTemporaryFile(max_size=settings.CHUNK_SPOOL_MAX_SIZE))
+    try:
+        size = 0
+        async for block in request.stream():
+            size += len(block)
+            if size > remaining:
+                raise _error(status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, "Body exceeds Upload-Length")
+            await body.write(block)
+        await body.seek(0)
+
+        if size:
+            await _store_patch(upload_id, offset, size, body, expected_checksum)
+        new_offset = offset + size
+    finally:
+        await body.close()
+
+    # A repeated empty PATCH at the end retries a completion that failed earlier
+    if new_offset == session["tus_length"] and session.get("tus_concat") != "partial":
+        await _finalize(upload_id, user_id)
+    return Response(status_code=status.HTTP_204_NO_CONTENT, headers=_tus_headers(**{"Upload-Offset": str(new_offset)}))
+
+
+async def _store_patch(upload_id: str, offset: int, size: int, body: UploadFile, expected_checksum) -> None:
+    state = {}
+
+    def reserve(session: dict):
+        now = time.time()
+        state["reserved"] = session.get("tus_offset") == offset and session.get("tus_lock_until", 0) < now
+        if state["reserved"]:
+            session["tus_lock_until"] = now + PATCH_LOCK_SECONDS
+            state["chunk_index"] = session.get("tus_chunks", 0)
+
+    def advance(session: dict):
+        session["tus_offset"] = offset + size
+        session["tus_chunks"] = state["chunk_index"] + 1
+        session.pop("tus_lock_until", None)
+
+    def release(session: dict):
+        session.pop("tus_lock_until", None)
+
+    await session_store.amutate(upload_id, reserve)
+    if not state.get("reserved"):
+        raise _error(status.HTTP_409_CONFLICT, "Upload is being written by another request")
+    try:
+        await file_service.save_chunk(upload_id, state["chunk_index"], body.file, offset, expected_checksum)
+    except ChecksumMismatchError as e:
+        await session_store.amutate(upload_id, release)
+        raise _error(HTTP_460_CHECKSUM_MISMATCH, str(e))
+    except IOSaturatedError:
+        await session_store.amutate(upload_id, release)
+        raise
+    except ValueError as e:
+        await session_store.amutate(upload_id, release)
+        raise _error(status.HTTP_400_BAD_REQUEST, str(e))
+    except Exception as e:
+        await session_store.amutate(upload_id, release)
+        logger.error(f"Failed to store tus PATCH for {upload_id}: {str(e)}")
+        raise _error(status.HTTP_500_INTERNAL_SERVER_ERROR, "Failed to store data.")
+    await session_store.amutate(upload_id, advance)
+
+
+@router.delete("/{upload_id}", dependencies=[Depends(require_tus_resumable)])
+async def tus_terminate(upload_id: str, user_id: str = Depends(get_current_user_id)):
+    """DELETE /tus/{upload_id} - Abandon an unfinished upload (termination extension)"""
+    await _get_upload(upload_id, user_id)
+    await file_service.cleanup_session(upload_id)
+    await session_store.adelete(upload_id)
+    return Response(status_code=status.HTTP_204_NO_CONTENT, headers=_tus_headers())
@@ -0,0 +1,93 @@
+import hashlib
+import os
+import re
+from email.utils import formatdate, parsedate_to_datetime
+from typing import Mapping, Optional
+from urllib.parse import quote
+
+
+def stat_etag(stat_result: os.stat_result) -> str:
+    """Same validator FileResponse derives from a stat result, so 200, 206 and 304 responses agree"""
+    return version_etag(stat_result.st_mtime, stat_result.st_size)
+
+
+def version_etag(mtime: float, size) -> str:
+    etag_base = str(mtime) + "-" + str(size)
+    return f'"{hashlib.md5(etag_base.encode(), usedforsecurity=False).hexdigest()}"'
+
+
+def checksum_etag(checksum: str) -> str:
+    """Strong validator from a catalog checksum ('<algorithm>:<digest>')"""
+    return f'"{checksum.split(":", 1)[-1]}"'
+
+
+def last_modified(stat_result: os.stat_result) -> str:
+    return http_date(stat_result.st_mtime)
+
+
+def http_date(timestamp: float) -> str:
+    return formatdate(timestamp, usegmt=True)
+
+
+def content_disposition(filename: str) -> str:
+    """attachment header as FileResponse builds it, for responses that don't come from a file path"""
+    quoted = quote(filename)
+    if quoted != filename:
+        return f"attachment; filename*=utf-8''{quoted}"
+    return f'attachment; filename="{filename}"'
+
+
+def _strip_weak(tag: str) -> str:
+    tag = tag.strip()
+    return tag[2:] if tag.startswith("W/") else tag
+
+
+_SINGLE_RANGE = re.compile(r"bytes=(\d*)-(\d*)")
+
+
+def requested_range(request_headers: Mapping[str, str], etag: str, mtime: Optional[float]) -> Optional[str]:
+    """
+    The Range header of a request for a single byte range that applies (RFC 9110 section 13.1.5 If-Range),
+    in the form S3 accepts; None when the whole representation should be sent instead.
+    """
+    value = request_headers.get("range")
+    match = _SINGLE_RANGE.fullmatch(value.strip()) if value else None
+    if match is None or match.group(1) == match.group(2) == "":
+        return None
+    if match.group(1) and match.group(2) and int(match.group(1)) > int(match.group(2)):
+        return None
+    if_range = request_headers.get("if-range")
+    if if_range is not None:
+        if_range = if_range.strip()
+        if if_range.startswith('"') or if_range.startswith("W/"):
+            # Only a strong match lets the range through
+            return match.group(0) if if_range == etag else None
+        try:
+            since = parsedate_to_datetime(if_range).timestamp()
+        except (TypeError, ValueError):
+            return None
+        if mtime is None or int(mtime) > since:
+            return None
+    return match.group(0)
+
+
+def is_not_modified(request_headers: Mapping[str, str], etag: str, mtime: Optional[float]) -> bool:
+    """
+    Evaluates If-None-Match / If-Modified-Since as described in RFC 9110 section 13.2.2.
+    If-None-Match takes precedence, and If-Modified-Since is ignored when it is present.
+    """
+    if_none_match = request_headers.get("if-none-match")
+    if if_none_match is not None:
+        if if_none_match.strip() == "*":
+            return True
+        wanted = _strip_weak(etag)
+        return any(_strip_weak(tag) == wanted for tag in if_none_match.split(","))
+
+    if_modified_since = request_headers.get("if-modified-since")
+    if if_modified_since is not None and mtime is not None:
+        try:
+            since = parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+        return int(mtime) <= since
+    return False
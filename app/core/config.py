@@ -8,21 +8,103 @@ class Settings(BaseSettings):
     JWT_ALGORITHM: str = "RS256"
     EXPECTED_JWT_ISSUER: str
     EXPECTED_JWT_AUDIENCE: str
+    # Verified tokens are cached so repeated requests with the same token skip the RSA check
+    JWT_CACHE_MAX_ENTRIES: int = 10000
+    JWT_CACHE_MAX_TTL_SECONDS: int = 300
 
     S3_ACCESS_KEY: str = ""
     S3_SECRET_KEY: str = ""
     S3_BUCKET_NAME: str = "hayula-uploads"
     S3_ENDPOINT_URL: str = ""
     S3_REGION_NAME: Optional[str] = None
+    # 'staged' merges chunks locally then uploads; 'multipart' sends each chunk as an S3 multipart part;
+    # 'presigned' hands clients presigned part URLs so chunks go straight to the bucket
+    S3_UPLOAD_MODE: str = "staged"
+    S3_PRESIGNED_PART_SIZE: int = 8 * 1024 * 1024  # chunk size clients use in presigned mode (>= 5 MiB)
+    S3_PRESIGNED_URL_EXPIRES: int = 3600
+    S3_PRESIGNED_BATCH_SIZE: int = 100  # part URLs returned by POST /files and per GET .../parts request
+    # One shared client serves every S3 call; its pool size bounds concurrent S3 requests per process
+    S3_MAX_POOL_CONNECTIONS: int = 50
+    S3_TCP_KEEPALIVE: bool = True
+    S3_CONNECT_TIMEOUT: float = 5
+    S3_READ_TIMEOUT: float = 60
+    S3_MAX_ATTEMPTS: int = 5
+    S3_RETRY_MODE: str = "standard"  # 'legacy', 'standard' or 'adaptive'
 
     # Local Temporary Storage for Chunks (Optional, if not using direct S3 multipart)
     LOCAL_TEMP_CHUNK_PATH: str = "/tmp/hayula_chunks"
 
+    # Chunk bodies are copied to storage in blocks of this size instead of being read whole
+    CHUNK_IO_BUFFER_SIZE: int = 256 * 1024
+    CHUNK_BATCH_MAX_CHUNKS: int = 256  # parts accepted by one POST /files/{file_id}/chunks request
+    # Multipart chunk parts larger than this are spooled to disk by the form parser instead of RAM
+    CHUNK_SPOOL_MAX_SIZE: int = 256 * 1024
+
+    # Hash fan-out of scratch and final directories (see app/services/storage/layout.py); 0 keeps the flat layout
+    STORAGE_SHARD_LEVELS: int = 0
+    STORAGE_SHARD_WIDTH: int = 2  # hex digits per level
+
     # Persistent Local Storage for completed files (if not using S3 as primary)
     PERSISTENT_LOCAL_STORAGE_PATH: str = "/var/data/hayula_uploads" # Example, make sure this path is writable by the service
+    # Catalog of completed files used for list/get/delete lookups
+    CATALOG_BACKEND: str = "sqlite"
+    CATALOG_SQLITE_PATH: str = ""  # defaults to PERSISTENT_LOCAL_STORAGE_PATH/catalog.db
     UPLOAD_SERVICE_BASE_URL: str = "http://localhost:8004" # Or your actual service URL
+    # S3 mode: GET /files/{file_id} serves objects through a read-through LRU disk cache
+    DOWNLOAD_CACHE_PATH: str = ""  # defaults to PERSISTENT_LOCAL_STORAGE_PATH/cache
+    DOWNLOAD_CACHE_MAX_BYTES: int = 10 * 1024 * 1024 * 1024
+    S3_SERVE_DOWNLOADS: bool = False  # hand out GET /files/{file_id} URLs instead of raw bucket URLs
+
+    # 'auto' picks copy_file_range, then sendfile, then a buffered readinto copy
+    MERGE_STRATEGY: str = "auto"
+    MERGE_BUFFER_SIZE: int = 8 * 1024 * 1024
+    # Chunks copied concurrently into a preallocated output on a dedicated pool; 1 keeps the serial merge
+    MERGE_PARALLELISM: int = 1
+
+    # Digest computed for every chunk as it streams in: 'md5', 'sha256', 'crc32c' (needs google-crc32c) or 'none'
+    CHECKSUM_ALGORITHM: str = "md5"
+
+    # Where upload sessions live: 'memory' (single worker), 'sqlite' (one host) or 'redis' (many hosts)
+    SESSION_STORE_BACKEND: str = "memory"
+    SESSION_STORE_SQLITE_PATH: str = "/tmp/hayula_sessions.db"
+    SESSION_STORE_REDIS_URL: str = "redis://localhost:6379/0"
+    SESSION_STORE_KEY_PREFIX: str = "upload_session:"
+    SESSION_TTL_SECONDS: int = 24 * 60 * 60
+
+    # Background cleanup of abandoned sessions; idle sessions expire after SESSION_TTL_SECONDS
+    JANITOR_ENABLED: bool = True
+    JANITOR_INTERVAL_SECONDS: float = 300
+    JANITOR_MIN_IDLE_SECONDS: float = 600  # never touch a session active more recently than this
+    JANITOR_DISK_HIGH_WATER_PERCENT: float = 90.0  # evict oldest-idle sessions while scratch disk is fuller
+    JANITOR_MULTIPART_KEY_PREFIX: str = ""  # only multipart uploads under this key prefix are ever aborted
+
+    # I/O scheduler: separate bounded pools for chunk writes, merges and S3 transfers
+    IO_CHUNK_WORKERS: int = 4
+    IO_CHUNK_MAX_QUEUE: int = 64  # jobs waiting for a thread before new chunk writes get 503
+    IO_MERGE_WORKERS: int = 2
+    IO_MERGE_MAX_QUEUE: int = 8
+    IO_S3_WORKERS: int = 16
+    IO_S3_MAX_QUEUE: int = 64
+    IO_MAX_INFLIGHT_BYTES: int = 512 * 1024 * 1024  # upload bodies held at once before 429; 0 disables
+    IO_RETRY_AFTER_SECONDS: int = 1  # Retry-After sent with 429/503 when saturated
+    STORAGE_FD_CACHE_SIZE: int = 256  # session directory / partial file descriptors kept open; 0 disables
+
+    # When writes are fsynced: 'none', 'on-complete', 'per-chunk' or 'group-commit' (see app/services/storage/durability.py)
+    DURABILITY_MODE: str = "on-complete"
+    DURABILITY_GROUP_COMMIT_WINDOW_MS: float = 2.0
+
+    # 'sync' completes uploads inside PATCH /files/{file_id}; 'async' answers 202 and runs a finalize job
+    FINALIZE_MODE: str = "sync"
+    FINALIZE_WORKERS: int = 2
+    FINALIZE_MAX_QUEUE: int = 100  # queued jobs before PATCH gets 503
+    FINALIZE_MAX_ATTEMPTS: int = 3
+    FINALIZE_RETRY_BACKOFF_SECONDS: float = 2.0  # doubled after every failed attempt
+    FINALIZE_PROGRESS_INTERVAL_SECONDS: float = 1.0
 
     STORAGE_BACKEND: str = "local"  # 's3' or 'local'
+    # 'chunks' stores each chunk as its own file and merges on completion;
+    # 'offset' writes every chunk at its byte offset into one preallocated file
+    LOCAL_WRITE_MODE: str = "chunks"
     SERVICE_PORT: int = 8000
 
     model_config = SettingsConfigDict(
@@ -0,0 +1,175 @@
+"""
+Prometheus metrics, served in the text exposition format on GET /metrics.
+
+Instruments are created once, at import time, with their label sets already rendered, so recording
+a value on the chunk path is a bisect and a few additions under a lock; nothing is formatted until
+the endpoint is scraped. Gauges are read from callbacks at scrape time.
+"""
+import time
+import bisect
+import logging
+import threading
+from typing import Callable, Dict, List, Optional, Tuple, Union
+
+# Seconds; from sub-millisecond token checks up to multi-minute merges and transfers
+DEFAULT_BUCKETS = (
+    0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+    1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0,
+)
+
+logger = logging.getLogger(__name__)
+
+
+def _labels(labels: Dict[str, str], extra: str = "") -> str:
+    pairs = [f'{name}="{value}"' for name, value in labels.items()]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Registry:
+    def __init__(self):
+        self._families: Dict[str, Tuple[str, str, list]] = {}
+        self._lock = threading.Lock()
+
+    def register(self, name: str, kind: str, help: str, metric) -> None:
+        with self._lock:
+            family = self._families.setdefault(name, (kind, help, []))
+            if family[0] != kind:
+                raise ValueError(f"Metric {name} is already registered as a {family[0]}")
+            family[2].append(metric)
+
+    def render(self) -> str:
+        lines = []
+        with self._lock:
+            families = [(name, kind, help, list(metrics)) for name, (kind, help, metrics) in self._families.items()]
+        for name, kind, help, metrics in families:
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            for metric in metrics:
+                lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+
+class Counter:
+    def __init__(self, name: str, help: str, **labels: str):
+        self._series = f"{name}{_labels(labels)}"
+        self._lock = threading.Lock()
+        self.value = 0
+        registry.register(name, "counter", help, self)
+
+    def inc(self, amount: int = 1) -> None:
+        with self._lock:
+            self.value += amount
+
+    def samples(self) -> List[str]:
+        return [f"{self._series} {_number(self.value)}"]
+
+
+class _Timer:
+    __slots__ = ("histogram", "started")
+
+    def __init__(self, histogram: "Histogram"):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.started)
+        return False
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, buckets: Tuple[float, ...] = DEFAULT_BUCKETS, **labels: str):
+        self.buckets = tuple(buckets)
+        # Series names are rendered here once, so scraping only formats the numbers
+        self._bucket_series = [
+            f"{name}_bucket" + _labels(labels, 'le="' + _number(bound) + '"')
+            for bound in self.buckets + (float("inf"),)
+        ]
+        self._sum_series = f"{name}_sum{_labels(labels)}"
+        self._count_series = f"{name}_count{_labels(labels)}"
+        self._lock = threading.Lock()
+        # One extra slot for observations above the last bucket (+Inf)
+        self._counts = [0] * (len(self.buckets) + 1)
+        self._sum = 0.0
+        registry.register(name, "histogram", help, self)
+
+    def observe(self, value: float) -> None:
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self._counts[index] += 1
+            self._sum += value
+
+    def time(self) -> _Timer:
+        """Context manager observing the duration of its block"""
+        return _Timer(self)
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            counts = list(self._counts)
+            total = self._sum
+        lines = []
+        cumulative = 0
+        for series, count in zip(self._bucket_series, counts):
+            cumulative += count
+            lines.append(f"{series} {cumulative}")
+        lines.append(f"{self._sum_series} {_number(total)}")
+        lines.append(f"{self._count_series} {cumulative}")
+        return lines
+
+
+class Gauge:
+    """
+    Value read from fn at scrape time. With label set, fn returns {label value: number} and one
+    sample is exported per entry.
+    """
+
+    def __init__(self, name: str, help: str, fn: Callable[[], Union[float, Dict[str, float], None]],
+                 label: Optional[str] = None):
+        self.name = name
+        self.fn = fn
+        self.label = label
+        registry.register(name, "gauge", help, self)
+
+    def samples(self) -> List[str]:
+        try:
+            value = self.fn()
+        except Exception as e:
+            # One unavailable source (e.g. the session store) shouldn't fail the whole scrape
+            logger.warning(f"Gauge {self.name} unavailable: {str(e)}")
+            return []
+        if value is None:
+            return []
+        if self.label is None:
+            return [f"{self.name} {_number(value)}"]
+        return [f"{self.name}{_labels({self.label: key})} {_number(item)}" for key, item in value.items()]
+
+
+def render() -> str:
+    return registry.render()
+
+
+# Upload pipeline stages; one series of hayula_stage_duration_seconds per stage
+STAGE_HELP = "Time spent in each upload pipeline stage"
+JWT_VERIFY_SECONDS = Histogram("hayula_stage_duration_seconds", STAGE_HELP, stage="jwt_verify")
+CHUNK_WRITE_SECONDS = Histogram("hayula_stage_duration_seconds", STAGE_HELP, stage="chunk_write")
+MERGE_SECONDS = Histogram("hayula_stage_duration_seconds", STAGE_HELP, stage="merge")
+S3_UPLOAD_SECONDS = Histogram("hayula_stage_duration_seconds", STAGE_HELP, stage="s3_upload")
+CLEANUP_SECONDS = Histogram("hayula_stage_duration_seconds", STAGE_HELP, stage="cleanup")
+DOWNLOAD_SECONDS = Histogram("hayula_stage_duration_seconds", STAGE_HELP, stage="download")
+FSYNC_SECONDS = Histogram("hayula_stage_duration_seconds", STAGE_HELP, stage="fsync")
+
+BYTES_INGESTED = Counter("hayula_ingested_bytes_total", "Chunk bytes accepted from clients")
+BYTES_SERVED = Counter("hayula_served_bytes_total", "File bytes sent in download responses")
@@ -0,0 +1,243 @@
+import json
+import re
+from typing import Iterable, List, Optional, Tuple
+from jwt import InvalidTokenError
+from app.core.security import verify_token, check_file_access
+
+# Routes that need a file access check: (compiled pattern, where file_id comes from).
+# "url" means the first capture group, anything else is the JSON body field holding the file_id.
+FILE_ACCESS_ROUTES = [
+    (re.compile(r'/upload/download/(\d+)'), "url"),                    # Download file
+    (re.compile(r'/upload/init'), "main_service_file_id"),             # Start upload (file_id is in the body)
+    (re.compile(r'/upload/complete'), "main_service_file_id"),         # Complete upload (file_id is in the body)
+    (re.compile(r'/upload/file'), "file_id"),                          # Delete file (file_id is in the body)
+]
+
+# Routes that carry upload bodies and go through admission control: (method, compiled pattern)
+UPLOAD_BODY_ROUTES = [
+    ("PUT", re.compile(r'/files/[^/]+$')),      # Chunk upload
+    ("POST", re.compile(r'/files/[^/]+/chunks$')),  # Chunk batch upload
+    ("PATCH", re.compile(r'/tus/[^/]+$')),      # tus PATCH
+]
+
+# JSON bodies on the file access routes are tiny; anything larger is not buffered
+MAX_INSPECTED_BODY_SIZE = 64 * 1024
+
+
+def _encode_headers(headers: Iterable[Tuple[str, str]]) -> List[Tuple[bytes, bytes]]:
+    return [(name.lower().encode("latin-1"), value.encode("latin-1")) for name, value in headers]
+
+
+class UploadGatewayMiddleware:
+    """
+    Pure ASGI replacement for the CORS and file access middleware stack.
+    Request bodies are never touched except the small JSON bodies of the file access routes,
+    and all CORS header blocks are encoded once at startup.
+    """
+
+    def __init__(
+        self,
+        app,
+        allow_origins: Iterable[str],
+        allow_methods: Iterable[str],
+        allow_headers: Iterable[str],
+        expose_headers: Iterable[str],
+        max_age: int = 600,
+    ):
+        self.app = app
+        allow_origins = list(allow_origins)
+        self.allow_all_origins = "*" in allow_origins
+        self.allow_origins = {origin.encode("latin-1") for origin in allow_origins}
+        self.simple_headers = _encode_headers([
+            ("Access-Control-Allow-Credentials", "true"),
+            ("Access-Control-Expose-Headers", ", ".join(expose_headers)),
+            ("Vary", "Origin"),
+        ])
+        self.preflight_headers = _encode_headers([
+            ("Access-Control-Allow-Credentials", "true"),
+            ("Access-Control-Allow-Methods", ", ".join(allow_methods)),
+            ("Access-Control-Allow-Headers", ", ".join(allow_headers)),
+            ("Access-Control-Max-Age", str(max_age)),
+            ("Vary", "Origin"),
+            ("Content-Length", "2"),
+            ("Content-Type", "text/plain; charset=utf-8"),
+        ])
+
+    def _origin_allowed(self, origin: bytes) -> bool:
+        return self.allow_all_origins or origin in self.allow_origins
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        origin = authorization = None
+        is_preflight = False
+        for name, value in scope["headers"]:
+            if name == b"origin":
+                origin = value
+            elif name == b"authorization":
+                authorization = value
+            elif name == b"access-control-request-method":
+                is_preflight = True
+
+        if origin is not None and not self._origin_allowed(origin):
+            origin = None
+
+        if is_preflight and origin is not None and scope["method"] == "OPTIONS":
+            await send({
+                "type": "http.response.start",
+                "status": 200,
+                "headers": [(b"access-control-allow-origin", origin)] + self.preflight_headers,
+            })
+            await send({"type": "http.response.body", "body": b"OK"})
+            return
+
+        if origin is not None:
+            cors_headers = [(b"access-control-allow-origin", origin)] + self.simple_headers
+
+            async def send_with_cors(message):
+                if message["type"] == "http.response.start":
+                    message.setdefault("headers", [])
+                    message["headers"] = list(message["headers"]) + cors_headers
+                await send(message)
+        else:
+            send_with_cors = send
+
+        path = scope["path"]
+        for pattern, file_id_source in FILE_ACCESS_ROUTES:
+            match = pattern.match(path)
+            if match:
+                receive = await self._check_file_access(scope, receive, send_with_cors, authorization, match, file_id_source)
+                if receive is None:
+                    return
+                break
+
+        await self.app(scope, receive, send_with_cors)
+
+    async def _check_file_access(self, scope, receive, send, authorization: Optional[bytes], match, file_id_source):
+        """Returns the receive callable to continue with, or None once an error response was sent"""
+        if not authorization or not authorization.startswith(b"Bearer "):
+            await self._error(send, 401, "Missing or invalid authorization header")
+            return None
+
+        try:
+            payload = verify_token(authorization[7:].decode("latin-1"))
+        except InvalidTokenError:
+            await self._error(send, 401, "Invalid token")
+            return None
+        except Exception:
+            await self._error(send, 401, "Token validation error")
+            return None
+
+        requested_file_id = None
+        if file_id_source == "url":
+            requested_file_id = int(match.group(1))
+        else:
+            body, more_body = await self._read_body(receive)
+            if not more_body and body:
+                try:
+                    requested_file_id = json.loads(body).get(file_id_source)
+                except (ValueError, AttributeError):
+                    pass
+            receive = self._replay(body, more_body, receive)
+
+        if requested_file_id is None:
+            # If we couldn't find file_id, be cautious
+            await self._error(send, 400, "Could not determine file_id from request.")
+            return None
+
+        try:
+            allowed = check_file_access(payload, requested_file_id)
+        except (TypeError, ValueError):
+            allowed = False
+        if not allowed:
+            jwt_file_id = payload.get("file_id", "unknown")
+            await self._error(send, 403, f"Access denied. JWT is for file {jwt_file_id}, but you requested file {requested_file_id}.")
+            return None
+
+        # Adding JWT payload to request state so endpoints can use it
+        scope.setdefault("state", {})["jwt_payload"] = payload
+        return receive
+
+    @staticmethod
+    async def _read_body(receive):
+        body = b""
+        while True:
+            message = await receive()
+            body += message.get("body", b"")
+            more_body = message.get("more_body", False)
+            if not more_body or len(body) > MAX_INSPECTED_BODY_SIZE:
+                return body, more_body
+
+    @staticmethod
+    def _replay(body: bytes, more_body: bool, receive):
+        """Hands the already consumed part of the body back to the endpoint before reading the rest"""
+        replayed = False
+
+        async def replay_receive():
+            nonlocal replayed
+            if not replayed:
+                replayed = True
+                return {"type": "http.request", "body": body, "more_body": more_body}
+            return await receive()
+
+        return replay_receive
+
+    @staticmethod
+    async def _error(send, status_code: int, detail: str, headers: Iterable[Tuple[bytes, bytes]] = ()):
+        body = json.dumps({"detail": detail}).encode()
+        await send({
+            "type": "http.response.start",
+            "status": status_code,
+            "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())] + list(headers),
+        })
+        await send({"type": "http.response.body", "body": body})
+
+
+class AdmissionMiddleware:
+    """
+    Refuses upload bodies up front when the process is saturated, before any byte is read:
+    503 while the chunk write queue is full, 429 while the in-flight byte budget is spent.
+    Both carry Retry-After. Admitted requests hold their Content-Length against the budget
+    until the response is finished, so a body without one (chunked transfer encoding) gets 411.
+    """
+
+    def __init__(self, app, inflight_bytes, write_pool, retry_after: int):
+        self.app = app
+        self.inflight_bytes = inflight_bytes
+        self.write_pool = write_pool
+        self.retry_after_header = [(b"retry-after", str(retry_after).encode())]
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not any(
+            scope["method"] == method and pattern.match(scope["path"]) for method, pattern in UPLOAD_BODY_ROUTES
+        ):
+            await self.app(scope, receive, send)
+            return
+
+        size = None
+        for name, value in scope["headers"]:
+            if name == b"content-length":
+                try:
+                    size = int(value)
+                except ValueError:
+                    pass
+                break
+
+        if size is None:
+            await UploadGatewayMiddleware._error(send, 411, "Content-Length is required for uploads.")
+            return
+        if size < 0:
+            await UploadGatewayMiddleware._error(send, 400, "Invalid Content-Length.")
+            return
+        if self.write_pool.saturated():
+            await UploadGatewayMiddleware._error(send, 503, "Upload queue is full, retry later.", self.retry_after_header)
+            return
+        if not self.inflight_bytes.try_acquire(size):
+            await UploadGatewayMiddleware._error(send, 429, "Too many uploads in flight, retry later.", self.retry_after_header)
+            return
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.inflight_bytes.release(size)
@@ -3,70 +3,108 @@ from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 import jwt
 from jwt import InvalidTokenError, ExpiredSignatureError, InvalidAudienceError, InvalidIssuerError, MissingRequiredClaimError
 from app.core.config import settings
-from typing import Dict, Any
-import re
+from app.core import metrics
+from cryptography.hazmat.primitives import serialization
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Dict, Any, Optional, Tuple
+import hashlib
+import logging
+import threading
+import time
 
 security = HTTPBearer()
+logger = logging.getLogger(__name__)
 
 
-def get_current_user_id(credentials: HTTPAuthorizationCredentials = Depends(security)):
-    token = credentials.credentials
-    print(f"Received token: {token}")
-    try:
-        unverified_header = jwt.get_unverified_header(token)
-        print(f"Unverified header: {unverified_header}")
-    except Exception as e:
-        print(f"Error getting unverified header: {e}")
+@lru_cache(maxsize=1)
+def get_jwt_public_key():
+    """Parses the PEM public key once; PyJWT accepts the key object directly"""
+    return serialization.load_pem_public_key(settings.MAIN_SERVICE_JWT_PUBLIC_KEY.encode())
 
-    try:
-        payload = jwt.decode(
-            token,
-            settings.MAIN_SERVICE_JWT_PUBLIC_KEY,
-            algorithms=["RS256"],
-            audience=settings.EXPECTED_JWT_AUDIENCE,
-            issuer=settings.EXPECTED_JWT_ISSUER,
-        )
-        user_id = payload.get("sub")
-        if not user_id:
-            raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Invalid token: missing sub.")
-        return user_id
-    except ExpiredSignatureError:
-        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Token has expired.")
-    except InvalidAudienceError:
-        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid token audience.")
-    except InvalidIssuerError:
-        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid token issuer.")
-    except MissingRequiredClaimError as e:
-        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail=f"Missing claim in token: {e}")
-    except InvalidTokenError as e:
-        print(f"Specific InvalidTokenError: {type(e).__name__} - {str(e)}")
-        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail=f"Invalid token: {str(e)}")
-    except Exception as e:
-        print(f"Generic token validation error: {type(e).__name__} - {str(e)}")
-        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Token validation error.")
 
+class TokenCache:
+    """
+    Bounded LRU cache of verified JWT payloads keyed by a SHA-256 digest of the token.
+    Entries never outlive the token's own exp claim, so a cached token expires exactly when it would
+    have failed verification.
+    """
 
-def get_jwt_payload(credentials: HTTPAuthorizationCredentials = Depends(security)) -> Dict[str, Any]:
+    def __init__(self, max_entries: int, max_ttl_seconds: int):
+        self.max_entries = max_entries
+        self.max_ttl_seconds = max_ttl_seconds
+        self._entries: "OrderedDict[bytes, Tuple[float, Dict[str, Any]]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _digest(token: str) -> bytes:
+        return hashlib.sha256(token.encode()).digest()
+
+    def get(self, token: str) -> Optional[Dict[str, Any]]:
+        key = self._digest(token)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= time.time():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, token: str, payload: Dict[str, Any]) -> None:
+        expires_at = time.time() + self.max_ttl_seconds
+        if isinstance(payload.get("exp"), (int, float)):
+            expires_at = min(expires_at, payload["exp"])
+        key = self._digest(token)
+        with self._lock:
+            self._entries[key] = (expires_at, payload)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "size": len(self._entries),
+            }
+
+
+token_cache = TokenCache(settings.JWT_CACHE_MAX_ENTRIES, settings.JWT_CACHE_MAX_TTL_SECONDS)
+
+
+def verify_token(token: str) -> Dict[str, Any]:
     """
-    Returns the full JWT payload
+    Returns the verified payload of token, running the RS256 check only on a cache miss.
+    The jwt_verify stage histogram includes cache hits, so its low buckets show the hit path.
+    Raises the PyJWT exception for invalid tokens.
     """
-    token = credentials.credentials
-    print(f"Received token (in get_jwt_payload): {token}")
-    try:
-        unverified_header = jwt.get_unverified_header(token)
-        print(f"Unverified header (in get_jwt_payload): {unverified_header}")
-    except Exception as e:
-        print(f"Error getting unverified header (in get_jwt_payload): {e}")
+    with metrics.JWT_VERIFY_SECONDS.time():
+        payload = token_cache.get(token)
+        if payload is None:
+            payload = jwt.decode(
+                token,
+                get_jwt_public_key(),
+                algorithms=["RS256"],
+                audience=settings.EXPECTED_JWT_AUDIENCE,
+                issuer=settings.EXPECTED_JWT_ISSUER,
+            )
+            token_cache.put(token, payload)
+        return payload
 
+
+def decode_token(token: str) -> Dict[str, Any]:
+    """Same as verify_token, but maps validation errors to HTTP 401 responses"""
     try:
-        payload = jwt.decode(
-            token,
-            settings.MAIN_SERVICE_JWT_PUBLIC_KEY,
-            algorithms=["RS256"],
-            audience=settings.EXPECTED_JWT_AUDIENCE,
-            issuer=settings.EXPECTED_JWT_ISSUER,
-        )
-        return payload
+        return verify_token(token)
     except ExpiredSignatureError:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Token has expired.")
     except InvalidAudienceError:
@@ -76,13 +114,37 @@ def get_jwt_payload(credentials: HTTPAuthorizationCredentials = Depends(security
     except MissingRequiredClaimError as e:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail=f"Missing claim in token: {e}")
     except InvalidTokenError as e:
-        print(f"Specific InvalidTokenError in get_jwt_payload: {type(e).__name__} - {str(e)}")
+        logger.debug(f"Specific InvalidTokenError: {type(e).__name__} - {str(e)}")
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail=f"Invalid token: {str(e)}")
     except Exception as e:
-        print(f"Generic token validation error in get_jwt_payload: {type(e).__name__} - {str(e)}")
+        logger.warning(f"Generic token validation error: {type(e).__name__} - {str(e)}")
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Token validation error.")
 
 
+def _request_payload(request: Request, credentials: HTTPAuthorizationCredentials) -> Dict[str, Any]:
+    # The middleware may already have verified this request's token
+    payload = getattr(request.state, "jwt_payload", None)
+    if payload is None:
+        payload = decode_token(credentials.credentials)
+        request.state.jwt_payload = payload
+    return payload
+
+
+def get_current_user_id(request: Request, credentials: HTTPAuthorizationCredentials = Depends(security)):
+    payload = _request_payload(request, credentials)
+    user_id = payload.get("sub")
+    if not user_id:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Invalid token: missing sub.")
+    return user_id
+
+
+def get_jwt_payload(request: Request, credentials: HTTPAuthorizationCredentials = Depends(security)) -> Dict[str, Any]:
+    """
+    Returns the full JWT payload
+    """
+    return _request_payload(request, credentials)
+
+
 def check_file_access(payload: Dict[str, Any], file_id: int) -> bool:
     """
     Checks if the user has access to the requested file based on the file_id in the JWT payload
@@ -100,102 +162,3 @@ def check_file_access(payload: Dict[str, Any], file_id: int) -> bool:
         
     # file_id must match exactly
     return int(allowed_file_id) == int(file_id)
-
-
-async def file_access_middleware(request: Request, call_next):
-    """
-    Middleware for checking file access based on file_id in JWT
-    """
-    # List of routes that need file access check
-    file_access_routes = [
-        r'/upload/download/(\d+)', # Download file
-        r'/upload/init',           # Start upload (file_id is in the body)
-        r'/upload/complete',       # Complete upload (file_id is in the body)
-        r'/upload/file'            # Delete file (file_id is in the body)
-    ]
-    
-    path = request.url.path
-    
-    # Checking if this route needs file access check
-    needs_file_check = False
-    file_id_from_url = None
-    
-    for route_pattern in file_access_routes:
-        match = re.match(route_pattern, path)
-        if match:
-            needs_file_check = True
-            if match.groups():  # If file_id is in the URL
-                file_id_from_url = int(match.group(1))
-            break
-    
-    if needs_file_check:
-        # Getting JWT from header
-        auth_header = request.headers.get("Authorization")
-        if not auth_header or not auth_header.startswith("Bearer "):
-            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Missing or invalid authorization header")
-        
-        token = auth_header.split(" ")[1]
-        
-        try:
-            # Decoding JWT
-            payload = jwt.decode(
-                token,
-                settings.MAIN_SERVICE_JWT_PUBLIC_KEY,
-                algorithms=["RS256"],
-                audience=settings.EXPECTED_JWT_AUDIENCE,
-                issuer=settings.EXPECTED_JWT_ISSUER,
-            )
-            
-            # Determining file_id to check
-            requested_file_id = None
-            
-            # If file_id is in the URL
-            if file_id_from_url is not None:
-                requested_file_id = file_id_from_url
-            
-            # If file_id is in the body
-            elif path in ['/upload/init', '/upload/complete', '/upload/file']:
-                # Reading body
-                body = await request.body()
-                if body:
-                    import json
-                    try:
-                        body_data = json.loads(body)
-                        # For init and complete, use main_service_file_id
-                        # For delete, use file_id
-                        if path == '/upload/file':
-                            requested_file_id = body_data.get('file_id')
-                        else:
-                            requested_file_id = body_data.get('main_service_file_id')
-                    except json.JSONDecodeError:
-                        pass
-                
-                # Rebuilding request with the same body so the endpoint can read it
-                async def receive():
-                    return {"type": "http.request", "body": body}
-                request._receive = receive
-            
-            if requested_file_id is not None:
-                if not check_file_access(payload, requested_file_id):
-                    jwt_file_id = payload.get("file_id", "unknown")
-                    raise HTTPException(
-                        status_code=status.HTTP_403_FORBIDDEN,
-                        detail=f"Access denied. JWT is for file {jwt_file_id}, but you requested file {requested_file_id}."
-                    )
-            else:
-                # If we couldn't find file_id, be cautious
-                raise HTTPException(
-                    status_code=status.HTTP_400_BAD_REQUEST,
-                    detail="Could not determine file_id from request."
-                )
-            
-            # Adding JWT payload to request so endpoints can use it
-            request.state.jwt_payload = payload
-            
-        except InvalidTokenError:
-            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid token")
-        except Exception as e:
-            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Token validation error")
-    
-    response = await call_next(request)
-    return response 
\ No newline at end of file
@@ -1,2 +1,411 @@
 # app/core/session.py
-session_map = {} 
\ No newline at end of file
+import json
+import os
+import asyncio
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from typing import Callable, Dict, List, Optional, Tuple
+from app.core.config import settings
+
+# Redis key suffix of a session's chunk hash
+CHUNKS_SUFFIX = ":chunks"
+
+
+class SessionStore(ABC):
+    """
+    Storage for upload sessions, keyed by upload session id (the file_id as a string).
+    Sessions are plain JSON-serialisable dicts and expire SESSION_TTL_SECONDS after their last write.
+    Received chunks are kept beside the session, one entry per chunk (see record_chunks), so a chunk
+    write doesn't rewrite everything received before it.
+
+    The plain methods block: SQLite may wait for the write lock and Redis does a network round trip
+    per call (several when a transaction is retried). Code on the event loop uses the a-prefixed
+    variants, which run them on a worker thread; the plain ones are for code already on one.
+    """
+    # False for stores that never wait on anything, whose async variants then run inline
+    blocking = True
+
+    def __init__(self, ttl_seconds: Optional[int] = None):
+        self.ttl_seconds = ttl_seconds if ttl_seconds is not None else settings.SESSION_TTL_SECONDS
+
+    @abstractmethod
+    def get(self, session_id: str) -> Optional[dict]:
+        pass
+
+    @abstractmethod
+    def set(self, session_id: str, session: dict) -> None:
+        pass
+
+    @abstractmethod
+    def mutate(self, session_id: str, fn: Callable[[dict], None]) -> Optional[dict]:
+        """
+        Applies fn to an existing session in place, atomically with respect to other writers, and refreshes
+        its TTL; returns the new session or None if it does not exist. fn may run more than once.
+        """
+        pass
+
+    def update(self, session_id: str, **fields) -> Optional[dict]:
+        """Merges fields into an existing session and refreshes its TTL; returns None if it does not exist"""
+        return self.mutate(session_id, lambda session: session.update(fields))
+
+    @abstractmethod
+    def touch(self, session_id: str) -> None:
+        """Refreshes the TTL of a session without changing it"""
+        pass
+
+    @abstractmethod
+    def record_chunks(self, session_id: str, chunks: List[Tuple[int, int, Optional[str]]]) -> bool:
+        """
+        Records (chunk_index, size, digest) entries for an existing session, replacing earlier ones for
+        the same index, and refreshes its TTL; returns False if the session does not exist.
+        """
+        pass
+
+    @abstractmethod
+    def chunks(self, session_id: str) -> Dict[int, Tuple[int, Optional[str]]]:
+        """The session's recorded chunks as chunk_index -> (size, digest); empty if it does not exist"""
+        pass
+
+    @abstractmethod
+    def delete(self, session_id: str) -> None:
+        pass
+
+    @abstractmethod
+    def count(self) -> int:
+        """Number of live sessions; meant for monitoring, not for the request path"""
+        pass
+
+    async def _run(self, fn: Callable, *args, **kwargs):
+        if not self.blocking:
+            return fn(*args, **kwargs)
+        return await asyncio.to_thread(fn, *args, **kwargs)
+
+    async def aget(self, session_id: str) -> Optional[dict]:
+        return await self._run(self.get, session_id)
+
+    async def aset(self, session_id: str, session: dict) -> None:
+        await self._run(self.set, session_id, session)
+
+    async def amutate(self, session_id: str, fn: Callable[[dict], None]) -> Optional[dict]:
+        return await self._run(self.mutate, session_id, fn)
+
+    async def aupdate(self, session_id: str, **fields) -> Optional[dict]:
+        return await self._run(self.update, session_id, **fields)
+
+    async def atouch(self, session_id: str) -> None:
+        await self._run(self.touch, session_id)
+
+    async def adelete(self, session_id: str) -> None:
+        await self._run(self.delete, session_id)
+
+    async def arecord_chunks(self, session_id: str, chunks: List[Tuple[int, int, Optional[str]]]) -> bool:
+        return await self._run(self.record_chunks, session_id, chunks)
+
+    async def achunks(self, session_id: str) -> Dict[int, Tuple[int, Optional[str]]]:
+        return await self._run(self.chunks, session_id)
+
+
+class MemorySessionStore(SessionStore):
+    """Process-local store; only valid when the service runs as a single worker"""
+    blocking = False
+
+    def __init__(self, ttl_seconds: Optional[int] = None):
+        super().__init__(ttl_seconds)
+        self._sessions = {}
+        self._chunks = {}
+        self._lock = threading.Lock()
+
+    def _get_entry(self, session_id: str):
+        entry = self._sessions.get(session_id)
+        if entry is None:
+            return None
+        if entry[0] < time.time():
+            self._sessions.pop(session_id, None)
+            self._chunks.pop(session_id, None)
+            return None
+        return entry
+
+    def get(self, session_id: str) -> Optional[dict]:
+        with self._lock:
+            entry = self._get_entry(session_id)
+            return dict(entry[1]) if entry else None
+
+    def set(self, session_id: str, session: dict) -> None:
+        with self._lock:
+            self._sessions[session_id] = (time.time() + self.ttl_seconds, dict(session))
+            self._chunks[session_id] = {}
+
+    def mutate(self, session_id: str, fn: Callable[[dict], None]) -> Optional[dict]:
+        with self._lock:
+            entry = self._get_entry(session_id)
+            if entry is None:
+                return None
+            session = json.loads(json.dumps(entry[1]))
+            fn(session)
+            self._sessions[session_id] = (time.time() + self.ttl_seconds, session)
+            return dict(session)
+
+    def touch(self, session_id: str) -> None:
+        with self._lock:
+            entry = self._get_entry(session_id)
+            if entry is not None:
+                self._sessions[session_id] = (time.time() + self.ttl_seconds, entry[1])
+
+    def record_chunks(self, session_id: str, chunks: List[Tuple[int, int, Optional[str]]]) -> bool:
+        with self._lock:
+            entry = self._get_entry(session_id)
+            if entry is None:
+                return False
+            recorded = self._chunks.setdefault(session_id, {})
+            for chunk_index, size, digest in chunks:
+                recorded[chunk_index] = (size, digest)
+            self._sessions[session_id] = (time.time() + self.ttl_seconds, entry[1])
+            return True
+
+    def chunks(self, session_id: str) -> Dict[int, Tuple[int, Optional[str]]]:
+        with self._lock:
+            if self._get_entry(session_id) is None:
+                return {}
+            return dict(self._chunks.get(session_id, {}))
+
+    def delete(self, session_id: str) -> None:
+        with self._lock:
+            self._sessions.pop(session_id, None)
+            self._chunks.pop(session_id, None)
+
+    def count(self) -> int:
+        now = time.time()
+        with self._lock:
+            return sum(1 for expires_at, _ in self._sessions.values() if expires_at >= now)
+
+
+class SQLiteSessionStore(SessionStore):
+    """Store shared by all worker processes on one host, backed by a SQLite database in WAL mode"""
+
+    def __init__(self, path: Optional[str] = None, ttl_seconds: Optional[int] = None):
+        super().__init__(ttl_seconds)
+        self.path = path or settings.SESSION_STORE_SQLITE_PATH
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._local = threading.local()
+        with self._connection() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS upload_sessions ("
+                "session_id TEXT PRIMARY KEY, data TEXT NOT NULL, expires_at REAL NOT NULL)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS upload_chunks ("
+                "session_id TEXT NOT NULL, chunk_index INTEGER NOT NULL, size INTEGER NOT NULL, digest TEXT, "
+                "PRIMARY KEY (session_id, chunk_index)) WITHOUT ROWID"
+            )
+
+    def _connection(self) -> sqlite3.Connection:
+        # sqlite3 connections must not be shared across threads, so each thread keeps its own
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, session_id: str) -> Optional[dict]:
+        row = self._connection().execute(
+            "SELECT data FROM upload_sessions WHERE session_id = ? AND expires_at >= ?",
+            (session_id, time.time())
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set(self, session_id: str, session: dict) -> None:
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute(
+                "INSERT OR REPLACE INTO upload_sessions (session_id, data, expires_at) VALUES (?, ?, ?)",
+                (session_id, json.dumps(session), time.time() + self.ttl_seconds)
+            )
+            # Chunks left behind by an expired session with the same id
+            conn.execute("DELETE FROM upload_chunks WHERE session_id = ?", (session_id,))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def mutate(self, session_id: str, fn: Callable[[dict], None]) -> Optional[dict]:
+        conn = self._connection()
+        # BEGIN IMMEDIATE takes the write lock up front so concurrent updates cannot interleave
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT data FROM upload_sessions WHERE session_id = ? AND expires_at >= ?",
+                (session_id, time.time())
+            ).fetchone()
+            if row is None:
+                conn.execute("COMMIT")
+                return None
+            session = json.loads(row[0])
+            fn(session)
+            conn.execute(
+                "UPDATE upload_sessions SET data = ?, expires_at = ? WHERE session_id = ?",
+                (json.dumps(session), time.time() + self.ttl_seconds, session_id)
+            )
+            conn.execute("COMMIT")
+            return session
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def touch(self, session_id: str) -> None:
+        self._connection().execute(
+            "UPDATE upload_sessions SET expires_at = ? WHERE session_id = ? AND expires_at >= ?",
+            (time.time() + self.ttl_seconds, session_id, time.time())
+        )
+
+    def record_chunks(self, session_id: str, chunks: List[Tuple[int, int, Optional[str]]]) -> bool:
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            now = time.time()
+            exists = conn.execute(
+                "UPDATE upload_sessions SET expires_at = ? WHERE session_id = ? AND expires_at >= ?",
+                (now + self.ttl_seconds, session_id, now)
+            ).rowcount
+            if exists:
+                conn.executemany(
+                    "INSERT OR REPLACE INTO upload_chunks (session_id, chunk_index, size, digest) VALUES (?, ?, ?, ?)",
+                    [(session_id, chunk_index, size, digest) for chunk_index, size, digest in chunks]
+                )
+            conn.execute("COMMIT")
+            return bool(exists)
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def chunks(self, session_id: str) -> Dict[int, Tuple[int, Optional[str]]]:
+        rows = self._connection().execute(
+            "SELECT c.chunk_index, c.size, c.digest FROM upload_chunks c JOIN upload_sessions s USING (session_id) "
+            "WHERE c.session_id = ? AND s.expires_at >= ?",
+            (session_id, time.time())
+        ).fetchall()
+        return {chunk_index: (size, digest) for chunk_index, size, digest in rows}
+
+    def delete(self, session_id: str) -> None:
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("DELETE FROM upload_sessions WHERE session_id = ?", (session_id,))
+            conn.execute("DELETE FROM upload_chunks WHERE session_id = ?", (session_id,))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def count(self) -> int:
+        return self._connection().execute(
+            "SELECT COUNT(*) FROM upload_sessions WHERE expires_at >= ?", (time.time(),)
+        ).fetchone()[0]
+
+
+class RedisSessionStore(SessionStore):
+    """
+    Store shared across hosts; works with Redis and any server speaking its protocol.
+    A session's chunks live in a hash next to it (one field per chunk) that shares its TTL.
+    """
+
+    def __init__(self, client=None, url: Optional[str] = None, ttl_seconds: Optional[int] = None):
+        super().__init__(ttl_seconds)
+        if client is None:
+            import redis
+            client = redis.Redis.from_url(url or settings.SESSION_STORE_REDIS_URL)
+        self.client = client
+        self.prefix = settings.SESSION_STORE_KEY_PREFIX
+
+    def _key(self, session_id: str) -> str:
+        return f"{self.prefix}{session_id}"
+
+    def _chunks_key(self, session_id: str) -> str:
+        return f"{self.prefix}{session_id}{CHUNKS_SUFFIX}"
+
+    def get(self, session_id: str) -> Optional[dict]:
+        data = self.client.get(self._key(session_id))
+        return json.loads(data) if data else None
+
+    def set(self, session_id: str, session: dict) -> None:
+        with self.client.pipeline() as pipe:
+            pipe.set(self._key(session_id), json.dumps(session), ex=self.ttl_seconds)
+            pipe.delete(self._chunks_key(session_id))
+            pipe.execute()
+
+    def mutate(self, session_id: str, fn: Callable[[dict], None]) -> Optional[dict]:
+        import redis
+        key = self._key(session_id)
+        with self.client.pipeline() as pipe:
+            while True:
+                try:
+                    # Optimistic transaction: retried if another worker changes the key meanwhile
+                    pipe.watch(key)
+                    data = pipe.get(key)
+                    if not data:
+                        pipe.unwatch()
+                        return None
+                    session = json.loads(data)
+                    fn(session)
+                    pipe.multi()
+                    pipe.set(key, json.dumps(session), ex=self.ttl_seconds)
+                    pipe.expire(self._chunks_key(session_id), self.ttl_seconds)
+                    pipe.execute()
+                    return session
+                except redis.WatchError:
+                    continue
+
+    def touch(self, session_id: str) -> None:
+        with self.client.pipeline() as pipe:
+            pipe.expire(self._key(session_id), self.ttl_seconds)
+            pipe.expire(self._chunks_key(session_id), self.ttl_seconds)
+            pipe.execute()
+
+    def record_chunks(self, session_id: str, chunks: List[Tuple[int, int, Optional[str]]]) -> bool:
+        chunks_key = self._chunks_key(session_id)
+        with self.client.pipeline() as pipe:
+            # No WATCH: each chunk is its own field, so concurrent writers don't conflict
+            pipe.expire(self._key(session_id), self.ttl_seconds)
+            if chunks:
+                pipe.hset(chunks_key, mapping={
+                    str(chunk_index): json.dumps([size, digest]) for chunk_index, size, digest in chunks
+                })
+            pipe.expire(chunks_key, self.ttl_seconds)
+            exists = pipe.execute()[0]
+        if not exists:
+            self.client.delete(chunks_key)
+        return bool(exists)
+
+    def chunks(self, session_id: str) -> Dict[int, Tuple[int, Optional[str]]]:
+        fields = self.client.hgetall(self._chunks_key(session_id))
+        return {int(chunk_index): tuple(json.loads(value)) for chunk_index, value in fields.items()}
+
+    def delete(self, session_id: str) -> None:
+        self.client.delete(self._key(session_id), self._chunks_key(session_id))
+
+    def count(self) -> int:
+        # SCAN walks the keyspace in batches without blocking the server like KEYS would
+        suffix = CHUNKS_SUFFIX.encode()
+        return sum(
+            1 for key in self.client.scan_iter(match=f"{self.prefix}*", count=1000)
+            if not (key if isinstance(key, bytes) else key.encode()).endswith(suffix)
+        )
+
+
+def get_session_store() -> SessionStore:
+    if settings.SESSION_STORE_BACKEND == "memory":
+        return MemorySessionStore()
+    if settings.SESSION_STORE_BACKEND == "sqlite":
+        return SQLiteSessionStore()
+    if settings.SESSION_STORE_BACKEND == "redis":
+        return RedisSessionStore()
+    raise ValueError(f"Unknown SESSION_STORE_BACKEND: {settings.SESSION_STORE_BACKEND}")
+
+
+session_store = get_session_store()
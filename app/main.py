@@ -1,9 +1,25 @@
+import shutil
+import asyncio
 import logging
-from fastapi import FastAPI, Request, Response
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, Response
 from app.api.endpoints.files import router as files_router
+from app.api.endpoints.tus import router as tus_router
 from app.core.config import settings
-from app.core.security import file_access_middleware
-from fastapi.middleware.cors import CORSMiddleware
+from app.core import metrics
+from app.core.session import session_store
+from app.core.middleware import UploadGatewayMiddleware, AdmissionMiddleware
+from app.core.security import get_jwt_public_key, token_cache
+from app.services.storage.s3_client import s3_pool_stats
+from app.services.storage import scheduler
+from app.services.storage.scheduler import IOSaturatedError
+from app.services.storage.handles import handles
+from app.services.storage import durability
+from app.services.file_service import file_service
+from app.services.janitor import Janitor
+from app.services.finalize_queue import finalize_queue
+from starlette.formparsers import MultiPartParser
 
 # تنظیم logging
 logging.basicConfig(
@@ -12,39 +28,103 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Chunk parts roll over to a temp file past this size, so in-flight chunks don't pile up in RAM
+MultiPartParser.spool_max_size = settings.CHUNK_SPOOL_MAX_SIZE
+
+janitor = Janitor(file_service.storage)
+
+
+def _scratch_disk(field: str):
+    return lambda: getattr(shutil.disk_usage(settings.LOCAL_TEMP_CHUNK_PATH), field)
+
+
+metrics.Gauge("hayula_active_sessions", "Upload sessions in the session store", session_store.count)
+metrics.Gauge(
+    "hayula_io_queue_depth", "Jobs waiting for a worker thread, per I/O pool",
+    lambda: {pool.name: pool.queued for pool in scheduler.POOLS}, label="pool"
+)
+metrics.Gauge(
+    "hayula_io_running", "Jobs running on a worker thread, per I/O pool",
+    lambda: {pool.name: pool.running for pool in scheduler.POOLS}, label="pool"
+)
+metrics.Gauge("hayula_inflight_bytes", "Upload body bytes admitted and not yet answered", lambda: scheduler.inflight_bytes.in_flight)
+metrics.Gauge("hayula_cached_fds", "Session directory and partial file descriptors held open", lambda: handles.stats()["open"])
+metrics.Gauge("hayula_finalize_queue_depth", "Finalize jobs waiting for a worker", lambda: finalize_queue.stats()["queued"])
+if file_service.download_cache is not None:
+    metrics.Gauge("hayula_download_cache_bytes", "Bytes held by the S3 download cache", lambda: file_service.download_cache.bytes)
+metrics.Gauge("hayula_scratch_disk_used_bytes", "Used space on the scratch filesystem (LOCAL_TEMP_CHUNK_PATH)", _scratch_disk("used"))
+metrics.Gauge("hayula_scratch_disk_total_bytes", "Size of the scratch filesystem (LOCAL_TEMP_CHUNK_PATH)", _scratch_disk("total"))
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if settings.JANITOR_ENABLED:
+        janitor.start()
+    if settings.FINALIZE_MODE == "async":
+        finalize_queue.start()
+    yield
+    await finalize_queue.stop()
+    await janitor.stop()
+
+
 app = FastAPI(
     title="Hayula Upload Service",
+    lifespan=lifespan,
     version="1.0.0",
     openapi_url=None if settings.ENV == "production" else f"/openapi.json",
     docs_url=None if settings.ENV == "production" else f"/docs",
     redoc_url=None if settings.ENV == "production" else f"/redoc"
 )
 
-# CORS Debug Middleware
-@app.middleware("http")
-async def cors_debug_middleware(request: Request, call_next):
-    origin = request.headers.get("origin")
-    if origin:
-        logging.info(f"Request from origin: {origin}")
-    
-    response = await call_next(request)
-    
-    # اضافه کردن CORS headers به صورت manual
-    if origin:
-        response.headers["Access-Control-Allow-Origin"] = origin
-        response.headers["Access-Control-Allow-Credentials"] = "true"
-        response.headers["Access-Control-Allow-Methods"] = "GET, POST, PUT, DELETE, PATCH, OPTIONS"
-        response.headers["Access-Control-Allow-Headers"] = "Accept, Accept-Language, Content-Language, Content-Type, Authorization, X-Requested-With, Origin, Access-Control-Request-Method, Access-Control-Request-Headers, Content-Range, X-File-Name, X-File-Size, X-Chunk-Index"
-        response.headers["Access-Control-Expose-Headers"] = "Content-Length, Content-Range, Accept-Ranges"
-    
-    return response
-
-# Adding middleware for file access check
-app.middleware("http")(file_access_middleware)
-
-# Adding CORS middleware
+# Parse the JWT public key once at startup so a bad key fails fast instead of on every request
+get_jwt_public_key()
+
+
+@app.get("/health")
+async def health():
+    health_status = {
+        "status": "ok",
+        "jwt_cache": token_cache.stats(),
+        "janitor": janitor.stats(),
+        "io": scheduler.stats(),
+        "fd_cache": handles.stats(),
+        "durability": durability.stats(),
+    }
+    if settings.FINALIZE_MODE == "async":
+        health_status["finalize"] = finalize_queue.stats()
+    if settings.STORAGE_BACKEND == "s3":
+        health_status["s3_pool"] = s3_pool_stats.stats()
+        health_status["download_cache"] = file_service.download_cache.stats()
+    return health_status
+
+
+@app.get("/metrics", include_in_schema=False)
+async def prometheus_metrics():
+    # Gauges may hit the session store or the filesystem, so they are read off the event loop
+    body = await asyncio.to_thread(metrics.render)
+    return Response(content=body, media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+@app.exception_handler(IOSaturatedError)
+async def io_saturated_handler(request: Request, exc: IOSaturatedError):
+    return JSONResponse(
+        status_code=503,
+        content={"detail": f"{exc}, retry later."},
+        headers={"Retry-After": str(exc.retry_after)}
+    )
+
+
+# Upload bodies are refused before they are read while the I/O scheduler is saturated
 app.add_middleware(
-    CORSMiddleware,
+    AdmissionMiddleware,
+    inflight_bytes=scheduler.inflight_bytes,
+    write_pool=file_service.storage.chunk_write_pool,
+    retry_after=settings.IO_RETRY_AFTER_SECONDS,
+)
+
+# CORS and file access checks run in a single pure ASGI layer that never buffers upload bodies
+app.add_middleware(
+    UploadGatewayMiddleware,
     allow_origins=[
         "https://dev-upload.hyul.ir",
         "https://upload.hyul.ir", 
@@ -52,18 +132,35 @@ app.add_middleware(
         "https://hayula.monster",
         "*"  # fallback
     ],
-    allow_credentials=True,
-    allow_methods=["*"],
+    allow_methods=["GET", "HEAD", "POST", "PUT", "DELETE", "PATCH", "OPTIONS"],
     allow_headers=[
         "Accept",
+        "Accept-Language",
+        "Content-Language",
         "Content-Type",
-        "Origin",
         "Authorization",
-        "Content-Range",
         "X-Requested-With",
+        "Origin",
         "Access-Control-Request-Method",
-        "Access-Control-Request-Headers"
+        "Access-Control-Request-Headers",
+        "Content-Range",
+        "X-File-Name",
+        "X-File-Size",
+        "X-Chunk-Index",
+        "Upload-Checksum",
+        "Tus-Resumable",
+        "Upload-Length",
+        "Upload-Offset",
+        "Upload-Metadata",
+        "Upload-Concat",
+        "Upload-Defer-Length"
+    ],
+    expose_headers=[
+        "Content-Length", "Content-Range", "Accept-Ranges", "ETag",
+        "Location", "Retry-After", "Tus-Resumable", "Tus-Version", "Tus-Extension", "Tus-Checksum-Algorithm",
+        "Upload-Offset", "Upload-Length", "Upload-Concat"
     ],
 )
 
-app.include_router(files_router, prefix="/files", tags=["files"]) 
\ No newline at end of file
+app.include_router(files_router, prefix="/files", tags=["files"])
+app.include_router(tus_router, prefix="/tus", tags=["tus"]) 
\ No newline at end of file
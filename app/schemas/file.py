@@ -1,11 +1,22 @@
 from pydantic import BaseModel
+from typing import List, Optional
 
 class InitSessionRequest(BaseModel):
     file_id: int
     original_file_name: str
+    file_size: Optional[int] = None
+    # Size of every chunk but the last; lets chunk PUTs send only Content-Range
+    chunk_size: Optional[int] = None
+
+class PresignedPart(BaseModel):
+    chunk_index: int
+    url: str
 
 class InitSessionResponseData(BaseModel):
     file_id: int
+    # Only in S3 presigned mode: the chunk size to use and upload URLs for the first chunks
+    part_size: Optional[int] = None
+    upload_parts: Optional[List[PresignedPart]] = None
 
 class InitSessionResponse(BaseModel):
     status: str = "success"
@@ -16,9 +27,24 @@ class ChunkUploadResponse(BaseModel):
     status: str = "success"
     message: str = "Chunk uploaded successfully."
 
+class ChunkBatchResult(BaseModel):
+    chunk_index: int
+    status: str  # stored, checksum_mismatch or failed
+    detail: Optional[str] = None
+
+class ChunkBatchResponse(BaseModel):
+    status: str = "success"  # 'partial' when any chunk was not stored
+    data: List[ChunkBatchResult]
+
+class CompletedPart(BaseModel):
+    chunk_index: int
+    etag: str
+
 class CompleteSessionRequest(BaseModel):
     total_chunks: int
     main_service_file_id: int
+    # ETags S3 returned for directly uploaded parts (presigned mode); checked against what S3 holds
+    parts: Optional[List[CompletedPart]] = None
 
 class CompleteSessionResponseData(BaseModel):
     file_download_url: str
@@ -26,4 +52,35 @@ class CompleteSessionResponseData(BaseModel):
 class CompleteSessionResponse(BaseModel):
     status: str = "success"
     message: str = "File upload completed and main service notified."
-    data: CompleteSessionResponseData 
\ No newline at end of file
+    data: CompleteSessionResponseData 
+class UploadStatusResponseData(BaseModel):
+    file_id: int
+    file_size: Optional[int] = None
+    received_chunks: List[int]
+    received_count: int
+    received_bytes: int
+    chunk_bitmap: str
+
+class FinalizeStatusData(BaseModel):
+    file_id: int
+    state: str  # queued, merging, uploading, completed or failed
+    attempts: Optional[int] = None
+    total_bytes: Optional[int] = None
+    bytes_merged: Optional[int] = None
+    bytes_uploaded: Optional[int] = None
+    file_download_url: Optional[str] = None
+    error: Optional[str] = None
+    status_url: Optional[str] = None
+
+class FinalizeStatusResponse(BaseModel):
+    status: str = "success"
+    message: Optional[str] = None
+    data: FinalizeStatusData
+
+class PresignedPartsResponse(BaseModel):
+    status: str = "success"
+    data: List[PresignedPart]
+
+class UploadStatusResponse(BaseModel):
+    status: str = "success"
+    data: UploadStatusResponseData
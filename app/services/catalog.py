@@ -0,0 +1,249 @@
+"""
+Catalog of completed files: one record per (user_id, file_id) with its storage key, size,
+checksum and timestamps. Listing, download and delete lookups go through the catalog instead of
+walking directories or listing S3 prefixes.
+
+Rebuild it from what is actually in storage with:
+
+    python -m app.services.catalog rebuild
+"""
+import os
+import sys
+import time
+import asyncio
+import sqlite3
+import logging
+import threading
+from abc import ABC, abstractmethod
+from typing import Iterable, List, Optional
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+RECORD_FIELDS = ("user_id", "file_id", "storage_key", "file_name", "size", "checksum", "created_at", "updated_at")
+
+
+class FileCatalog(ABC):
+    """
+    The plain methods block on the database; code on the event loop uses the a-prefixed variants,
+    which run them on a worker thread.
+    """
+
+    @abstractmethod
+    def add(self, record: dict) -> None:
+        """Inserts or replaces the record for (record['user_id'], record['file_id'])"""
+        pass
+
+    @abstractmethod
+    def get(self, user_id: str, file_id) -> Optional[dict]:
+        pass
+
+    @abstractmethod
+    def list_user_files(self, user_id: str) -> List[dict]:
+        pass
+
+    @abstractmethod
+    def delete(self, user_id: str, file_id) -> Optional[dict]:
+        """Removes a record and returns it, or None if there was none"""
+        pass
+
+    @abstractmethod
+    def replace_all(self, records: Iterable[dict]) -> int:
+        """
+        Atomically replaces the whole catalog; used by rebuild. A record without a checksum whose
+        storage key and size match the current one keeps the checksum (and created_at) recorded at upload.
+        """
+        pass
+
+    async def aadd(self, record: dict) -> None:
+        await asyncio.to_thread(self.add, record)
+
+    async def aget(self, user_id: str, file_id) -> Optional[dict]:
+        return await asyncio.to_thread(self.get, user_id, file_id)
+
+    async def alist_user_files(self, user_id: str) -> List[dict]:
+        return await asyncio.to_thread(self.list_user_files, user_id)
+
+    async def adelete(self, user_id: str, file_id) -> Optional[dict]:
+        return await asyncio.to_thread(self.delete, user_id, file_id)
+
+
+class SQLiteFileCatalog(FileCatalog):
+    def __init__(self, path: Optional[str] = None):
+        self.path = path or settings.CATALOG_SQLITE_PATH or os.path.join(settings.PERSISTENT_LOCAL_STORAGE_PATH, "catalog.db")
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._local = threading.local()
+        self._connection().execute(
+            "CREATE TABLE IF NOT EXISTS files ("
+            "user_id TEXT NOT NULL, file_id TEXT NOT NULL, storage_key TEXT NOT NULL, file_name TEXT NOT NULL, "
+            "size INTEGER, checksum TEXT, created_at REAL NOT NULL, updated_at REAL NOT NULL, "
+            "PRIMARY KEY (user_id, file_id))"
+        )
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    @staticmethod
+    def _row(record: dict) -> tuple:
+        now = time.time()
+        return (
+            record["user_id"],
+            str(record["file_id"]),
+            record["storage_key"],
+            record["file_name"],
+            record.get("size"),
+            record.get("checksum"),
+            record.get("created_at") or now,
+            record.get("updated_at") or now,
+        )
+
+    def add(self, record: dict) -> None:
+        self._connection().execute(
+            f"INSERT OR REPLACE INTO files ({', '.join(RECORD_FIELDS)}) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            self._row(record)
+        )
+
+    def get(self, user_id: str, file_id) -> Optional[dict]:
+        row = self._connection().execute(
+            "SELECT * FROM files WHERE user_id = ? AND file_id = ?", (user_id, str(file_id))
+        ).fetchone()
+        return dict(row) if row else None
+
+    def list_user_files(self, user_id: str) -> List[dict]:
+        rows = self._connection().execute(
+            "SELECT * FROM files WHERE user_id = ? ORDER BY created_at", (user_id,)
+        ).fetchall()
+        return [dict(row) for row in rows]
+
+    def delete(self, user_id: str, file_id) -> Optional[dict]:
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT * FROM files WHERE user_id = ? AND file_id = ?", (user_id, str(file_id))
+            ).fetchone()
+            if row is not None:
+                conn.execute("DELETE FROM files WHERE user_id = ? AND file_id = ?", (user_id, str(file_id)))
+            conn.execute("COMMIT")
+            return dict(row) if row else None
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def replace_all(self, records: Iterable[dict]) -> int:
+        conn = self._connection()
+        fields = ", ".join(RECORD_FIELDS)
+        # records is usually a live bucket listing or tree walk; it is loaded into a connection-private
+        # temp table first, so the write lock that blocks completions and deletes is only held for the swap
+        conn.execute("CREATE TEMP TABLE IF NOT EXISTS rebuild AS SELECT * FROM main.files WHERE 0")
+        conn.execute("BEGIN")
+        try:
+            conn.execute("DELETE FROM temp.rebuild")
+            conn.executemany(
+                f"INSERT OR REPLACE INTO temp.rebuild ({fields}) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (self._row(record) for record in records)
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        count = conn.execute("SELECT COUNT(*) FROM temp.rebuild").fetchone()[0]
+
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # Storage doesn't know the checksum recorded at upload time (the file's ETag), so an
+            # unchanged file keeps its own, and its original creation time
+            conn.execute(
+                "UPDATE temp.rebuild SET (checksum, created_at) = ("
+                "SELECT f.checksum, f.created_at FROM main.files f WHERE f.user_id = rebuild.user_id "
+                "AND f.file_id = rebuild.file_id AND f.storage_key = rebuild.storage_key AND f.size IS rebuild.size) "
+                "WHERE checksum IS NULL AND EXISTS (SELECT 1 FROM main.files f WHERE f.user_id = rebuild.user_id "
+                "AND f.file_id = rebuild.file_id AND f.storage_key = rebuild.storage_key AND f.size IS rebuild.size)"
+            )
+            conn.execute("DELETE FROM main.files")
+            conn.execute(f"INSERT OR REPLACE INTO main.files ({fields}) SELECT {fields} FROM temp.rebuild")
+            conn.execute("DELETE FROM temp.rebuild")
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return count
+
+
+def get_catalog() -> FileCatalog:
+    if settings.CATALOG_BACKEND == "sqlite":
+        return SQLiteFileCatalog()
+    raise ValueError(f"Unknown CATALOG_BACKEND: {settings.CATALOG_BACKEND}")
+
+
+def _scan_local_files():
+    from app.services.storage import layout
+    # Both the flat final/ tree and, when sharding is on, the sharded one
+    for final_root, depth in layout.final_roots():
+        for user_entry in layout.scan(final_root, depth):
+            if not user_entry.is_dir():
+                continue
+            for file_entry in os.scandir(user_entry.path):
+                if not file_entry.is_dir():
+                    continue
+                for entry in os.scandir(file_entry.path):
+                    if entry.is_file():
+                        stat_result = entry.stat()
+                        yield {
+                            "user_id": user_entry.name,
+                            "file_id": file_entry.name,
+                            "storage_key": os.path.relpath(entry.path, settings.PERSISTENT_LOCAL_STORAGE_PATH),
+                            "file_name": entry.name,
+                            "size": stat_result.st_size,
+                            "created_at": stat_result.st_mtime,
+                            "updated_at": stat_result.st_mtime,
+                        }
+                        break
+
+
+def _scan_s3_files(s3_client):
+    paginator = s3_client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=settings.S3_BUCKET_NAME):
+        for obj in page.get("Contents", []):
+            parts = obj["Key"].split("/", 2)
+            if len(parts) != 3:
+                continue
+            modified = obj["LastModified"].timestamp()
+            yield {
+                "user_id": parts[0],
+                "file_id": parts[1],
+                "storage_key": obj["Key"],
+                "file_name": parts[2],
+                "size": obj["Size"],
+                "created_at": modified,
+                "updated_at": modified,
+            }
+
+
+def rebuild_catalog(catalog: FileCatalog) -> int:
+    """Regenerates the catalog from the files that actually exist in the active storage backend"""
+    if settings.STORAGE_BACKEND == "s3":
+        from app.services.storage.s3_client import get_s3_client
+        records = _scan_s3_files(get_s3_client())
+    else:
+        records = _scan_local_files()
+    count = catalog.replace_all(records)
+    logger.info(f"Catalog rebuilt from {settings.STORAGE_BACKEND} storage: {count} files")
+    return count
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    if sys.argv[1:] != ["rebuild"]:
+        print("usage: python -m app.services.catalog rebuild", file=sys.stderr)
+        sys.exit(2)
+    rebuild_catalog(get_catalog())
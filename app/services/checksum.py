@@ -0,0 +1,112 @@
+"""
+Chunk and file checksums computed while data streams through the service.
+
+Per-chunk digests are base64 encoded, the same encoding S3 uses for Content-MD5 and
+x-amz-checksum-* headers. The whole-file checksum is a digest of the chunk digests in order,
+suffixed with the chunk count, like an S3 multipart ETag: it is built from what was hashed on
+the way in, so the merged file never has to be read again. With md5 and S3 multipart mode it
+equals the object's S3 ETag.
+"""
+import base64
+import hashlib
+import binascii
+from typing import BinaryIO, Dict, Iterable, Optional, Sequence, Tuple
+from app.core.config import settings
+
+ALGORITHMS = ("md5", "sha256", "crc32c", "sha1")
+
+
+class ChecksumMismatchError(ValueError):
+    pass
+
+
+class _Crc32c:
+    def __init__(self):
+        # Optional dependency, only needed when CHECKSUM_ALGORITHM is 'crc32c'
+        import google_crc32c
+        self._checksum = google_crc32c.Checksum()
+
+    def update(self, data) -> None:
+        self._checksum.update(bytes(data))
+
+    def digest(self) -> bytes:
+        return self._checksum.digest()
+
+
+def new_hasher(algorithm: str):
+    if algorithm == "crc32c":
+        return _Crc32c()
+    if algorithm in ("md5", "sha256", "sha1"):
+        return hashlib.new(algorithm)
+    raise ValueError(f"Unsupported checksum algorithm: {algorithm}")
+
+
+def enabled() -> bool:
+    return settings.CHECKSUM_ALGORITHM != "none"
+
+
+def _encode(hashers: dict) -> Dict[str, str]:
+    return {algorithm: base64.b64encode(hasher.digest()).decode() for algorithm, hasher in hashers.items()}
+
+
+class HashingReader:
+    """Read-only file wrapper that hashes everything read through it with one or more algorithms"""
+
+    def __init__(self, raw: BinaryIO, algorithms: Sequence[str]):
+        self._raw = raw
+        self._hashers = {algorithm: new_hasher(algorithm) for algorithm in algorithms}
+        self.size = 0
+
+    def read(self, size: int = -1) -> bytes:
+        data = self._raw.read(size)
+        for hasher in self._hashers.values():
+            hasher.update(data)
+        self.size += len(data)
+        return data
+
+    def digests(self) -> Dict[str, str]:
+        return _encode(self._hashers)
+
+
+def digest_file(fileobj: BinaryIO, algorithms: Sequence[str]) -> Dict[str, str]:
+    """Hashes a seekable file from the start and rewinds it, for callers that need the digest before sending"""
+    hashers = {algorithm: new_hasher(algorithm) for algorithm in algorithms}
+    fileobj.seek(0)
+    while True:
+        block = fileobj.read(settings.CHUNK_IO_BUFFER_SIZE)
+        if not block:
+            break
+        for hasher in hashers.values():
+            hasher.update(block)
+    fileobj.seek(0)
+    return _encode(hashers)
+
+
+def parse_checksum_header(value: str) -> Tuple[str, str]:
+    """Parses '<algorithm> <base64 digest>' (the tus Upload-Checksum format)"""
+    parts = value.strip().split(" ")
+    if len(parts) != 2 or not parts[0] or not parts[1]:
+        raise ValueError("Checksum header must be '<algorithm> <base64 digest>'")
+    algorithm, digest = parts[0].lower(), parts[1]
+    try:
+        base64.b64decode(digest, validate=True)
+    except binascii.Error:
+        raise ValueError("Checksum digest is not valid base64")
+    return algorithm, digest
+
+
+def verify(expected: Optional[Tuple[str, str]], digests: Dict[str, str]) -> None:
+    if expected is None:
+        return
+    algorithm, wanted = expected
+    if digests[algorithm] != wanted:
+        raise ChecksumMismatchError(f"{algorithm} checksum mismatch: expected {wanted}, got {digests[algorithm]}")
+
+
+def composite_checksum(algorithm: str, chunk_digests: Iterable[str]) -> str:
+    hasher = new_hasher(algorithm)
+    count = 0
+    for digest in chunk_digests:
+        hasher.update(base64.b64decode(digest))
+        count += 1
+    return f"{hasher.digest().hex()}-{count}"
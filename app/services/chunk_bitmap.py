@@ -0,0 +1,35 @@
+"""
+Received-chunk bookkeeping over a session's chunk map (SessionStore.chunks: chunk_index -> (size, digest)).
+
+The store keeps one entry per chunk, so recording a chunk costs the same however many were received
+before it. The bitmap in status responses is derived from the map: bit i (base64, least significant
+bit first) is set once chunk i has been stored.
+"""
+import base64
+from typing import Dict, List, Optional, Tuple
+
+ChunkMap = Dict[int, Tuple[int, Optional[str]]]
+
+
+def is_complete(chunks: ChunkMap, total_chunks: int) -> bool:
+    # n distinct indices that all lie in [0, n-1] are exactly 0..n-1
+    return len(chunks) == total_chunks and max(chunks, default=-1) == total_chunks - 1
+
+
+def received_indices(chunks: ChunkMap) -> List[int]:
+    return sorted(chunks)
+
+
+def received_bytes(chunks: ChunkMap) -> int:
+    return sum(size for size, _ in chunks.values())
+
+
+def missing_indices(chunks: ChunkMap, total_chunks: int) -> List[int]:
+    return [i for i in range(total_chunks) if i not in chunks]
+
+
+def encode(chunks: ChunkMap) -> str:
+    bitmap = bytearray((max(chunks) // 8 + 1) if chunks else 0)
+    for chunk_index in chunks:
+        bitmap[chunk_index // 8] |= 1 << (chunk_index % 8)
+    return base64.b64encode(bytes(bitmap)).decode()
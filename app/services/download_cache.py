@@ -0,0 +1,283 @@
+"""
+Read-through disk cache for downloads in S3 mode.
+
+GET /files/{file_id} serves S3 objects from DOWNLOAD_CACHE_PATH. A miss starts a single fetch from
+S3 into a .part file; the request that caused it, and every other request for the same object
+while the fetch runs, stream from that file as it grows, so concurrent misses cost one S3 GET.
+The finished file is renamed into the cache and entries are evicted least recently used first
+once the cache holds more than DOWNLOAD_CACHE_MAX_BYTES. Objects larger than the whole budget are
+streamed through without being kept, and byte ranges of them are fetched from S3 as ranges. Deleting or replacing a file invalidates its entry.
+
+The index is per process and rebuilt from the directory at startup, oldest mtime first; with
+several workers sharing the directory, each keeps the entries it added within the budget.
+"""
+import os
+import uuid
+import asyncio
+import hashlib
+import logging
+from functools import partial
+from collections import OrderedDict
+from typing import AsyncIterator, BinaryIO, Dict, List, Optional, Set, Union
+from app.core.config import settings
+from app.services.storage.scheduler import chunk_pool, s3_pool
+
+logger = logging.getLogger(__name__)
+
+PART_SUFFIX = ".part"
+
+
+class CacheFill:
+    """An S3 fetch in progress; readers tail its file while `written` grows"""
+
+    def __init__(self, key: str, path: str, keep: bool):
+        self.key = key
+        self.path = path
+        # False for oversized objects and invalidated keys: the file is dropped once fetched
+        self.keep = keep
+        self.size: Optional[int] = None
+        self.written = 0
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.writer: Optional[BinaryIO] = None
+        self._changed = asyncio.Event()
+
+    def _notify(self) -> None:
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    # start / advance / finish run on the event loop; the fetch thread schedules them
+    def start(self, size: int) -> None:
+        self.size = size
+        self._notify()
+
+    def advance(self, size: int) -> None:
+        self.written += size
+        self._notify()
+
+    def finish(self, error: Optional[BaseException] = None) -> None:
+        self.done = True
+        self.error = error
+        self._notify()
+
+    async def started(self) -> None:
+        while self.size is None and not self.done:
+            await self._changed.wait()
+        if self.error is not None:
+            raise self.error
+
+    async def completed(self) -> None:
+        while not self.done:
+            await self._changed.wait()
+        if self.error is not None:
+            raise self.error
+
+    def open(self) -> BinaryIO:
+        """
+        Opens the file being filled. Must be called without awaiting after getting the fill, so the
+        file can't be renamed or dropped in between; the open descriptor survives both.
+        """
+        return open(self.path, "rb")
+
+    async def stream(self, reader: BinaryIO):
+        """Yields the object from reader as the fetch writes it"""
+        position = 0
+        try:
+            while True:
+                if position < self.written:
+                    # A response already under way isn't refused half-way by a full pool
+                    block = await chunk_pool.run(
+                        reader.read, min(self.written - position, settings.CHUNK_IO_BUFFER_SIZE), bounded=False
+                    )
+                    position += len(block)
+                    yield block
+                elif self.error is not None:
+                    raise self.error
+                elif self.done:
+                    return
+                else:
+                    await self._changed.wait()
+        finally:
+            reader.close()
+
+
+class DownloadCache:
+    def __init__(self, s3_client, root: Optional[str] = None, max_bytes: Optional[int] = None):
+        self.s3_client = s3_client
+        self.root = root or settings.DOWNLOAD_CACHE_PATH or os.path.join(settings.PERSISTENT_LOCAL_STORAGE_PATH, "cache")
+        self.max_bytes = max_bytes if max_bytes is not None else settings.DOWNLOAD_CACHE_MAX_BYTES
+        # Cache file name -> size, least recently used first
+        self._entries: "OrderedDict[str, int]" = OrderedDict()
+        self._fills: Dict[str, CacheFill] = {}
+        self._tasks: Set[asyncio.Task] = set()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+        self._load()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "entries": len(self._entries),
+            "bytes": self.bytes,
+            "max_bytes": self.max_bytes,
+            "filling": len(self._fills),
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "evictions": self.evictions,
+        }
+
+    @staticmethod
+    def _name(key: str) -> str:
+        return hashlib.sha256(key.encode()).hexdigest()
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.root, name)
+
+    def _load(self) -> None:
+        os.makedirs(self.root, exist_ok=True)
+        found = []
+        for entry in os.scandir(self.root):
+            if not entry.is_file():
+                continue
+            if entry.name.endswith(PART_SUFFIX):
+                # Left by a fetch that never finished
+                _remove(entry.path)
+                continue
+            stat_result = entry.stat()
+            found.append((stat_result.st_mtime, entry.name, stat_result.st_size))
+        for _, name, size in sorted(found):
+            self._entries[name] = size
+            self.bytes += size
+        for path in self._evict():
+            _remove(path)
+
+    def _evict(self) -> List[str]:
+        """Drops least recently used entries until the budget holds; returns the files to remove"""
+        paths = []
+        while self.bytes > self.max_bytes and self._entries:
+            name, size = self._entries.popitem(last=False)
+            self.bytes -= size
+            self.evictions += 1
+            paths.append(self._path(name))
+        return paths
+
+    def cached_path(self, key: str) -> Optional[str]:
+        """Path of a complete cached copy, without counting a hit or starting a fetch"""
+        name = self._name(key)
+        return self._path(name) if name in self._entries else None
+
+    def keeps(self, size: Optional[int]) -> bool:
+        """Whether an object of size bytes (None if unknown) would be kept once fetched"""
+        return size is None or size <= self.max_bytes
+
+    def get(self, key: str, size: Optional[int] = None) -> Union[str, CacheFill]:
+        """
+        Returns the cached file's path on a hit. Otherwise returns the fetch for key, joining the one
+        already running or starting it; size (if known) decides whether the object will be kept.
+        """
+        name = self._name(key)
+        if name in self._entries:
+            self._entries.move_to_end(name)
+            self.hits += 1
+            return self._path(name)
+        fill = self._fills.get(key)
+        if fill is not None:
+            self.coalesced += 1
+            return fill
+
+        self.misses += 1
+        fill = CacheFill(key, self._path(f"{name}.{uuid.uuid4().hex}{PART_SUFFIX}"), self.keeps(size))
+        # Created here, on the loop, so the file exists before any reader opens it
+        fill.writer = open(fill.path, "wb", buffering=0)
+        self._fills[key] = fill
+        task = asyncio.create_task(self._fill(fill))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return fill
+
+    def _fetch(self, fill: CacheFill, loop: asyncio.AbstractEventLoop) -> int:
+        with fill.writer as f:
+            response = self.s3_client.get_object(Bucket=settings.S3_BUCKET_NAME, Key=fill.key)
+            size = response["ContentLength"]
+            loop.call_soon_threadsafe(fill.start, size)
+            for block in response["Body"].iter_chunks(settings.CHUNK_IO_BUFFER_SIZE):
+                view = memoryview(block)
+                while view:
+                    view = view[f.write(view):]
+                # Unbuffered writes: readers see the bytes as soon as they are told about them
+                loop.call_soon_threadsafe(fill.advance, len(block))
+        return size
+
+    async def _fill(self, fill: CacheFill) -> None:
+        try:
+            size = await s3_pool.run(self._fetch, fill, asyncio.get_running_loop())
+        except BaseException as e:
+            fill.writer.close()
+            self._fills.pop(fill.key, None)
+            await asyncio.to_thread(_remove, fill.path)
+            if not isinstance(e, Exception):
+                fill.finish(RuntimeError("Download cancelled"))
+                raise
+            logger.warning(f"Fetching {fill.key} into the download cache failed: {str(e)}")
+            fill.finish(e)
+            return
+
+        # No await from here to finish(): a reader that got this fill opens whichever path is current
+        self._fills.pop(fill.key, None)
+        evicted = []
+        if fill.keep and size <= self.max_bytes:
+            name = self._name(fill.key)
+            final_path = self._path(name)
+            os.replace(fill.path, final_path)
+            fill.path = final_path
+            self._entries[name] = size
+            self.bytes += size
+            evicted = self._evict()
+        else:
+            # Readers hold their own descriptors, so the file can go right away
+            os.remove(fill.path)
+        fill.finish()
+        if evicted:
+            await asyncio.to_thread(_remove_all, evicted)
+
+    async def fetch_range(self, key: str, byte_range: str) -> dict:
+        """GetObject of one byte range (a Range header value) past the cache, for objects it won't keep"""
+        return await s3_pool.run(partial(self.s3_client.get_object, Bucket=settings.S3_BUCKET_NAME, Key=key, Range=byte_range))
+
+    @staticmethod
+    async def stream_body(body) -> AsyncIterator[bytes]:
+        """Yields a GetObject body, reading it off the event loop"""
+        try:
+            while True:
+                block = await s3_pool.run(body.read, settings.CHUNK_IO_BUFFER_SIZE, bounded=False)
+                if not block:
+                    return
+                yield block
+        finally:
+            body.close()
+
+    async def invalidate(self, key: str) -> None:
+        """Drops the cached copy of key; a fetch still running for it won't be kept"""
+        fill = self._fills.get(key)
+        if fill is not None:
+            fill.keep = False
+        name = self._name(key)
+        size = self._entries.pop(name, None)
+        if size is not None:
+            self.bytes -= size
+            await asyncio.to_thread(_remove, self._path(name))
+
+
+def _remove(path: str) -> None:
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def _remove_all(paths: List[str]) -> None:
+    for path in paths:
+        _remove(path)
@@ -1,59 +1,354 @@
 from app.services.storage.factory import get_storage
-from app.core.session import session_map
+from app.services.storage.scheduler import chunk_pool, merge_pool, IOSaturatedError
+from app.services.storage import layout, durability
+from app.services.storage.internal import move_file
+from app.services.catalog import get_catalog
+from app.services.download_cache import DownloadCache
+from app.services import checksum, chunk_bitmap
+from app.core.session import session_store
 from app.core.config import settings
+from app.core import metrics
 import os
-import boto3
+import time
+import shutil
+import asyncio
+import logging
+from typing import BinaryIO, Callable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class IncompleteUploadError(ValueError):
+    def __init__(self, total_chunks: int, missing: list):
+        self.total_chunks = total_chunks
+        self.missing = missing
+        if missing:
+            message = f"{len(missing)} of {total_chunks} chunks have not been received: {missing[:20]}"
+        else:
+            message = f"Chunks beyond total_chunks={total_chunks} were received"
+        super().__init__(message)
+
 
 class FileService:
     def __init__(self):
         self.storage = get_storage()
+        self.catalog = get_catalog()
+        self.download_cache = DownloadCache(self.storage.s3_client) if settings.STORAGE_BACKEND == "s3" else None
+
+    @staticmethod
+    def final_dir(user_id: str, file_id) -> str:
+        return layout.final_dir(user_id, file_id)
+
+    def _find_final_path(self, user_id: str, file_id) -> Optional[str]:
+        # The legacy flat directory still holds files the layout migration hasn't moved yet
+        for user_file_dir in layout.final_dirs(user_id, file_id):
+            try:
+                with os.scandir(user_file_dir) as entries:
+                    for entry in entries:
+                        if entry.is_file():
+                            return entry.path
+            except FileNotFoundError:
+                pass
+        return None
+
+    def _backfill_local_record(self, user_id: str, file_id) -> Optional[dict]:
+        # Files completed before the catalog existed are picked up once and recorded
+        file_path = self._find_final_path(user_id, file_id)
+        if file_path is None:
+            return None
+        stat_result = os.stat(file_path)
+        record = {
+            "user_id": user_id,
+            "file_id": str(file_id),
+            "storage_key": os.path.relpath(file_path, settings.PERSISTENT_LOCAL_STORAGE_PATH),
+            "file_name": os.path.basename(file_path),
+            "size": stat_result.st_size,
+            "created_at": stat_result.st_mtime,
+            "updated_at": stat_result.st_mtime,
+        }
+        self.catalog.add(record)
+        return record
+
+    async def get_local_file(self, user_id: str, file_id) -> Optional[dict]:
+        """
+        Returns the catalog record of a completed local file, or None.
+        The file's directory is only scanned for files the catalog doesn't know yet.
+        """
+        record = await self.catalog.aget(user_id, file_id)
+        if record is None:
+            record = await asyncio.to_thread(self._backfill_local_record, user_id, file_id)
+        return record
+
+    @staticmethod
+    def local_path(record: dict) -> str:
+        return os.path.join(settings.PERSISTENT_LOCAL_STORAGE_PATH, record["storage_key"])
+
+    @staticmethod
+    def object_key(user_id: str, file_id: int, original_file_name: str) -> str:
+        return f"{user_id}/{file_id}/{original_file_name}"
+
+    async def create_session(self, file_id: int, user_id: str, original_file_name: str, file_size: Optional[int] = None,
+                             chunk_size: Optional[int] = None):
+        if chunk_size is not None and chunk_size <= 0:
+            raise ValueError("chunk_size must be positive")
+        session = {
+            "user_id": user_id,
+            "original_file_name": original_file_name,
+            "main_service_file_id": file_id,
+            "file_size": file_size
+        }
+        object_key = self.object_key(user_id, file_id, original_file_name)
+        session.update(await self.storage.init_session(str(file_id), object_key, file_size))
+        # Presigned mode dictates the chunk size
+        chunk_size = session.get("part_size") or chunk_size
+        if chunk_size:
+            session["chunk_size"] = chunk_size
+        await session_store.aset(str(file_id), session)
+        return session
+
+    async def chunk_index_for_range(self, upload_session_id: str, start: int, end: int, total: int) -> int:
+        """
+        Chunk index of the bytes start-end of a total byte file, for chunk PUTs that send only Content-Range.
+        Every chunk but the last has the session's chunk_size, declared on creation or else taken from
+        the first range that isn't the last one.
+        """
+        length = end - start + 1
+        last = end + 1 == total
+        session = await session_store.aget(upload_session_id) or {}
+        chunk_size = session.get("chunk_size")
+        if not chunk_size and not last:
+            def fix_chunk_size(session: dict):
+                if not session.get("chunk_size"):
+                    session["chunk_size"] = length
+
+            session = await session_store.amutate(upload_session_id, fix_chunk_size) or {}
+            chunk_size = session.get("chunk_size", length)
+        if not chunk_size:
+            if start == 0:
+                return 0
+            raise ValueError(
+                "The chunk size of this upload isn't known yet: send chunk_index, or chunk_size when creating the upload"
+            )
+        if start % chunk_size or length > chunk_size or (length < chunk_size and not last):
+            raise ValueError(f"Bytes {start}-{end}/{total} are not a chunk of this upload's {chunk_size} byte chunks")
+        return start // chunk_size
+
+    async def save_chunk(self, upload_session_id: str, chunk_index: int, chunk_file: BinaryIO, offset: Optional[int] = None,
+                         expected_checksum: Optional[Tuple[str, str]] = None):
+        """
+        Stores a chunk and records it among the session's received chunks along with its digest.
+        expected_checksum is the client's (algorithm, base64 digest); a mismatching chunk is dropped
+        and ChecksumMismatchError raised.
+        """
+        if chunk_index < 0:
+            raise ValueError("chunk_index must not be negative")
+        started = time.perf_counter()
+        chunk_size = _stream_size(chunk_file)
+        algorithm = settings.CHECKSUM_ALGORITHM
+        algorithms = _chunk_algorithms(expected_checksum)
+
+        digests = {}
+        if not algorithms:
+            result = await self.storage.save_chunk(upload_session_id, chunk_index, chunk_file, offset)
+        elif self.storage.digest_before_write:
+            # The spooled chunk is hashed before it is sent, so nothing is written when it doesn't match
+            digests = await chunk_pool.run(checksum.digest_file, chunk_file, algorithms)
+            checksum.verify(expected_checksum, digests)
+            result = await self.storage.save_chunk(upload_session_id, chunk_index, chunk_file, offset, digests.get(algorithm))
+        else:
+            reader = checksum.HashingReader(chunk_file, algorithms)
+            result = await self.storage.save_chunk(upload_session_id, chunk_index, reader, offset)
+            digests = reader.digests()
+            try:
+                checksum.verify(expected_checksum, digests)
+            except checksum.ChecksumMismatchError:
+                await self.storage.discard_chunk(upload_session_id, chunk_index)
+                raise
+        # Activity also refreshes the session TTL; idle sessions expire after SESSION_TTL_SECONDS
+        await session_store.arecord_chunks(upload_session_id, [(chunk_index, chunk_size, digests.get(algorithm))])
+        metrics.CHUNK_WRITE_SECONDS.observe(time.perf_counter() - started)
+        metrics.BYTES_INGESTED.inc(chunk_size)
+        return result
+
+    async def save_chunks(self, upload_session_id: str,
+                          chunks: List[Tuple[int, BinaryIO, Optional[int], Optional[Tuple[str, str]]]]) -> List[dict]:
+        """
+        Stores a batch of (chunk_index, file, offset, expected_checksum) chunks with a single storage call
+        and a single session update. Returns one {"chunk_index", "status", "detail"} result per chunk, in
+        order, with status 'stored', 'checksum_mismatch' or 'failed'; one bad chunk doesn't fail the rest.
+        """
+        results: List[Optional[dict]] = [None] * len(chunks)
+        if self.storage.digest_before_write:
+            # Each chunk is hashed and sent as its own request anyway
+            for position, (chunk_index, chunk_file, offset, expected_checksum) in enumerate(chunks):
+                try:
+                    await self.save_chunk(upload_session_id, chunk_index, chunk_file, offset, expected_checksum)
+                    results[position] = _chunk_result(chunk_index, "stored")
+                except checksum.ChecksumMismatchError as e:
+                    results[position] = _chunk_result(chunk_index, "checksum_mismatch", str(e))
+                except IOSaturatedError:
+                    raise
+                except Exception as e:
+                    results[position] = _chunk_result(chunk_index, "failed", str(e))
+            return results
+
+        started = time.perf_counter()
+        algorithm = settings.CHECKSUM_ALGORITHM
+        pending = []
+        for position, (chunk_index, chunk_file, offset, expected_checksum) in enumerate(chunks):
+            size = _stream_size(chunk_file)
+            try:
+                if chunk_index < 0:
+                    raise ValueError("chunk_index must not be negative")
+                if not size:
+                    raise ValueError("Empty chunk received")
+                algorithms = _chunk_algorithms(expected_checksum)
+            except ValueError as e:
+                results[position] = _chunk_result(chunk_index, "failed", str(e))
+                continue
+            reader = checksum.HashingReader(chunk_file, algorithms)
+            pending.append((position, chunk_index, offset, expected_checksum, reader, size))
+
+        written = await self.storage.save_chunks(
+            upload_session_id, [(chunk_index, reader, offset) for _, chunk_index, offset, _, reader, _ in pending]
+        )
+        received = []
+        for (position, chunk_index, _, expected_checksum, reader, size), outcome in zip(pending, written):
+            if isinstance(outcome, Exception):
+                results[position] = _chunk_result(chunk_index, "failed", str(outcome))
+                continue
+            digests = reader.digests()
+            try:
+                checksum.verify(expected_checksum, digests)
+            except checksum.ChecksumMismatchError as e:
+                await self.storage.discard_chunk(upload_session_id, chunk_index)
+                results[position] = _chunk_result(chunk_index, "checksum_mismatch", str(e))
+                continue
+            received.append((chunk_index, size, digests.get(algorithm)))
+            results[position] = _chunk_result(chunk_index, "stored")
+
+        if received:
+            await session_store.arecord_chunks(upload_session_id, received)
+        # One observation per batch: the write stage is a single storage job here
+        metrics.CHUNK_WRITE_SECONDS.observe(time.perf_counter() - started)
+        metrics.BYTES_INGESTED.inc(sum(size for _, size, _ in received))
+        return results
+
+    async def adopt_uploads(self, target_session_id: str, sources: List[Tuple[str, dict]]) -> int:
+        """
+        Appends finished upload sessions to target_session_id in order, chunks and bookkeeping alike.
+        Returns the target's resulting chunk count. The sources are left for discard_uploads once the
+        target has completed; a ValueError means nothing was touched.
+        """
+        # Everything is checked before the first source is touched
+        source_chunks = []
+        for source_id, _ in sources:
+            chunks = await session_store.achunks(source_id)
+            if not chunks or not chunk_bitmap.is_complete(chunks, len(chunks)):
+                raise ValueError(f"Upload {source_id} is missing chunks")
+            source_chunks.append(chunks)
+        sizes = [chunks[i][0] for chunks in source_chunks for i in range(len(chunks))]
+        min_part_size = self.storage.min_part_size
+        if any(size < min_part_size for size in sizes[:-1]):
+            raise ValueError(
+                f"Every chunk of the concatenated file but the last must be at least {min_part_size} bytes"
+            )
+
+        chunk_index = 0
+        offset = 0
+        for (source_id, _), chunks in zip(sources, source_chunks):
+            chunk_count = len(chunks)
+            size = chunk_bitmap.received_bytes(chunks)
+            await self.storage.adopt_chunks(source_id, target_session_id, chunk_index, chunk_count, offset, size)
+            await session_store.arecord_chunks(target_session_id, [
+                (chunk_index + i, chunk_size, digest) for i, (chunk_size, digest) in sorted(chunks.items())
+            ])
+            chunk_index += chunk_count
+            offset += size
+        return chunk_index
+
+    async def discard_uploads(self, upload_session_ids: List[str]) -> None:
+        """Removes sessions along with whatever storage they still hold"""
+        for upload_session_id in upload_session_ids:
+            await self.cleanup_session(upload_session_id)
+            await session_store.adelete(upload_session_id)
 
-    async def save_chunk(self, upload_session_id: str, chunk_index: int, chunk_data: bytes):
-        return await self.storage.save_chunk(upload_session_id, chunk_index, chunk_data)
+    async def presigned_parts(self, upload_session_id: str, first_chunk_index: int, count: int) -> List[dict]:
+        """Direct upload URLs for a batch of chunks, at most S3_PRESIGNED_BATCH_SIZE at a time"""
+        if not self.storage.direct_upload:
+            raise ValueError("Presigned part URLs are only available when S3_UPLOAD_MODE is 'presigned'")
+        count = min(count, settings.S3_PRESIGNED_BATCH_SIZE)
+        return await self.storage.presign_parts(upload_session_id, first_chunk_index, count)
 
-    async def merge_chunks(self, upload_session_id: str, total_chunks: int, merged_file_path: str):
-        return await self.storage.merge_chunks(upload_session_id, total_chunks, merged_file_path)
+    async def record_uploaded_parts(self, upload_session_id: str, client_parts: Optional[List[Tuple[int, str]]] = None) -> None:
+        """
+        Records the chunks clients uploaded straight to the object store among the session's chunks, taking
+        their md5 from the part ETags. client_parts are (chunk_index, etag) pairs the client got back from
+        the store; one that doesn't match the stored part raises ChecksumMismatchError.
+        """
+        uploaded = await self.storage.uploaded_parts(upload_session_id)
+        stored_etags = {part["chunk_index"]: part["etag"] for part in uploaded}
+        for chunk_index, etag in client_parts or []:
+            # Parts the store doesn't have show up as missing chunks instead
+            if chunk_index in stored_etags and stored_etags[chunk_index] != etag.strip('"'):
+                raise checksum.ChecksumMismatchError(
+                    f"Chunk {chunk_index} ETag mismatch: expected {etag}, stored part has {stored_etags[chunk_index]}"
+                )
+        record_md5 = settings.CHECKSUM_ALGORITHM == "md5"
+        await session_store.arecord_chunks(upload_session_id, [
+            (part["chunk_index"], part["size"], part["md5"] if record_md5 else None) for part in uploaded
+        ])
+
+    async def upload_status(self, upload_session_id: str) -> Optional[dict]:
+        session = await session_store.aget(upload_session_id)
+        if session is None:
+            return None
+        chunks = await session_store.achunks(upload_session_id)
+        return {
+            "file_id": session["main_service_file_id"],
+            "file_size": session.get("file_size"),
+            "received_chunks": chunk_bitmap.received_indices(chunks),
+            "received_count": len(chunks),
+            "received_bytes": chunk_bitmap.received_bytes(chunks),
+            "chunk_bitmap": chunk_bitmap.encode(chunks),
+        }
+
+    @staticmethod
+    def file_checksum(chunks: dict, total_chunks: int) -> Optional[str]:
+        """Whole-file checksum from the recorded chunk digests, or None if any chunk has none"""
+        digests = [chunks[i][1] if i in chunks else None for i in range(total_chunks)]
+        if not checksum.enabled() or None in digests:
+            return None
+        algorithm = settings.CHECKSUM_ALGORITHM
+        return f"{algorithm}:{checksum.composite_checksum(algorithm, digests)}"
+
+    async def merge_chunks(self, upload_session_id: str, total_chunks: int, merged_file_path: str,
+                           progress: Optional[Callable[[int], None]] = None):
+        with metrics.MERGE_SECONDS.time():
+            return await self.storage.merge_chunks(upload_session_id, total_chunks, merged_file_path, progress)
 
-    async def upload_file(self, file_path: str, s3_key: str):
-        return await self.storage.upload_file(file_path, s3_key)
+    async def upload_file(self, file_path: str, s3_key: str, progress: Optional[Callable[[int], None]] = None):
+        with metrics.S3_UPLOAD_SECONDS.time():
+            return await self.storage.upload_file(file_path, s3_key, progress)
 
     async def delete_file(self, file_path_or_key: str):
         return await self.storage.delete_file(file_path_or_key)
 
     async def cleanup_session(self, upload_session_id: str):
-        return await self.storage.cleanup_session(upload_session_id)
+        with metrics.CLEANUP_SECONDS.time():
+            return await self.storage.cleanup_session(upload_session_id)
 
-    def list_user_files(self, user_id: str):
-        files = []
-        if settings.STORAGE_BACKEND == "s3":
-            # List S3 objects with prefix user_id/
-            s3_client = boto3.client(
-                's3',
-                aws_access_key_id=settings.S3_ACCESS_KEY,
-                aws_secret_access_key=settings.S3_SECRET_KEY,
-                endpoint_url=settings.S3_ENDPOINT_URL,
-                region_name=settings.S3_REGION_NAME
-            )
-            paginator = s3_client.get_paginator('list_objects_v2')
-            prefix = f"{user_id}/"
-            for page in paginator.paginate(Bucket=settings.S3_BUCKET_NAME, Prefix=prefix):
-                for obj in page.get('Contents', []):
-                    file_url = f"{settings.S3_ENDPOINT_URL}/{settings.S3_BUCKET_NAME}/{obj['Key']}"
-                    files.append(file_url)
-        else:
-            # برای local storage، URL های دانلود پذیر برمی‌گردونیم
-            user_dir = os.path.join(settings.PERSISTENT_LOCAL_STORAGE_PATH, "final", user_id)
-            if os.path.exists(user_dir):
-                for file_id in os.listdir(user_dir):
-                    file_id_path = os.path.join(user_dir, file_id)
-                    if os.path.isdir(file_id_path):  # file_id یک دایرکتوری هست
-                        # URL دانلود پذیر برای این فایل می‌سازیم
-                        download_url = f"{settings.UPLOAD_SERVICE_BASE_URL}/files/{file_id}"
-                        files.append(download_url)
-        return files
-
-    def check_user_access(self, upload_session_id: str, user_id: str, main_service_file_id: int = None):
-        session = session_map.get(upload_session_id)
+    def _file_url(self, record: dict) -> str:
+        if settings.STORAGE_BACKEND == "s3" and not settings.S3_SERVE_DOWNLOADS:
+            return f"{settings.S3_ENDPOINT_URL}/{settings.S3_BUCKET_NAME}/{record['storage_key']}"
+        # برای local storage، URL های دانلود پذیر برمی‌گردونیم
+        return f"{settings.UPLOAD_SERVICE_BASE_URL}/files/{record['file_id']}"
+
+    async def list_user_files(self, user_id: str):
+        return [self._file_url(record) for record in await self.catalog.alist_user_files(user_id)]
+
+    async def check_user_access(self, upload_session_id: str, user_id: str, main_service_file_id: int = None):
+        session = await session_store.aget(upload_session_id)
         if not session or session["user_id"] != user_id:
             return False
         if main_service_file_id is not None and session["main_service_file_id"] != main_service_file_id:
@@ -64,31 +359,130 @@ class FileService:
         """
         حذف فایل کاربر بر اساس user_id و file_id
         """
+        record = await self.catalog.adelete(user_id, file_id)
+        if settings.STORAGE_BACKEND == "s3":
+            if record is not None:
+                await self.download_cache.invalidate(record["storage_key"])
+                await self.storage.delete_file(record["storage_key"])
+                return True
+            # Not in the catalog (e.g. uploaded before it existed): look only under this file's own prefix
+            keys = await self.storage.list_keys(f"{user_id}/{file_id}/")
+            for key in keys:
+                await self.download_cache.invalidate(key)
+            return await self.storage.delete_files(keys) > 0
+        else:
+            # برای local storage، کل دایرکتوری file_id رو حذف می‌کنیم (در layout فعلی و قدیمی)
+            removed = False
+            for file_dir in layout.final_dirs(user_id, file_id):
+                if os.path.exists(file_dir):
+                    # حذف کل دایرکتوری (شامل همه فایل‌هاش)
+                    await asyncio.to_thread(shutil.rmtree, file_dir)
+                    removed = True
+            return removed or record is not None
+
+    @staticmethod
+    def require_complete(chunks: dict, total_chunks: int) -> None:
+        """Checks the recorded chunks instead of probing every chunk on storage"""
+        if not chunk_bitmap.is_complete(chunks, total_chunks):
+            missing = chunk_bitmap.missing_indices(chunks, total_chunks)
+            raise IncompleteUploadError(total_chunks, missing)
+
+    async def finalize_upload(self, upload_session_id: str, session: dict, user_id: str, total_chunks: int, main_service_file_id: int,
+                              parts: Optional[List[Tuple[int, str]]] = None,
+                              on_progress: Optional[Callable[[str, int], None]] = None) -> str:
+        """
+        Merges the session's chunks, moves the result to its final location, records it in the catalog
+        and removes the session. Returns the URL of the completed file.
+        parts are the client's (chunk_index, etag) pairs for chunks uploaded straight to the object store.
+        on_progress, if given, is called with ("merged" | "uploaded", byte count) as the work advances.
+        """
+        if self.storage.direct_upload:
+            await self.record_uploaded_parts(upload_session_id, parts)
+
+        chunks = await session_store.achunks(upload_session_id)
+        self.require_complete(chunks, total_chunks)
+        merge_progress = upload_progress = None
+        if on_progress is not None:
+            merge_progress = lambda n: on_progress("merged", n)
+            upload_progress = lambda n: on_progress("uploaded", n)
+
+        # استفاده از نام اصلی فایل به جای merged_final_file
+        original_filename = session['original_file_name']
+        merged_file_path = layout.merge_path(upload_session_id, original_filename)
+        
+        await self.merge_chunks(upload_session_id, total_chunks, merged_file_path, merge_progress)
+
+        # Clean up logic
         if settings.STORAGE_BACKEND == "s3":
-            # برای S3، ممکنه چندین فایل با prefix user_id/file_id/ باشه
-            # پس همه رو پیدا می‌کنیم و حذف می‌کنیم
-            files = self.list_user_files(user_id)
-            target_pattern = f"/{user_id}/{file_id}/"
-            deleted_count = 0
+            storage_key = self.object_key(user_id, main_service_file_id, original_filename)
+            # Staged mode leaves a merged local file; in multipart mode the object already exists in S3
+            file_size = await asyncio.to_thread(_file_size, merged_file_path)
+            await self.upload_file(merged_file_path, storage_key, upload_progress)  # Also removes the local merged file
+            await self.cleanup_session(upload_session_id)  # Delete all chunks
+            if file_size is None:
+                file_size = await self.storage.object_size(storage_key)
+            # A re-upload under the same key replaces the object behind any cached copy
+            await self.download_cache.invalidate(storage_key)
+        else:
+            # برای local storage، فایل رو به final directory منتقل میکنیم
+            final_dir = self.final_dir(user_id, upload_session_id)
+            logger.info(f"Final dir: {final_dir}")
+            final_file_path = os.path.join(final_dir, original_filename)
+            logger.info(f"Final file path: {final_file_path}")
             
-            for file_url in files:
-                if target_pattern in file_url:
-                    # استخراج S3 key از URL
-                    parts = file_url.split('/')
-                    bucket_index = parts.index(settings.S3_BUCKET_NAME)
-                    s3_key = '/'.join(parts[bucket_index + 1:])
-                    await self.storage.delete_file(s3_key)
-                    deleted_count += 1
+            # انتقال فایل merged به final directory؛ between the scratch and sharded trees this may be a copy
+            file_size = await merge_pool.run(_move_into_place, merged_file_path, final_file_path, bounded=False)
+            logger.info(f"File moved to final location: {final_file_path}")
+            # Durable (per DURABILITY_MODE) before the catalog and the client are told it exists
+            await merge_pool.run(durability.complete, final_file_path, settings.PERSISTENT_LOCAL_STORAGE_PATH, bounded=False)
             
-            return deleted_count > 0
-        else:
-            # برای local storage، کل دایرکتوری file_id رو حذف می‌کنیم
-            file_dir = os.path.join(settings.PERSISTENT_LOCAL_STORAGE_PATH, "final", user_id, str(file_id))
-            if os.path.exists(file_dir):
-                # حذف کل دایرکتوری (شامل همه فایل‌هاش)
-                import shutil
-                shutil.rmtree(file_dir)
-                return True
-            return False
+            await self.cleanup_session(upload_session_id) # Delete chunks
+            storage_key = os.path.relpath(final_file_path, settings.PERSISTENT_LOCAL_STORAGE_PATH)
+
+        record = {
+            "user_id": user_id,
+            "file_id": upload_session_id,
+            "storage_key": storage_key,
+            "file_name": original_filename,
+            "size": file_size,
+            "checksum": self.file_checksum(chunks, total_chunks),
+        }
+        await self.catalog.aadd(record)
+        await session_store.adelete(upload_session_id)
+        return self._file_url(record)
+
+
+def _chunk_algorithms(expected_checksum: Optional[Tuple[str, str]]) -> List[str]:
+    # The configured algorithm is recorded; a client may verify with any supported one alongside it
+    algorithms = [settings.CHECKSUM_ALGORITHM] if checksum.enabled() else []
+    if expected_checksum is not None and expected_checksum[0] not in algorithms:
+        if expected_checksum[0] not in checksum.ALGORITHMS:
+            raise ValueError(f"Unsupported checksum algorithm '{expected_checksum[0]}'")
+        algorithms.append(expected_checksum[0])
+    return algorithms
+
+
+def _chunk_result(chunk_index: int, status: str, detail: Optional[str] = None) -> dict:
+    return {"chunk_index": chunk_index, "status": status, "detail": detail}
+
+
+def _stream_size(fileobj: BinaryIO) -> int:
+    position = fileobj.tell()
+    size = fileobj.seek(0, os.SEEK_END)
+    fileobj.seek(position)
+    return size - position
+
+
+def _move_into_place(merged_file_path: str, final_file_path: str) -> int:
+    move_file(merged_file_path, final_file_path)
+    return os.stat(final_file_path).st_size
+
+
+def _file_size(path: str) -> Optional[int]:
+    try:
+        return os.path.getsize(path)
+    except FileNotFoundError:
+        return None
+
 
 file_service = FileService() 
\ No newline at end of file
@@ -0,0 +1,232 @@
+"""
+Asynchronous upload completion (FINALIZE_MODE=async).
+
+PATCH /files/{file_id} only enqueues a finalize job and answers 202; FINALIZE_WORKERS workers run
+the merge and upload with up to FINALIZE_MAX_ATTEMPTS attempts. Jobs are keyed by file_id: asking
+again while a job is queued or running returns that job instead of starting a second one, also
+across worker processes through the job state kept on the session. Progress (bytes merged and
+uploaded) is written back to the session every FINALIZE_PROGRESS_INTERVAL_SECONDS, and a finished
+upload is reported from the catalog once its session is gone.
+"""
+import time
+import asyncio
+import logging
+from typing import Dict, List, Optional, Tuple
+from app.core.config import settings
+from app.core.session import session_store
+from app.services.storage.scheduler import IOSaturatedError
+from app.services.file_service import file_service
+from app.services import chunk_bitmap
+
+logger = logging.getLogger(__name__)
+
+ACTIVE_STATES = ("queued", "merging", "uploading")
+# A job whose state hasn't been refreshed for this long belongs to a process that died; it may be taken over
+STALE_AFTER_SECONDS = 60
+
+
+class FinalizeJob:
+    def __init__(self, file_id: str, user_id: str, total_chunks: int, main_service_file_id: int,
+                 parts: Optional[List[Tuple[int, str]]], total_bytes: Optional[int]):
+        self.file_id = file_id
+        self.user_id = user_id
+        self.total_chunks = total_chunks
+        self.main_service_file_id = main_service_file_id
+        self.parts = parts
+        self.state = "queued"
+        self.attempts = 0
+        self.total_bytes = total_bytes
+        self.bytes_merged = 0
+        self.bytes_uploaded = 0
+        self.file_url: Optional[str] = None
+        self.error: Optional[str] = None
+
+    def on_progress(self, kind: str, size: int) -> None:
+        # Called from storage worker threads; each counter only ever has one writer at a time
+        if kind == "merged":
+            self.state = "merging"
+            self.bytes_merged += size
+        else:
+            self.state = "uploading"
+            self.bytes_uploaded += size
+
+    def status(self) -> dict:
+        return {
+            "file_id": self.main_service_file_id,
+            "state": self.state,
+            "attempts": self.attempts,
+            "total_bytes": self.total_bytes,
+            "bytes_merged": self.bytes_merged,
+            "bytes_uploaded": self.bytes_uploaded,
+            "file_download_url": self.file_url,
+            "error": self.error,
+            "updated_at": time.time(),
+        }
+
+
+class FinalizeQueue:
+    def __init__(self, service):
+        self.service = service
+        self._queue: Optional[asyncio.Queue] = None
+        self._workers: List[asyncio.Task] = []
+        self._jobs: Dict[str, FinalizeJob] = {}
+        self.completed = 0
+        self.failed = 0
+        self.retries = 0
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "workers": len(self._workers),
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+            "running": sum(1 for job in self._jobs.values() if job.state in ("merging", "uploading")),
+            "completed": self.completed,
+            "failed": self.failed,
+            "retries": self.retries,
+        }
+
+    async def submit(self, file_id: str, session: dict, user_id: str, total_chunks: int, main_service_file_id: int,
+                     parts: Optional[List[Tuple[int, str]]] = None) -> Optional[dict]:
+        """
+        Enqueues the finalize job for file_id, or returns the status of the one already queued or running.
+        Returns None if the session no longer exists (e.g. another worker just completed it).
+        Raises IncompleteUploadError up front when the recorded chunks already show missing ones.
+        """
+        job = self._jobs.get(file_id)
+        if job is not None and job.state in ACTIVE_STATES:
+            return job.status()
+        chunks = await session_store.achunks(file_id)
+        if not chunks and await session_store.aget(file_id) is None:
+            return None
+        if not self.service.storage.direct_upload:
+            self.service.require_complete(chunks, total_chunks)
+        if self._queue is None or self._queue.full():
+            raise IOSaturatedError("finalize")
+
+        total_bytes = chunk_bitmap.received_bytes(chunks) if chunks else None
+        job = FinalizeJob(file_id, user_id, total_chunks, main_service_file_id, parts, total_bytes)
+        claimed = {}
+
+        def claim(session: dict):
+            current = session.get("finalize")
+            claimed["ok"] = not (
+                current and current["state"] in ACTIVE_STATES and time.time() - current["updated_at"] < STALE_AFTER_SECONDS
+            )
+            claimed["current"] = current
+            if claimed["ok"]:
+                session["finalize"] = job.status()
+
+        if await session_store.amutate(file_id, claim) is None:
+            return None
+        if not claimed["ok"]:
+            # Another worker process owns this upload's job
+            return claimed["current"]
+        self._jobs[file_id] = job
+        self._queue.put_nowait(job)
+        return job.status()
+
+    async def status(self, file_id: str, user_id: str) -> Optional[dict]:
+        job = self._jobs.get(file_id)
+        if job is not None and job.user_id == user_id:
+            return job.status()
+        session = await session_store.aget(file_id)
+        if session is not None:
+            if session["user_id"] != user_id or "finalize" not in session:
+                return None
+            return session["finalize"]
+        record = await self.service.catalog.aget(user_id, file_id)
+        if record is None:
+            return None
+        return {
+            "file_id": int(file_id),
+            "state": "completed",
+            "attempts": None,
+            "total_bytes": record.get("size"),
+            "bytes_merged": record.get("size"),
+            "bytes_uploaded": record.get("size"),
+            "file_download_url": self.service._file_url(record),
+            "error": None,
+            "updated_at": record.get("updated_at"),
+        }
+
+    async def _save(self, job: FinalizeJob) -> None:
+        await session_store.aupdate(job.file_id, finalize=job.status())
+
+    async def _report_progress(self, job: FinalizeJob):
+        while True:
+            await asyncio.sleep(settings.FINALIZE_PROGRESS_INTERVAL_SECONDS)
+            await self._save(job)
+
+    async def _run(self, job: FinalizeJob) -> None:
+        reporter = asyncio.create_task(self._report_progress(job))
+        try:
+            while True:
+                job.attempts += 1
+                job.state = "merging"
+                job.bytes_merged = job.bytes_uploaded = 0
+                await self._save(job)
+                session = await session_store.aget(job.file_id)
+                if session is None:
+                    job.state, job.error = "failed", "Session not found."
+                    break
+                try:
+                    job.file_url = await self.service.finalize_upload(
+                        job.file_id, session, job.user_id, job.total_chunks, job.main_service_file_id,
+                        job.parts, job.on_progress
+                    )
+                    job.state = "completed"
+                    break
+                except ValueError as e:
+                    # Missing chunks, mismatching parts and the like won't go away by retrying
+                    job.state, job.error = "failed", str(e)
+                    break
+                except Exception as e:
+                    logger.warning(f"Finalize attempt {job.attempts} for {job.file_id} failed: {str(e)}")
+                    if job.attempts >= settings.FINALIZE_MAX_ATTEMPTS:
+                        job.state, job.error = "failed", str(e)
+                        break
+                    self.retries += 1
+                    await asyncio.sleep(settings.FINALIZE_RETRY_BACKOFF_SECONDS * 2 ** (job.attempts - 1))
+        finally:
+            reporter.cancel()
+
+        if job.state == "completed":
+            self.completed += 1
+            logger.info(f"Finalized {job.file_id} after {job.attempts} attempt(s)")
+        else:
+            self.failed += 1
+            logger.error(f"Finalizing {job.file_id} failed after {job.attempts} attempt(s): {job.error}")
+            # Kept on the session so the status endpoint can report it; a new PATCH starts over
+            await self._save(job)
+
+    async def _worker(self):
+        while True:
+            job = await self._queue.get()
+            try:
+                await self._run(job)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Finalize worker error for {job.file_id}: {str(e)}")
+            finally:
+                # Finished jobs stay visible through the session or the catalog
+                self._jobs.pop(job.file_id, None)
+                self._queue.task_done()
+
+    def start(self):
+        if self._queue is None:
+            self._queue = asyncio.Queue(maxsize=settings.FINALIZE_MAX_QUEUE)
+            self._workers = [asyncio.create_task(self._worker()) for _ in range(settings.FINALIZE_WORKERS)]
+
+    async def stop(self):
+        for worker in self._workers:
+            worker.cancel()
+        for worker in self._workers:
+            try:
+                await worker
+            except asyncio.CancelledError:
+                pass
+        self._workers = []
+        self._queue = None
+
+
+finalize_queue = FinalizeQueue(file_service)
@@ -0,0 +1,200 @@
+"""
+Background cleanup of abandoned upload sessions.
+
+Every JANITOR_INTERVAL_SECONDS the janitor walks the scratch areas (chunk directories under
+LOCAL_TEMP_CHUNK_PATH, partial files of the offset backend) and, for S3 multipart, the bucket's
+open multipart uploads:
+
+- sessions idle for longer than SESSION_TTL_SECONDS, or whose session has already expired from
+  the session store, are cleaned up through the active backend's cleanup_session;
+- when a scratch filesystem is above JANITOR_DISK_HIGH_WATER_PERCENT, the remaining sessions are
+  evicted oldest-idle first until it is below the mark again;
+- multipart uploads that no live session owns are aborted, if their key has the shape this service
+  gives object keys (and lies under JANITOR_MULTIPART_KEY_PREFIX); other uploads in a shared bucket
+  are left alone.
+
+Nothing touched in the last JANITOR_MIN_IDLE_SECONDS is ever removed.
+"""
+import os
+import re
+import time
+import shutil
+import asyncio
+import logging
+from typing import Dict, List, Optional
+from app.core.config import settings
+from app.core.session import session_store
+from app.core import metrics
+from app.services.storage import layout
+
+logger = logging.getLogger(__name__)
+
+# Object keys are {user_id}/{session_id}/{name}: session ids are main service file ids, or uuid4 hex for
+# tus partial uploads, which are all named "partial"
+OBJECT_KEY = re.compile(r"[^/]+/(?P<session_id>\d+)/[^/]+|[^/]+/(?P<partial_id>[0-9a-f]{32})/partial")
+
+
+def _tree_size(path: str) -> int:
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    total = 0
+    for directory, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(directory, name))
+            except FileNotFoundError:
+                pass
+    return total
+
+
+def _scratch_entries() -> List[dict]:
+    """Per-session scratch paths with their last activity time, whichever backend left them"""
+    entries = []
+    for root, suffix, entry in layout.scratch_entries():
+        try:
+            # A directory's mtime moves whenever a chunk file is added, a part file's on every write
+            mtime = entry.stat().st_mtime
+        except FileNotFoundError:
+            continue
+        entries.append({
+            "session_id": entry.name[:-len(suffix)] if suffix else entry.name,
+            "path": entry.path,
+            "root": root,
+            "mtime": mtime,
+        })
+    return entries
+
+
+def _disk_usage_percent(root: str) -> float:
+    usage = shutil.disk_usage(root)
+    return usage.used / usage.total * 100 if usage.total else 0.0
+
+
+class Janitor:
+    def __init__(self, storage):
+        self.storage = storage
+        self._task: Optional[asyncio.Task] = None
+        self.runs = 0
+        self.sessions_expired = 0
+        self.sessions_evicted = 0
+        self.uploads_aborted = 0
+        self.bytes_reclaimed = 0
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "runs": self.runs,
+            "sessions_expired": self.sessions_expired,
+            "sessions_evicted": self.sessions_evicted,
+            "uploads_aborted": self.uploads_aborted,
+            "bytes_reclaimed": self.bytes_reclaimed,
+        }
+
+    async def _reclaim(self, entry: dict) -> int:
+        size = await asyncio.to_thread(_tree_size, entry["path"])
+        # The backend's own cleanup also aborts an S3 multipart upload the session still holds
+        with metrics.CLEANUP_SECONDS.time():
+            await self.storage.cleanup_session(entry["session_id"])
+        await session_store.adelete(entry["session_id"])
+        # Left behind by a different backend than the active one (e.g. after a config change)
+        if os.path.exists(entry["path"]):
+            await asyncio.to_thread(_remove, entry["path"])
+        return size
+
+    async def sweep(self) -> dict:
+        now = time.time()
+        entries = await asyncio.to_thread(_scratch_entries)
+        expired = []
+        live = []
+        for entry in entries:
+            idle = now - entry["mtime"]
+            if idle < settings.JANITOR_MIN_IDLE_SECONDS:
+                continue
+            if idle > session_store.ttl_seconds or await session_store.aget(entry["session_id"]) is None:
+                expired.append(entry)
+            else:
+                live.append(entry)
+
+        reclaimed = 0
+        for entry in expired:
+            reclaimed += await self._reclaim(entry)
+        self.sessions_expired += len(expired)
+
+        # Oldest-idle first until every scratch filesystem is back under the high-water mark
+        evicted = 0
+        live.sort(key=lambda entry: entry["mtime"])
+        for entry in live:
+            usage = await asyncio.to_thread(_disk_usage_percent, entry["root"])
+            if usage <= settings.JANITOR_DISK_HIGH_WATER_PERCENT:
+                continue
+            logger.warning(
+                f"Scratch disk {entry['root']} at {usage:.1f}% (high-water mark "
+                f"{settings.JANITOR_DISK_HIGH_WATER_PERCENT}%), evicting session {entry['session_id']}"
+            )
+            reclaimed += await self._reclaim(entry)
+            evicted += 1
+        self.sessions_evicted += evicted
+
+        aborted = await self._abort_dangling_uploads(now)
+
+        self.runs += 1
+        self.bytes_reclaimed += reclaimed
+        result = {"expired": len(expired), "evicted": evicted, "aborted": aborted, "bytes_reclaimed": reclaimed}
+        if expired or evicted or aborted:
+            logger.info(
+                f"Janitor reclaimed {reclaimed/1024/1024:.2f}MB: {len(expired)} expired, "
+                f"{evicted} evicted, {aborted} multipart uploads aborted"
+            )
+        return result
+
+    async def _abort_dangling_uploads(self, now: float) -> int:
+        if not hasattr(self.storage, "list_multipart_uploads"):
+            return 0
+        aborted = 0
+        for upload in await self.storage.list_multipart_uploads(settings.JANITOR_MULTIPART_KEY_PREFIX):
+            if now - upload["Initiated"].timestamp() < settings.JANITOR_MIN_IDLE_SECONDS:
+                continue
+            match = OBJECT_KEY.fullmatch(upload["Key"])
+            if match is None:
+                # Not a key this service creates; the bucket may be shared
+                continue
+            # A live session points at its own upload id
+            session = await session_store.aget(match.group("session_id") or match.group("partial_id"))
+            if session and session.get("s3_upload_id") == upload["UploadId"]:
+                continue
+            await self.storage.abort_upload(upload["Key"], upload["UploadId"])
+            aborted += 1
+        self.uploads_aborted += aborted
+        return aborted
+
+    async def run_forever(self):
+        while True:
+            try:
+                await self.sweep()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Janitor sweep failed: {str(e)}")
+            await asyncio.sleep(settings.JANITOR_INTERVAL_SECONDS)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self.run_forever())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+def _remove(path: str):
+    if os.path.isdir(path):
+        shutil.rmtree(path, ignore_errors=True)
+    else:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
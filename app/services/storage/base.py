@@ -1,17 +1,65 @@
 from abc import ABC, abstractmethod
-from typing import Optional
+from typing import BinaryIO, Callable, List, Optional, Tuple, Union
+from .scheduler import IOSaturatedError, chunk_pool
 
 class BaseStorage(ABC):
+    # Backends that send a chunk somewhere that needs its digest up front (S3 Content-MD5) set this,
+    # and receive the digest as save_chunk's checksum argument instead of hashing while streaming
+    digest_before_write = False
+    # Backends whose clients upload chunks straight to the object store; the service learns about
+    # those chunks from the store when the upload is completed
+    direct_upload = False
+    # Smallest chunk allowed anywhere but at the end of a file (S3 part size limit); concatenation
+    # checks it before adopting anything
+    min_part_size = 0
+    # The I/O pool save_chunk runs on; the admission middleware refuses upload bodies while it is full
+    chunk_write_pool = chunk_pool
+
+    async def init_session(self, upload_session_id: str, object_key: str, file_size: Optional[int] = None) -> dict:
+        """Prepare backend state for a new upload session; returned fields are stored on the session."""
+        return {}
+
+    @abstractmethod
+    async def save_chunk(self, upload_session_id: str, chunk_index: int, chunk_file: BinaryIO, offset: Optional[int] = None, checksum: Optional[str] = None) -> str:
+        pass
+
+    async def save_chunks(self, upload_session_id: str, chunks: List[Tuple[int, BinaryIO, Optional[int]]]) -> List[Union[str, Exception]]:
+        """
+        Stores a batch of (chunk_index, file, offset) chunks; returns each chunk's save_chunk result or the
+        exception it failed with. Local backends override this to write the whole batch in one executor job.
+        """
+        results = []
+        for chunk_index, chunk_file, offset in chunks:
+            try:
+                results.append(await self.save_chunk(upload_session_id, chunk_index, chunk_file, offset))
+            except IOSaturatedError:
+                raise
+            except Exception as e:
+                results.append(e)
+        return results
+
+    async def discard_chunk(self, upload_session_id: str, chunk_index: int) -> None:
+        """Drops a chunk that failed verification; backends without per-chunk files have nothing to drop."""
+        pass
+
     @abstractmethod
-    async def save_chunk(self, upload_session_id: str, chunk_index: int, chunk_data: bytes) -> str:
+    async def adopt_chunks(self, source_session_id: str, target_session_id: str, first_chunk_index: int,
+                           chunk_count: int, target_offset: int, source_size: int) -> None:
+        """
+        Links or copies a finished session's chunks into another session as chunks first_chunk_index..
+        at byte target_offset; used to concatenate partial uploads. The source must stay adoptable
+        afterwards, so a concatenation that fails later can be retried; its cleanup_session releases it.
+        """
         pass
 
     @abstractmethod
-    async def merge_chunks(self, upload_session_id: str, total_chunks: int, merged_file_path: str) -> str:
+    async def merge_chunks(self, upload_session_id: str, total_chunks: int, merged_file_path: str, progress: Optional[Callable[[int], None]] = None) -> str:
+        """progress, if given, is called from a worker thread with the number of bytes just merged."""
         pass
 
     @abstractmethod
-    async def upload_file(self, file_path: str, s3_key: str) -> str:
+    async def upload_file(self, file_path: str, s3_key: str, progress: Optional[Callable[[int], None]] = None) -> str:
+        """progress, if given, is called from a worker thread with the number of bytes just uploaded."""
         pass
 
     @abstractmethod
@@ -0,0 +1,198 @@
+"""
+When written data is fsynced (DURABILITY_MODE).
+
+- none: never; a crash can lose chunks the client was told were stored and files already completed.
+- on-complete (default): chunks are left to the page cache, but a completed file is fsynced, and so is
+  the directory it is moved into, before it is recorded in the catalog. A crash mid-upload can lose
+  acknowledged chunks; the client re-sends what GET /files/{file_id}/status reports as missing.
+- per-chunk: every chunk write, and the new directory entries it creates, is fsynced before the chunk
+  is acknowledged, plus everything on-complete does.
+- group-commit: like per-chunk, but writes arriving within DURABILITY_GROUP_COMMIT_WINDOW_MS of each
+  other are synced together by one thread. A descriptor written by several chunks (the offset mode's
+  partial file) or a directory that gained several chunks is synced once for the whole group, and
+  every writer in the group is acknowledged when the group is durable. A group closes early once
+  every chunk worker thread has joined it, since nobody else can. It pays off with many concurrent
+  uploads; a single upload stream waits out the window on every chunk.
+
+S3 staged mode has nothing to sync on completion: the merged file only exists to be uploaded.
+"""
+import os
+import time
+import logging
+import threading
+from typing import Callable, Dict, Hashable, Iterable, Optional
+from app.core import metrics
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+NONE = "none"
+ON_COMPLETE = "on-complete"
+PER_CHUNK = "per-chunk"
+GROUP_COMMIT = "group-commit"
+MODES = (NONE, ON_COMPLETE, PER_CHUNK, GROUP_COMMIT)
+
+# fdatasync skips metadata such as mtime that isn't needed to read the data back
+_datasync = getattr(os, "fdatasync", os.fsync)
+
+
+def syncs_chunks() -> bool:
+    return settings.DURABILITY_MODE in (PER_CHUNK, GROUP_COMMIT)
+
+
+def syncs_completion() -> bool:
+    return settings.DURABILITY_MODE != NONE
+
+
+def fsync_dir(path: str) -> None:
+    fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def fsync_parents(path: str, root: str) -> None:
+    """fsyncs every directory from path's parent up to root, so newly created entries on the way survive"""
+    directory = os.path.dirname(path)
+    root = os.path.abspath(root)
+    while True:
+        fsync_dir(directory)
+        if os.path.abspath(directory) == root or os.path.dirname(directory) == directory:
+            return
+        directory = os.path.dirname(directory)
+
+
+class _Sync:
+    """One descriptor or directory to sync for a group, done by the writer that brought it first"""
+    __slots__ = ("run", "error", "done")
+
+    def __init__(self, run: Callable[[], None]):
+        self.run = run
+        self.error: Optional[OSError] = None
+        self.done = threading.Event()
+
+
+class _Group:
+    __slots__ = ("writers", "syncs", "closed")
+
+    def __init__(self):
+        self.writers = 0
+        self.syncs: Dict[Hashable, _Sync] = {}
+        self.closed = threading.Event()
+
+
+class GroupCommitter:
+    """
+    Batches fsyncs from concurrent writer threads. The first writer of a group waits out the window
+    (or until max_writers have joined) and closes it. Each descriptor or directory in the group is then
+    synced once, by the writer that brought it first, in parallel with the others; every writer waits
+    for all of its own. Writers arriving meanwhile start the next group.
+    """
+
+    def __init__(self, window_seconds: float, max_writers: int):
+        self.window_seconds = window_seconds
+        self.max_writers = max_writers
+        self._lock = threading.Lock()
+        self._joined = threading.Condition(self._lock)
+        self._group: Optional[_Group] = None
+        self.groups = 0
+        self.writes = 0
+        self.syncs = 0
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            return {
+                "groups": self.groups,
+                "writes": self.writes,
+                "syncs": self.syncs,
+                "writes_per_group": self.writes / self.groups if self.groups else 0.0,
+            }
+
+    def commit(self, fds: Iterable[int], dirs: Dict[Hashable, Callable[[], None]]) -> None:
+        wanted = {fd: (lambda fd=fd: _datasync(fd)) for fd in fds}
+        wanted.update(dirs)
+        owned = []
+        with self._lock:
+            group = self._group
+            leader = group is None
+            if leader:
+                group = self._group = _Group()
+            for key, run in wanted.items():
+                if key not in group.syncs:
+                    group.syncs[key] = _Sync(run)
+                    owned.append(group.syncs[key])
+                    self.syncs += 1
+            mine = [group.syncs[key] for key in wanted]
+            group.writers += 1
+            self.writes += 1
+            if group.writers >= self.max_writers:
+                self._joined.notify()
+
+            if leader:
+                deadline = time.monotonic() + self.window_seconds
+                while group.writers < self.max_writers:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._joined.wait(remaining)
+                self._group = None
+                self.groups += 1
+
+        if leader:
+            group.closed.set()
+        else:
+            # Nothing may be synced before the group closes: a later writer's data could be missed
+            group.closed.wait()
+
+        with metrics.FSYNC_SECONDS.time():
+            for sync in owned:
+                try:
+                    sync.run()
+                except OSError as e:
+                    logger.error(f"Group commit fsync failed: {str(e)}")
+                    sync.error = e
+                finally:
+                    sync.done.set()
+        for sync in mine:
+            sync.done.wait()
+            if sync.error is not None:
+                raise sync.error
+
+
+# Only the chunk pool's threads write chunks, so a group can't grow past its size
+committer = GroupCommitter(settings.DURABILITY_GROUP_COMMIT_WINDOW_MS / 1000, settings.IO_CHUNK_WORKERS)
+
+
+def commit(fds: Iterable[int], dirs: Optional[Dict[Hashable, Callable[[], None]]] = None) -> None:
+    """
+    Makes the writes made through fds durable as DURABILITY_MODE requires, along with the directories
+    synced by the callables in dirs (keyed so a group syncs each directory once). Blocks until then;
+    the descriptors must stay open until it returns.
+    """
+    mode = settings.DURABILITY_MODE
+    if mode == PER_CHUNK:
+        with metrics.FSYNC_SECONDS.time():
+            for fd in fds:
+                _datasync(fd)
+            for sync in (dirs or {}).values():
+                sync()
+    elif mode == GROUP_COMMIT:
+        committer.commit(fds, dirs or {})
+
+
+def complete(path: str, root: str) -> None:
+    """fsyncs a completed file and the directories up to root that lead to it, unless DURABILITY_MODE is none"""
+    if not syncs_completion():
+        return
+    with metrics.FSYNC_SECONDS.time():
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        fsync_parents(path, root)
+
+
+def stats() -> dict:
+    return {"mode": settings.DURABILITY_MODE, "group_commit": committer.stats()}
@@ -1,7 +1,12 @@
 from app.core.config import settings
 from .s3 import S3Storage
+from .s3_multipart import S3MultipartStorage
+from .s3_presigned import S3PresignedStorage
 from .internal import InternalStorage
+from .internal_offset import InternalOffsetStorage
 from .base import BaseStorage
+from . import durability
+from . import merge
 
 _storage_instance = None
 
@@ -9,10 +14,28 @@ def get_storage() -> BaseStorage:
     global _storage_instance
     if _storage_instance is not None:
         return _storage_instance
+    if settings.DURABILITY_MODE not in durability.MODES:
+        raise ValueError(f"Unknown DURABILITY_MODE: {settings.DURABILITY_MODE}")
+    if settings.MERGE_STRATEGY != "auto" and settings.MERGE_STRATEGY not in merge.STRATEGIES:
+        raise ValueError(f"Unknown MERGE_STRATEGY: {settings.MERGE_STRATEGY}")
+    if settings.MERGE_STRATEGY != "auto" and settings.MERGE_STRATEGY not in merge.available_strategies():
+        raise ValueError(f"MERGE_STRATEGY {settings.MERGE_STRATEGY} is not available on this platform")
     if settings.STORAGE_BACKEND == "s3":
-        _storage_instance = S3Storage()
+        if settings.S3_UPLOAD_MODE == "multipart":
+            _storage_instance = S3MultipartStorage()
+        elif settings.S3_UPLOAD_MODE == "presigned":
+            _storage_instance = S3PresignedStorage()
+        elif settings.S3_UPLOAD_MODE == "staged":
+            _storage_instance = S3Storage()
+        else:
+            raise ValueError(f"Unknown S3_UPLOAD_MODE: {settings.S3_UPLOAD_MODE}")
     elif settings.STORAGE_BACKEND == "local":
-        _storage_instance = InternalStorage()
+        if settings.LOCAL_WRITE_MODE == "offset":
+            _storage_instance = InternalOffsetStorage()
+        elif settings.LOCAL_WRITE_MODE == "chunks":
+            _storage_instance = InternalStorage()
+        else:
+            raise ValueError(f"Unknown LOCAL_WRITE_MODE: {settings.LOCAL_WRITE_MODE}")
     else:
         raise ValueError(f"Unknown STORAGE_BACKEND: {settings.STORAGE_BACKEND}")
     return _storage_instance
@@ -0,0 +1,211 @@
+"""
+Open descriptors kept across a session's chunk writes.
+
+Writing a chunk used to cost a stat of the session directory, a makedirs, and an open and close by
+full path. Instead each session's chunk directory is opened once (O_DIRECTORY) and chunks are created
+relative to it with openat, and in offset mode the partial file stays open for pwrite. Descriptors
+live in a process-wide LRU capped at STORAGE_FD_CACHE_SIZE; the least recently used idle one is closed
+when the budget is reached. A descriptor in use by a chunk write is never closed under it: eviction
+only marks it and the last user closes it.
+
+Storage drops a session's descriptors whenever it removes, renames or moves the session's files.
+Another worker process can do that too (shared session store), so a cached directory whose path was
+removed is reopened on ENOENT, and with a shared store a cached partial file is checked against the
+path's inode before use.
+"""
+import os
+import logging
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Tuple
+from app.core.config import settings
+from . import layout
+from . import durability
+
+logger = logging.getLogger(__name__)
+
+DIR = "dir"
+PART = "part"
+
+
+class _Handle:
+    __slots__ = ("fd", "identity", "users", "evicted", "parents_synced")
+
+    def __init__(self, fd: int, identity: Tuple[int, int]):
+        self.fd = fd
+        self.identity = identity
+        self.users = 0
+        self.evicted = False
+        # Whether the directories leading to this one have been fsynced since it was opened
+        self.parents_synced = False
+
+
+class HandleCache:
+    def __init__(self, max_open: int):
+        self.max_open = max_open
+        # (kind, session id) -> handle, least recently used first
+        self._handles: "OrderedDict[Tuple[str, str], _Handle]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.stale = 0
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "open": len(self._handles),
+                "max_open": self.max_open,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "stale": self.stale,
+            }
+
+    def _acquire(self, key: Tuple[str, str], locate: Callable[[str], str], opener: Callable[[str], int],
+                 check_path: bool) -> _Handle:
+        """Returns the cached handle for key, opening it on a miss; pair with _release"""
+        with self._lock:
+            handle = self._handles.get(key)
+            if handle is not None:
+                self._handles.move_to_end(key)
+                handle.users += 1
+                self.hits += 1
+
+        if handle is not None and check_path and not _same_file(handle, locate(key[1])):
+            # Renamed or removed by another process since it was opened
+            self._release(handle)
+            self.drop(key[1], key[0])
+            with self._lock:
+                self.stale += 1
+            handle = None
+
+        if handle is None:
+            fd = opener(locate(key[1]))
+            stat_result = os.fstat(fd)
+            handle = _Handle(fd, (stat_result.st_dev, stat_result.st_ino))
+            handle.users = 1
+            to_close = []
+            with self._lock:
+                self.misses += 1
+                if self.max_open > 0 and key not in self._handles:
+                    self._handles[key] = handle
+                    to_close = self._evict()
+                else:
+                    # Caching disabled, or a concurrent write of the same session cached its own first
+                    handle.evicted = True
+            for fd_to_close in to_close:
+                os.close(fd_to_close)
+        return handle
+
+    def _evict(self) -> list:
+        """Called with the lock held; returns the descriptors that can be closed right away"""
+        to_close = []
+        for key in list(self._handles):
+            if len(self._handles) <= self.max_open:
+                break
+            handle = self._handles.pop(key)
+            handle.evicted = True
+            self.evictions += 1
+            if not handle.users:
+                to_close.append(handle.fd)
+        return to_close
+
+    def _release(self, handle: _Handle) -> None:
+        with self._lock:
+            handle.users -= 1
+            close = handle.evicted and not handle.users
+        if close:
+            os.close(handle.fd)
+
+    def chunk_opener(self, session_id: str) -> Callable[[str, int], int]:
+        """
+        An opener for open() creating files relative to the session's chunk directory, which is
+        created if missing: open(f"chunk_{i}", "wb", opener=handles.chunk_opener(session_id))
+        """
+        def opener(name: str, flags: int) -> int:
+            for attempt in range(2):
+                handle = self._acquire((DIR, session_id), layout.chunk_dir, _open_dir, check_path=False)
+                try:
+                    return os.open(name, flags, 0o644, dir_fd=handle.fd)
+                except FileNotFoundError:
+                    if attempt:
+                        raise
+                finally:
+                    self._release(handle)
+                # The directory was removed since it was opened; open it again
+                self.drop(session_id, DIR)
+                with self._lock:
+                    self.stale += 1
+        return opener
+
+    def sync_dir(self, session_id: str) -> None:
+        """fsyncs the session's chunk directory and, once per open, the directories leading to it"""
+        handle = self._acquire((DIR, session_id), layout.chunk_dir, _open_dir, check_path=False)
+        try:
+            os.fsync(handle.fd)
+            if not handle.parents_synced:
+                # The session directory may be new; its own entry lives in its parent
+                durability.fsync_parents(layout.chunk_dir(session_id), settings.LOCAL_TEMP_CHUNK_PATH)
+                handle.parents_synced = True
+        finally:
+            self._release(handle)
+
+    def commit(self, session_id: str, fds: List[int]) -> None:
+        """Makes chunk files written through fds, and their entries in the session's directory, durable"""
+        if durability.syncs_chunks():
+            durability.commit(fds, {(DIR, session_id): lambda: self.sync_dir(session_id)})
+
+    @contextmanager
+    def partial_file(self, session_id: str) -> Iterator[int]:
+        """Write descriptor of the session's partial file"""
+        # With the in-memory session store only this process touches the session's files
+        check = settings.SESSION_STORE_BACKEND != "memory"
+        handle = self._acquire((PART, session_id), layout.partial_path, _open_part, check_path=check)
+        try:
+            yield handle.fd
+        finally:
+            self._release(handle)
+
+    def drop(self, session_id: str, *kinds: str) -> None:
+        """Forgets the session's descriptors; call before removing or moving its files"""
+        to_close = []
+        with self._lock:
+            for kind in kinds or (DIR, PART):
+                handle = self._handles.pop((kind, session_id), None)
+                if handle is None:
+                    continue
+                handle.evicted = True
+                if not handle.users:
+                    to_close.append(handle.fd)
+        for fd in to_close:
+            os.close(fd)
+
+
+def _same_file(handle: _Handle, path: str) -> bool:
+    try:
+        stat_result = os.stat(path)
+    except FileNotFoundError:
+        return False
+    return (stat_result.st_dev, stat_result.st_ino) == handle.identity
+
+
+def _open_dir(path: str) -> int:
+    try:
+        return os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+    except FileNotFoundError:
+        os.makedirs(path, exist_ok=True)
+        return os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+    except NotADirectoryError:
+        # A stray file where the session directory belongs
+        os.remove(path)
+        os.makedirs(path, exist_ok=True)
+        return os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+
+
+def _open_part(path: str) -> int:
+    return os.open(path, os.O_WRONLY)
+
+
+handles = HandleCache(settings.STORAGE_FD_CACHE_SIZE)
@@ -1,61 +1,159 @@
 import os
+import errno
 import shutil
-import asyncio
 import logging
-import concurrent.futures
-from typing import Optional
+from typing import BinaryIO, Callable, List, Optional, Tuple, Union
 from .base import BaseStorage
+from .merge import merge_files
+from .scheduler import chunk_pool, merge_pool, IOSaturatedError
+from . import layout
+from . import durability
+from .handles import handles
 from app.core.config import settings
 
 logger = logging.getLogger(__name__)
 
-# ایجاد یک ThreadPoolExecutor برای عملیات I/O بلاکینگ
-thread_pool = concurrent.futures.ThreadPoolExecutor(max_workers=4)
+def write_chunk_file(upload_session_id: str, chunk_index: int, chunk_file: BinaryIO) -> str:
+    """Writes one chunk into the session's chunk directory, durable as DURABILITY_MODE requires; returns its path"""
+    chunk_name = f"chunk_{chunk_index}"
+    # فایل چانک نسبت به descriptor کش‌شده‌ی دایرکتوری session ساخته میشه (بدون stat و makedirs)
+    # کپی بلاک به بلاک تا کل چانک هیچوقت یکجا توی حافظه نباشه
+    with open(chunk_name, "wb", opener=handles.chunk_opener(upload_session_id)) as f:
+        shutil.copyfileobj(chunk_file, f, settings.CHUNK_IO_BUFFER_SIZE)
+        f.flush()
+        handles.commit(upload_session_id, [f.fileno()])
+    return os.path.join(layout.chunk_dir(upload_session_id), chunk_name)
+
+
+def write_chunk_files(upload_session_id: str, chunks: List[Tuple[int, BinaryIO, Optional[int]]]) -> List[Union[str, Exception]]:
+    """
+    Writes a batch of chunks into the session's chunk directory with a single durability commit for
+    the whole batch; returns each chunk's path or the error it failed with.
+    """
+    base_path = layout.chunk_dir(upload_session_id)
+    opener = handles.chunk_opener(upload_session_id)
+    results: List[Union[str, Exception]] = []
+    # Written files stay open until the commit, which syncs them through their descriptors
+    written = []
+    try:
+        for chunk_index, chunk_file, _ in chunks:
+            try:
+                f = open(f"chunk_{chunk_index}", "wb", opener=opener)
+            except OSError as e:
+                logger.error(f"Error saving chunk {chunk_index} for session {upload_session_id}: {str(e)}")
+                results.append(e)
+                continue
+            written.append(f)
+            try:
+                shutil.copyfileobj(chunk_file, f, settings.CHUNK_IO_BUFFER_SIZE)
+                f.flush()
+                results.append(os.path.join(base_path, f"chunk_{chunk_index}"))
+            except OSError as e:
+                logger.error(f"Error saving chunk {chunk_index} for session {upload_session_id}: {str(e)}")
+                results.append(e)
+        try:
+            handles.commit(upload_session_id, [f.fileno() for f in written])
+        except OSError as e:
+            # Nothing in the batch can be acknowledged as stored
+            logger.error(f"Error syncing a batch of chunks for session {upload_session_id}: {str(e)}")
+            results = [e if isinstance(result, str) else result for result in results]
+    finally:
+        for f in written:
+            f.close()
+    return results
+
+
+def _link_or_copy(source_path: str, target_path: str) -> None:
+    try:
+        os.link(source_path, target_path)
+    except OSError as e:
+        # Filesystems without hard links, or a chunk tree spanning devices
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+            raise
+        with open(source_path, "rb") as source, open(target_path, "wb") as target:
+            shutil.copyfileobj(source, target, settings.CHUNK_IO_BUFFER_SIZE)
+            target.flush()
+            durability.commit([target.fileno()])
+
+
+def link_chunk_files(source_session_id: str, target_session_id: str, first_chunk_index: int, chunk_count: int) -> None:
+    """
+    Links chunk_0..chunk_{n-1} of one session directory into another, renumbered from first_chunk_index.
+    The source keeps its chunks, so it can be adopted again if the target fails to complete.
+    """
+    source_dir = layout.chunk_dir(source_session_id)
+    target_dir = layout.chunk_dir(target_session_id)
+    os.makedirs(target_dir, exist_ok=True)
+    for i in range(chunk_count):
+        source_path = os.path.join(source_dir, f"chunk_{i}")
+        target_path = os.path.join(target_dir, f"chunk_{first_chunk_index + i}")
+        try:
+            _link_or_copy(source_path, target_path)
+        except FileExistsError:
+            # Left by an earlier attempt at the same concatenation
+            os.remove(target_path)
+            _link_or_copy(source_path, target_path)
+    if durability.syncs_chunks():
+        # The linked entries are acknowledged chunks of the target session now
+        handles.sync_dir(target_session_id)
+
+
+def move_file(source_path: str, target_path: str) -> None:
+    os.makedirs(os.path.dirname(target_path), exist_ok=True)
+    shutil.move(source_path, target_path)
+
 
 class InternalStorage(BaseStorage):
-    def _save_chunk_sync(self, upload_session_id: str, chunk_index: int, chunk_data: bytes) -> str:
+    def _save_chunk_sync(self, upload_session_id: str, chunk_index: int, chunk_file: BinaryIO) -> str:
         """ذخیره یک چانک به صورت سنکرون"""
         try:
-            base_path = os.path.join(settings.LOCAL_TEMP_CHUNK_PATH, str(upload_session_id))
-            
-            # چک کنیم که path یک فایل نباشه
-            if os.path.exists(base_path) and os.path.isfile(base_path):
-                os.remove(base_path)
-            
-            os.makedirs(base_path, exist_ok=True)
-            chunk_path = os.path.join(base_path, f"chunk_{chunk_index}")
-            
-            with open(chunk_path, "wb") as f:
-                f.write(chunk_data)
-            
-            logger.debug(f"Chunk saved successfully: {chunk_path} ({len(chunk_data)} bytes)")
+            chunk_path = write_chunk_file(str(upload_session_id), chunk_index, chunk_file)
+            logger.debug(f"Chunk saved successfully: {chunk_path}")
             return chunk_path
             
         except Exception as e:
             logger.error(f"Error saving chunk {chunk_index} for session {upload_session_id}: {str(e)}")
             raise
 
-    async def save_chunk(self, upload_session_id: str, chunk_index: int, chunk_data: bytes) -> str:
+    async def save_chunk(self, upload_session_id: str, chunk_index: int, chunk_file: BinaryIO, offset: Optional[int] = None, checksum: Optional[str] = None) -> str:
         """ذخیره یک چانک به صورت غیربلاکینگ"""
         try:
             logger.debug(f"Saving chunk {chunk_index} for session {upload_session_id}")
             
-            # استفاده از ThreadPoolExecutor برای اجرای عملیات I/O بلاکینگ
-            loop = asyncio.get_event_loop()
-            chunk_path = await loop.run_in_executor(
-                thread_pool,
-                self._save_chunk_sync,
-                upload_session_id,
-                chunk_index,
-                chunk_data
-            )
+            # نوشتن چانک روی pool مخصوص چانک‌ها؛ اگر صف پر باشه IOSaturatedError میده
+            chunk_path = await chunk_pool.run(self._save_chunk_sync, upload_session_id, chunk_index, chunk_file)
             
             return chunk_path
+        except IOSaturatedError:
+            raise
         except Exception as e:
             logger.error(f"Error in async save_chunk: {str(e)}")
             raise
 
-    def _merge_files_sync(self, base_path: str, total_chunks: int, merged_file_path: str) -> dict:
+    def _save_chunks_sync(self, upload_session_id: str, chunks: List[Tuple[int, BinaryIO, Optional[int]]]) -> List[Union[str, Exception]]:
+        """ذخیره چند چانک با یک descriptor دایرکتوری؛ خطای هر چانک جدا برگردونده میشه"""
+        results = write_chunk_files(str(upload_session_id), chunks)
+        logger.debug(f"Saved a batch of {len(chunks)} chunks for session {upload_session_id}")
+        return results
+
+    async def save_chunks(self, upload_session_id: str, chunks: List[Tuple[int, BinaryIO, Optional[int]]]) -> List[Union[str, Exception]]:
+        # کل batch توی یک job روی pool چانک‌ها نوشته میشه
+        return await chunk_pool.run(self._save_chunks_sync, upload_session_id, chunks)
+
+    def _discard_chunk_sync(self, upload_session_id: str, chunk_index: int) -> None:
+        chunk_path = os.path.join(layout.chunk_dir(str(upload_session_id)), f"chunk_{chunk_index}")
+        if os.path.exists(chunk_path):
+            os.remove(chunk_path)
+            logger.info(f"Discarded chunk {chunk_index} for session {upload_session_id}")
+
+    async def discard_chunk(self, upload_session_id: str, chunk_index: int) -> None:
+        await chunk_pool.run(self._discard_chunk_sync, upload_session_id, chunk_index, bounded=False)
+
+    async def adopt_chunks(self, source_session_id: str, target_session_id: str, first_chunk_index: int,
+                           chunk_count: int, target_offset: int, source_size: int) -> None:
+        await chunk_pool.run(link_chunk_files, source_session_id, target_session_id, first_chunk_index, chunk_count)
+
+    def _merge_files_sync(self, base_path: str, total_chunks: int, merged_file_path: str, progress: Optional[Callable[[int], None]] = None) -> dict:
         """ادغام چانک‌ها به یک فایل نهایی به صورت سنکرون"""
         try:
             # ایجاد directory برای merged file
@@ -63,40 +161,24 @@ class InternalStorage(BaseStorage):
             os.makedirs(merged_dir, exist_ok=True)
             
             logger.info(f"Starting merge of {total_chunks} chunks from {base_path} to {merged_file_path}")
-            total_size = 0
-            chunks_merged = 0
             
-            with open(merged_file_path, "wb") as merged:
-                for i in range(total_chunks):
-                    chunk_path = os.path.join(base_path, f"chunk_{i}")
-                    
-                    if not os.path.exists(chunk_path):
-                        logger.warning(f"Chunk file not found: {chunk_path}")
-                        continue
-                    
-                    chunk_size = os.path.getsize(chunk_path)
-                    logger.debug(f"Processing chunk {i+1}/{total_chunks}: {chunk_path} ({chunk_size} bytes)")
-                    
-                    with open(chunk_path, "rb") as chunk_file:
-                        chunk_data = chunk_file.read()
-                        merged.write(chunk_data)
-                        total_size += len(chunk_data)
-                        chunks_merged += 1
-                    
-                    logger.debug(f"Chunk {i+1} merged successfully")
+            # Completeness was checked against the session's chunk map; a chunk missing on disk anyway
+            # fails the merge when it is opened instead of being stat'ed here first
+            chunk_paths = [os.path.join(base_path, f"chunk_{i}") for i in range(total_chunks)]
+            
+            # کپی داده‌ها سمت کرنل انجام میشه و از حافظه پایتون عبور نمیکنه
+            stats = merge_files(chunk_paths, merged_file_path, progress=progress)
             
             logger.info(
                 f"Merge completed:\n"
-                f"- Chunks merged: {chunks_merged}/{total_chunks}\n"
-                f"- Total size: {total_size/1024/1024:.2f}MB\n"
+                f"- Chunks merged: {stats['chunks_merged']}/{total_chunks}\n"
+                f"- Total size: {stats['total_size']/1024/1024:.2f}MB\n"
+                f"- Throughput: {stats['throughput_mb_s']:.1f}MB/s ({stats['strategy']})\n"
                 f"- Output file: {merged_file_path}"
             )
             
-            return {
-                "chunks_merged": chunks_merged,
-                "total_size": total_size,
-                "success": chunks_merged == total_chunks
-            }
+            stats["success"] = stats["chunks_merged"] == total_chunks
+            return stats
             
         except Exception as e:
             logger.error(f"Error merging chunks: {str(e)}")
@@ -109,50 +191,37 @@ class InternalStorage(BaseStorage):
                     pass
             raise
 
-    async def merge_chunks(self, upload_session_id: str, total_chunks: int, merged_file_path: str) -> str:
+    async def merge_chunks(self, upload_session_id: str, total_chunks: int, merged_file_path: str, progress: Optional[Callable[[int], None]] = None) -> str:
         """ادغام چانک‌ها به یک فایل نهایی به صورت غیربلاکینگ"""
         try:
-            base_path = os.path.join(settings.LOCAL_TEMP_CHUNK_PATH, upload_session_id)
+            base_path = layout.chunk_dir(upload_session_id)
             
-            # استفاده از ThreadPoolExecutor برای اجرای عملیات I/O بلاکینگ
-            loop = asyncio.get_event_loop()
-            result = await loop.run_in_executor(
-                thread_pool,
+            # ادغام روی pool جداگانه تا merge های سنگین جلوی نوشتن چانک‌ها رو نگیرن
+            # merge_files returns after its last write and a missing chunk fails the merge, so there is
+            # nothing to wait for; the file is fsynced once it is in its final place (durability.complete)
+            await merge_pool.run(
                 self._merge_files_sync,
                 base_path,
                 total_chunks,
-                merged_file_path
+                merged_file_path,
+                progress
             )
             
-            # اطمینان از اینکه فایل به طور کامل نوشته شده است
-            if result.get("success", False):
-                # اضافه کردن تأخیر کوتاه برای اطمینان از اتمام عملیات I/O
-                await asyncio.sleep(0.1)
-                
-                # بررسی مجدد فایل
-                if os.path.exists(merged_file_path):
-                    file_size = os.path.getsize(merged_file_path)
-                    logger.info(f"Final file size verification: {file_size/1024/1024:.2f}MB")
-                else:
-                    logger.error(f"Final file does not exist after merge: {merged_file_path}")
-                    raise FileNotFoundError(f"Merged file not created: {merged_file_path}")
-            
             return merged_file_path
         except Exception as e:
             logger.error(f"Error in async merge_chunks: {str(e)}")
             raise
 
-    async def upload_file(self, file_path: str, s3_key: str) -> str:
+    async def upload_file(self, file_path: str, s3_key: str, progress: Optional[Callable[[int], None]] = None) -> str:
         # For local, just move/rename the file to a final location
-        final_path = os.path.join(settings.PERSISTENT_LOCAL_STORAGE_PATH, "final", s3_key)
-        final_dir = os.path.dirname(final_path)
-        await asyncio.to_thread(os.makedirs, final_dir, exist_ok=True)
-        await asyncio.to_thread(shutil.move, file_path, final_path)
+        user_id, file_id, file_name = s3_key.split("/", 2)
+        final_path = os.path.join(layout.final_dir(user_id, file_id), file_name)
+        await merge_pool.run(move_file, file_path, final_path, bounded=False)
         return final_path
 
     async def delete_file(self, file_path_or_key: str, storage_type: Optional[str] = None) -> None:
         # file_path_or_key is a local path
-        await asyncio.to_thread(self._delete_file, file_path_or_key)
+        await chunk_pool.run(self._delete_file, file_path_or_key, bounded=False)
 
     def _delete_file(self, file_path):
         if os.path.exists(file_path):
@@ -161,7 +230,8 @@ class InternalStorage(BaseStorage):
     def _cleanup_session_sync(self, upload_session_id: str) -> dict:
         """پاکسازی دایرکتوری چانک‌ها به صورت سنکرون"""
         try:
-            base_path = os.path.join(settings.LOCAL_TEMP_CHUNK_PATH, upload_session_id)
+            handles.drop(upload_session_id)
+            base_path = layout.chunk_dir(upload_session_id)
             
             if os.path.exists(base_path):
                 files = os.listdir(base_path)
@@ -193,13 +263,7 @@ class InternalStorage(BaseStorage):
     async def cleanup_session(self, upload_session_id: str) -> None:
         """پاکسازی دایرکتوری چانک‌ها به صورت غیربلاکینگ"""
         try:
-            # استفاده از ThreadPoolExecutor برای اجرای عملیات I/O بلاکینگ
-            loop = asyncio.get_event_loop()
-            result = await loop.run_in_executor(
-                thread_pool,
-                self._cleanup_session_sync,
-                upload_session_id
-            )
+            result = await chunk_pool.run(self._cleanup_session_sync, upload_session_id, bounded=False)
             
             return result
         except Exception as e:
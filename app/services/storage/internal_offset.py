@@ -0,0 +1,140 @@
+import os
+import logging
+from typing import BinaryIO, Callable, List, Optional, Tuple, Union
+from .internal import InternalStorage
+from .scheduler import chunk_pool, merge_pool
+from .merge import copy_into
+from . import layout
+from . import durability
+from .handles import handles
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+
+class InternalOffsetStorage(InternalStorage):
+    """
+    Local backend that writes every chunk at its byte offset into a single partial file.
+    The partial file lives under PERSISTENT_LOCAL_STORAGE_PATH so completing an upload is an
+    fsync plus an atomic rename instead of re-reading and rewriting all chunks.
+    """
+
+    def _part_path(self, upload_session_id: str) -> str:
+        return layout.partial_path(upload_session_id)
+
+    def _create_part_file_sync(self, upload_session_id: str, file_size: Optional[int]) -> str:
+        # A descriptor still cached from an earlier session with this id points at the old file
+        handles.drop(upload_session_id)
+        part_path = self._part_path(upload_session_id)
+        os.makedirs(os.path.dirname(part_path), exist_ok=True)
+        fd = os.open(part_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            if file_size:
+                try:
+                    # رزرو فضای دیسک از همون اول تا فایل تکه تکه نشه
+                    os.posix_fallocate(fd, 0, file_size)
+                except OSError:
+                    # Filesystem without fallocate support: fall back to a sparse file
+                    os.ftruncate(fd, file_size)
+        finally:
+            os.close(fd)
+        if durability.syncs_chunks():
+            # Chunks acknowledged later are only durable if the file they went into is
+            durability.fsync_parents(part_path, settings.PERSISTENT_LOCAL_STORAGE_PATH)
+        logger.debug(f"Partial file created: {part_path} ({file_size or 0} bytes reserved)")
+        return part_path
+
+    async def init_session(self, upload_session_id: str, object_key: str, file_size: Optional[int] = None) -> dict:
+        await chunk_pool.run(self._create_part_file_sync, upload_session_id, file_size)
+        return {}
+
+    @staticmethod
+    def _pwrite_stream(fd: int, chunk_file: BinaryIO, offset: int) -> int:
+        position = offset
+        while True:
+            block = chunk_file.read(settings.CHUNK_IO_BUFFER_SIZE)
+            if not block:
+                break
+            view = memoryview(block)
+            while view:
+                written = os.pwrite(fd, view, position)
+                position += written
+                view = view[written:]
+        return position - offset
+
+    def _write_at_offset_sync(self, upload_session_id: str, chunk_file: BinaryIO, offset: int) -> str:
+        # The partial file stays open across the session's chunks
+        with handles.partial_file(upload_session_id) as fd:
+            written = self._pwrite_stream(fd, chunk_file, offset)
+            durability.commit([fd])
+        logger.debug(f"Wrote {written} bytes at offset {offset} into the partial file of {upload_session_id}")
+        return self._part_path(upload_session_id)
+
+    def _write_batch_sync(self, upload_session_id: str, chunks: List[Tuple[int, BinaryIO, Optional[int]]]) -> List[Union[str, Exception]]:
+        """Writes every chunk of a batch at its offset through the session's cached descriptor"""
+        part_path = self._part_path(upload_session_id)
+        results = []
+        with handles.partial_file(upload_session_id) as fd:
+            for chunk_index, chunk_file, offset in chunks:
+                if offset is None:
+                    results.append(ValueError(f"Chunk {chunk_index} has no offset, required when LOCAL_WRITE_MODE is 'offset'"))
+                    continue
+                try:
+                    self._pwrite_stream(fd, chunk_file, offset)
+                    results.append(part_path)
+                except OSError as e:
+                    logger.error(f"Error writing chunk {chunk_index} at offset {offset} into {part_path}: {str(e)}")
+                    results.append(e)
+            try:
+                # One sync of the partial file covers every chunk of the batch
+                durability.commit([fd])
+            except OSError as e:
+                logger.error(f"Error syncing a batch of chunks into {part_path}: {str(e)}")
+                results = [e if isinstance(result, str) else result for result in results]
+        return results
+
+    async def save_chunk(self, upload_session_id: str, chunk_index: int, chunk_file: BinaryIO, offset: Optional[int] = None, checksum: Optional[str] = None) -> str:
+        if offset is None:
+            raise ValueError("Content-Range header is required when LOCAL_WRITE_MODE is 'offset'")
+        return await chunk_pool.run(self._write_at_offset_sync, upload_session_id, chunk_file, offset)
+
+    async def save_chunks(self, upload_session_id: str, chunks: List[Tuple[int, BinaryIO, Optional[int]]]) -> List[Union[str, Exception]]:
+        return await chunk_pool.run(self._write_batch_sync, upload_session_id, chunks)
+
+    def _adopt_part_sync(self, source_session_id: str, target_session_id: str, target_offset: int, source_size: int) -> None:
+        # The source's partial file is left in place until its session is cleaned up
+        copy_into(self._part_path(source_session_id), self._part_path(target_session_id), source_size, target_offset)
+        if durability.syncs_chunks():
+            with handles.partial_file(target_session_id) as fd:
+                durability.commit([fd])
+
+    async def adopt_chunks(self, source_session_id: str, target_session_id: str, first_chunk_index: int,
+                           chunk_count: int, target_offset: int, source_size: int) -> None:
+        # The source's bytes are already contiguous, so they are copied kernel-side into place
+        if not source_size:
+            return
+        await merge_pool.run(self._adopt_part_sync, source_session_id, target_session_id, target_offset, source_size)
+
+    def _finalize_sync(self, upload_session_id: str, merged_file_path: str) -> int:
+        handles.drop(upload_session_id)
+        part_path = self._part_path(upload_session_id)
+        # The fsync happens once the file is in its final place (durability.complete)
+        file_size = os.stat(part_path).st_size
+        os.makedirs(os.path.dirname(merged_file_path), exist_ok=True)
+        os.replace(part_path, merged_file_path)
+        return file_size
+
+    async def merge_chunks(self, upload_session_id: str, total_chunks: int, merged_file_path: str, progress: Optional[Callable[[int], None]] = None) -> str:
+        """Chunks are already in place, so completing the file is a rename"""
+        file_size = await merge_pool.run(self._finalize_sync, upload_session_id, merged_file_path)
+        if progress is not None:
+            progress(file_size)
+        logger.info(f"Partial file finalized: {merged_file_path} ({file_size/1024/1024:.2f}MB)")
+        return merged_file_path
+
+    def _cleanup_session_sync(self, upload_session_id: str) -> dict:
+        part_path = self._part_path(upload_session_id)
+        if os.path.exists(part_path):
+            os.remove(part_path)
+            logger.info(f"Removed abandoned partial file: {part_path}")
+        return super()._cleanup_session_sync(upload_session_id)
@@ -0,0 +1,194 @@
+"""
+On-disk layout of chunk scratch directories, partial files and final files.
+
+STORAGE_SHARD_LEVELS=0 keeps the flat layout: one directory per session directly under
+LOCAL_TEMP_CHUNK_PATH and final/<user_id>/<file_id>/ under PERSISTENT_LOCAL_STORAGE_PATH. Above 0,
+every path gets that many directory levels named after the leading hex digits of an md5 of the
+session or user id (STORAGE_SHARD_WIDTH digits per level), so no directory holds more than a few
+thousand entries. With levels=2 and width=2:
+
+    LOCAL_TEMP_CHUNK_PATH/sessions/3f/a2/<session_id>/chunk_<n>
+    PERSISTENT_LOCAL_STORAGE_PATH/partial/3f/a2/<session_id>.part
+    PERSISTENT_LOCAL_STORAGE_PATH/merging/3f/a2/<session_id>/<file name>
+    PERSISTENT_LOCAL_STORAGE_PATH/files/9c/07/<user_id>/<file_id>/<file name>
+
+Sharded trees use their own roots, so they never mix with flat entries whose names could look
+like shard prefixes. Sessions started before sharding was switched on keep their flat scratch
+paths until they finish. Final files are moved into the sharded tree, online, with
+
+    python -m app.services.storage.layout migrate [--dry-run]
+
+Each final/<user_id>/<file_id> directory is renamed in one step and its catalog record repointed;
+downloads that looked the record up just before the move retry the lookup.
+"""
+import os
+import sys
+import hashlib
+import logging
+from typing import Iterator, List, Tuple
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+
+def _levels() -> int:
+    return settings.STORAGE_SHARD_LEVELS
+
+
+def shard(name: str) -> List[str]:
+    """Shard directory names for name, outermost first; empty in the flat layout"""
+    levels, width = _levels(), settings.STORAGE_SHARD_WIDTH
+    if not levels:
+        return []
+    digest = hashlib.md5(name.encode(), usedforsecurity=False).hexdigest()
+    return [digest[i * width:(i + 1) * width] for i in range(levels)]
+
+
+def chunk_dir(session_id: str) -> str:
+    legacy = os.path.join(settings.LOCAL_TEMP_CHUNK_PATH, session_id)
+    if not _levels():
+        return legacy
+    # A session that started in the flat layout finishes there
+    if os.path.isdir(legacy):
+        return legacy
+    return os.path.join(settings.LOCAL_TEMP_CHUNK_PATH, "sessions", *shard(session_id), session_id)
+
+
+def partial_path(session_id: str) -> str:
+    root = os.path.join(settings.PERSISTENT_LOCAL_STORAGE_PATH, "partial")
+    legacy = os.path.join(root, f"{session_id}.part")
+    if not _levels() or os.path.exists(legacy):
+        return legacy
+    return os.path.join(root, *shard(session_id), f"{session_id}.part")
+
+
+def merge_path(session_id: str, file_name: str) -> str:
+    """Where a session's chunks are assembled before the result is moved or uploaded"""
+    if not _levels():
+        return os.path.join(settings.PERSISTENT_LOCAL_STORAGE_PATH, session_id, file_name)
+    return os.path.join(settings.PERSISTENT_LOCAL_STORAGE_PATH, "merging", *shard(session_id), session_id, file_name)
+
+
+def legacy_final_dir(user_id: str, file_id) -> str:
+    return os.path.join(settings.PERSISTENT_LOCAL_STORAGE_PATH, "final", user_id, str(file_id))
+
+
+def final_dir(user_id: str, file_id) -> str:
+    """Directory new final files of (user_id, file_id) are written to"""
+    if not _levels():
+        return legacy_final_dir(user_id, file_id)
+    return os.path.join(settings.PERSISTENT_LOCAL_STORAGE_PATH, "files", *shard(user_id), user_id, str(file_id))
+
+
+def final_dirs(user_id: str, file_id) -> List[str]:
+    """Every directory a final file of (user_id, file_id) may be in, current layout first"""
+    dirs = [final_dir(user_id, file_id)]
+    legacy = legacy_final_dir(user_id, file_id)
+    if legacy not in dirs:
+        dirs.append(legacy)
+    return dirs
+
+
+def scan(root: str, depth: int) -> Iterator[os.DirEntry]:
+    """Entries `depth` directory levels below root"""
+    try:
+        entries = list(os.scandir(root))
+    except FileNotFoundError:
+        return
+    for entry in entries:
+        if not depth:
+            yield entry
+        elif entry.is_dir(follow_symlinks=False):
+            yield from scan(entry.path, depth - 1)
+
+
+def scratch_entries() -> Iterator[Tuple[str, str, os.DirEntry]]:
+    """(root, entry suffix, entry) for every per-session scratch entry, flat and sharded"""
+    sessions_root = os.path.join(settings.LOCAL_TEMP_CHUNK_PATH, "sessions")
+    partial_root = os.path.join(settings.PERSISTENT_LOCAL_STORAGE_PATH, "partial")
+    roots = [(settings.LOCAL_TEMP_CHUNK_PATH, "", 0), (partial_root, ".part", 0)]
+    if _levels():
+        roots += [(sessions_root, "", _levels()), (partial_root, ".part", _levels())]
+    for root, suffix, depth in roots:
+        for entry in scan(root, depth):
+            # The sharded tree's root sits among the flat session directories
+            if entry.path == sessions_root:
+                continue
+            # Shard directories of the partial tree are skipped here by the suffix
+            if suffix and not entry.name.endswith(suffix):
+                continue
+            yield root, suffix, entry
+
+
+def final_roots() -> List[Tuple[str, int]]:
+    """(root, shard depth) of the trees holding <user_id>/<file_id>/<file> final files"""
+    roots = [(os.path.join(settings.PERSISTENT_LOCAL_STORAGE_PATH, "final"), 0)]
+    if _levels():
+        roots.append((os.path.join(settings.PERSISTENT_LOCAL_STORAGE_PATH, "files"), _levels()))
+    return roots
+
+
+def _storage_key(path: str) -> str:
+    return os.path.relpath(path, settings.PERSISTENT_LOCAL_STORAGE_PATH)
+
+
+def migrate(catalog, dry_run: bool = False) -> dict:
+    """
+    Moves every legacy final/<user_id>/<file_id> directory into the sharded tree and repoints its
+    catalog record. Safe to run while the service is up and to re-run after an interruption.
+    Between the rename and the record update the catalog names the old place; downloads that miss
+    the file there search final_dirs() instead.
+    """
+    if not _levels():
+        raise ValueError("STORAGE_SHARD_LEVELS is 0, there is no sharded layout to migrate to")
+    stats = {"moved": 0, "records_updated": 0, "conflicts": 0}
+    legacy_root = os.path.join(settings.PERSISTENT_LOCAL_STORAGE_PATH, "final")
+    for user_entry in scan(legacy_root, 0):
+        if not user_entry.is_dir(follow_symlinks=False):
+            continue
+        for file_entry in scan(user_entry.path, 0):
+            if not file_entry.is_dir(follow_symlinks=False):
+                continue
+            user_id, file_id = user_entry.name, file_entry.name
+            target = final_dir(user_id, file_id)
+            if os.path.exists(target):
+                # Uploaded again after sharding was enabled; the sharded copy is the current one
+                logger.warning(f"Not migrating {file_entry.path}: {target} already exists")
+                stats["conflicts"] += 1
+                continue
+            if dry_run:
+                logger.info(f"Would move {file_entry.path} -> {target}")
+                stats["moved"] += 1
+                continue
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            # Same filesystem, so the whole directory moves atomically
+            os.rename(file_entry.path, target)
+            stats["moved"] += 1
+            record = catalog.get(user_id, file_id)
+            legacy_prefix = _storage_key(file_entry.path) + os.sep
+            if record is not None and record["storage_key"].startswith(legacy_prefix):
+                record["storage_key"] = _storage_key(os.path.join(target, record["storage_key"][len(legacy_prefix):]))
+                catalog.add(record)
+                stats["records_updated"] += 1
+        if not dry_run:
+            try:
+                os.rmdir(user_entry.path)
+            except OSError:
+                # Still holds a conflicting entry
+                pass
+    logger.info(f"Layout migration {'dry run ' if dry_run else ''}finished: {stats}")
+    return stats
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    args = sys.argv[1:]
+    if args not in (["migrate"], ["migrate", "--dry-run"]):
+        print("usage: python -m app.services.storage.layout migrate [--dry-run]", file=sys.stderr)
+        sys.exit(2)
+    from app.services.catalog import get_catalog
+    try:
+        migrate(get_catalog(), dry_run="--dry-run" in args)
+    except ValueError as e:
+        print(str(e), file=sys.stderr)
+        sys.exit(1)
@@ -0,0 +1,230 @@
+import os
+import time
+import errno
+import logging
+import threading
+import concurrent.futures
+from typing import Callable, List, Optional
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+# Errors that mean "this copy primitive is not usable for these two files", not a real I/O failure
+_FALLBACK_ERRNOS = {errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP}
+
+# Strategies in order of preference; the first one that works is kept for the rest of the merge
+STRATEGIES = ("copy_file_range", "sendfile", "readinto")
+
+# One copy buffer per pool thread, allocated on first use of the userspace fallback and then reused
+_local = threading.local()
+
+# Parallel merges copy ranges on their own pool so they never starve chunk writes on the storage pool
+_merge_pool: Optional[concurrent.futures.ThreadPoolExecutor] = None
+_merge_pool_lock = threading.Lock()
+
+
+def _get_merge_pool() -> concurrent.futures.ThreadPoolExecutor:
+    global _merge_pool
+    if _merge_pool is None:
+        with _merge_pool_lock:
+            if _merge_pool is None:
+                _merge_pool = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=settings.MERGE_PARALLELISM, thread_name_prefix="merge"
+                )
+    return _merge_pool
+
+
+def _get_buffer() -> memoryview:
+    view = getattr(_local, "view", None)
+    if view is None or len(view) != settings.MERGE_BUFFER_SIZE:
+        view = memoryview(bytearray(settings.MERGE_BUFFER_SIZE))
+        _local.view = view
+    return view
+
+
+def available_strategies() -> List[str]:
+    """Strategies this platform's os module provides; readinto works everywhere"""
+    return [strategy for strategy in STRATEGIES if strategy == "readinto" or hasattr(os, strategy)]
+
+
+def _initial_strategy() -> str:
+    if settings.MERGE_STRATEGY != "auto":
+        return settings.MERGE_STRATEGY
+    if hasattr(os, "copy_file_range"):
+        return "copy_file_range"
+    if hasattr(os, "sendfile"):
+        return "sendfile"
+    return "readinto"
+
+
+def _copy_with_buffer(src_fd: int, dst_fd: int, count: int, src_offset: int, dst_offset: int) -> None:
+    view = _get_buffer()
+    remaining = count
+    while remaining:
+        n = os.preadv(src_fd, [view[:min(remaining, len(view))]], src_offset)
+        if n == 0:
+            raise IOError(f"Unexpected end of file after {count - remaining} of {count} bytes")
+        block = view[:n]
+        while block:
+            written = os.pwrite(dst_fd, block, dst_offset)
+            dst_offset += written
+            block = block[written:]
+        src_offset += n
+        remaining -= n
+
+
+def copy_range(src_fd: int, dst_fd: int, count: int, src_offset: int, dst_offset: int, strategy: str) -> str:
+    """
+    Copies count bytes from src_fd[src_offset:] to dst_fd[dst_offset:] and returns the strategy that did it.
+    Kernel-side primitives are tried first; a primitive that the filesystem rejects falls through to the next one.
+    """
+    copied = 0
+    if strategy == "copy_file_range":
+        try:
+            while copied < count:
+                n = os.copy_file_range(src_fd, dst_fd, count - copied, src_offset + copied, dst_offset + copied)
+                if n == 0:
+                    raise IOError(f"Unexpected end of file after {copied} of {count} bytes")
+                copied += n
+            return strategy
+        except OSError as e:
+            if e.errno not in _FALLBACK_ERRNOS:
+                raise
+            strategy = "sendfile"
+    if strategy == "sendfile":
+        try:
+            # sendfile writes at the destination's file position, so pin it first
+            os.lseek(dst_fd, dst_offset + copied, os.SEEK_SET)
+            while copied < count:
+                n = os.sendfile(dst_fd, src_fd, src_offset + copied, count - copied)
+                if n == 0:
+                    raise IOError(f"Unexpected end of file after {copied} of {count} bytes")
+                copied += n
+            return strategy
+        except OSError as e:
+            if e.errno not in _FALLBACK_ERRNOS:
+                raise
+            strategy = "readinto"
+    _copy_with_buffer(src_fd, dst_fd, count - copied, src_offset + copied, dst_offset + copied)
+    return "readinto"
+
+
+def _preallocate(fd: int, size: int) -> None:
+    if not size:
+        return
+    try:
+        os.posix_fallocate(fd, 0, size)
+    except (AttributeError, OSError):
+        os.ftruncate(fd, size)
+
+
+def _copy_chunk(chunk_path: str, merged_file_path: str, size: int, dst_offset: int, strategy: str) -> str:
+    # Each range gets its own destination fd: sendfile moves the file position, which would race on a shared fd
+    src_fd = os.open(chunk_path, os.O_RDONLY)
+    try:
+        dst_fd = os.open(merged_file_path, os.O_WRONLY)
+        try:
+            return copy_range(src_fd, dst_fd, size, 0, dst_offset, strategy)
+        finally:
+            os.close(dst_fd)
+    finally:
+        os.close(src_fd)
+
+
+def copy_into(src_path: str, dst_path: str, count: int, dst_offset: int) -> str:
+    """Copies the first count bytes of src_path into the existing file dst_path at dst_offset"""
+    return _copy_chunk(src_path, dst_path, count, dst_offset, _initial_strategy())
+
+
+def _merge_serial(chunk_paths: List[str], merged_file_path: str, strategy: str, progress: Optional[Callable[[int], None]]) -> tuple:
+    strategies_used = set()
+    total_size = 0
+    dst_fd = os.open(merged_file_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        for chunk_path in chunk_paths:
+            src_fd = os.open(chunk_path, os.O_RDONLY)
+            try:
+                chunk_size = os.fstat(src_fd).st_size
+                if chunk_size:
+                    strategy = copy_range(src_fd, dst_fd, chunk_size, 0, total_size, strategy)
+                    strategies_used.add(strategy)
+                total_size += chunk_size
+                if progress is not None:
+                    progress(chunk_size)
+            finally:
+                os.close(src_fd)
+    finally:
+        os.close(dst_fd)
+    return total_size, strategies_used
+
+
+def _merge_parallel(chunk_paths: List[str], merged_file_path: str, strategy: str, progress: Optional[Callable[[int], None]]) -> tuple:
+    # Every chunk's place in the output is known up front from the chunk sizes
+    sizes = [os.stat(chunk_path).st_size for chunk_path in chunk_paths]
+    offsets = []
+    total_size = 0
+    for size in sizes:
+        offsets.append(total_size)
+        total_size += size
+
+    dst_fd = os.open(merged_file_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        _preallocate(dst_fd, total_size)
+    finally:
+        os.close(dst_fd)
+
+    pool = _get_merge_pool()
+    futures = {
+        pool.submit(_copy_chunk, chunk_path, merged_file_path, size, offset, strategy): size
+        for chunk_path, size, offset in zip(chunk_paths, sizes, offsets)
+        if size
+    }
+    strategies_used = set()
+    try:
+        for future in concurrent.futures.as_completed(futures):
+            strategies_used.add(future.result())
+            if progress is not None:
+                progress(futures[future])
+    except BaseException:
+        for future in futures:
+            future.cancel()
+        concurrent.futures.wait(futures)
+        raise
+    return total_size, strategies_used
+
+
+def merge_files(chunk_paths: List[str], merged_file_path: str, parallelism: Optional[int] = None,
+                progress: Optional[Callable[[int], None]] = None) -> dict:
+    """
+    Concatenates chunk_paths into merged_file_path without pulling chunk data through Python objects.
+    With parallelism > 1 the output is preallocated and chunks are copied to their offsets concurrently
+    on the merge pool. progress, if given, is called with each chunk's size once it has been copied.
+    Returns merge statistics including the strategy used and the achieved throughput.
+    """
+    started = time.perf_counter()
+    strategy = _initial_strategy()
+    if parallelism is None:
+        parallelism = settings.MERGE_PARALLELISM
+
+    if parallelism > 1 and len(chunk_paths) > 1:
+        total_size, strategies_used = _merge_parallel(chunk_paths, merged_file_path, strategy, progress)
+    else:
+        parallelism = 1
+        total_size, strategies_used = _merge_serial(chunk_paths, merged_file_path, strategy, progress)
+
+    seconds = time.perf_counter() - started
+    throughput = total_size / 1024 / 1024 / seconds if seconds > 0 else 0.0
+    stats = {
+        "chunks_merged": len(chunk_paths),
+        "total_size": total_size,
+        "seconds": seconds,
+        "throughput_mb_s": throughput,
+        "strategy": "+".join(s for s in STRATEGIES if s in strategies_used) or strategy,
+        "parallelism": parallelism,
+    }
+    logger.info(
+        f"Merged {len(chunk_paths)} chunks into {merged_file_path}: "
+        f"{total_size/1024/1024:.2f}MB in {seconds:.3f}s "
+        f"({throughput:.1f}MB/s, {stats['strategy']}, parallelism {parallelism})"
+    )
+    return stats
@@ -1,69 +1,117 @@
 import os
 import shutil
-import asyncio
-import boto3
-from typing import Optional
+import logging
+from typing import BinaryIO, Callable, List, Optional, Tuple, Union
 from .base import BaseStorage
+from .merge import merge_files
+from .internal import link_chunk_files, write_chunk_file, write_chunk_files
+from .scheduler import chunk_pool, merge_pool, s3_pool
+from . import layout
+from .handles import handles
+from .s3_client import get_s3_client, transfer_config, DELETE_BATCH_SIZE
 from app.core.config import settings
 from botocore.exceptions import BotoCoreError, ClientError
 
+logger = logging.getLogger(__name__)
+
 class S3Storage(BaseStorage):
     def __init__(self):
-        self.s3_client = boto3.client(
-            's3',
-            aws_access_key_id=settings.S3_ACCESS_KEY,
-            aws_secret_access_key=settings.S3_SECRET_KEY,
-            endpoint_url=settings.S3_ENDPOINT_URL,
-            region_name=settings.S3_REGION_NAME
-        )
-
-    async def save_chunk(self, upload_session_id: str, chunk_index: int, chunk_data: bytes) -> str:
-        base_path = os.path.join(settings.LOCAL_TEMP_CHUNK_PATH, upload_session_id)
-        await asyncio.to_thread(os.makedirs, base_path, True)
-        chunk_path = os.path.join(base_path, f"chunk_{chunk_index}")
-        await asyncio.to_thread(self._write_file, chunk_path, chunk_data)
-        return chunk_path
-
-    def _write_file(self, path, data):
-        with open(path, "wb") as f:
-            f.write(data)
-
-    async def merge_chunks(self, upload_session_id: str, total_chunks: int, merged_file_path: str) -> str:
-        base_path = os.path.join(settings.LOCAL_TEMP_CHUNK_PATH, upload_session_id)
-        await asyncio.to_thread(self._merge_files, base_path, total_chunks, merged_file_path)
+        self.s3_client = get_s3_client()
+
+    async def save_chunk(self, upload_session_id: str, chunk_index: int, chunk_file: BinaryIO, offset: Optional[int] = None, checksum: Optional[str] = None) -> str:
+        # Staged chunks are written exactly like the local backend's, path lookup included, in a single job
+        return await chunk_pool.run(write_chunk_file, upload_session_id, chunk_index, chunk_file)
+
+    async def save_chunks(self, upload_session_id: str, chunks: List[Tuple[int, BinaryIO, Optional[int]]]) -> List[Union[str, Exception]]:
+        # Staged chunks are local files, so a whole batch is written in one job
+        return await chunk_pool.run(write_chunk_files, upload_session_id, chunks)
+
+    async def discard_chunk(self, upload_session_id: str, chunk_index: int) -> None:
+        chunk_path = os.path.join(layout.chunk_dir(upload_session_id), f"chunk_{chunk_index}")
+        await chunk_pool.run(self._delete_file, chunk_path, bounded=False)
+
+    def _delete_file(self, path):
+        if os.path.exists(path):
+            os.remove(path)
+
+    async def adopt_chunks(self, source_session_id: str, target_session_id: str, first_chunk_index: int,
+                           chunk_count: int, target_offset: int, source_size: int) -> None:
+        # Staged chunks live on local disk with the same layout as the local backend
+        await chunk_pool.run(link_chunk_files, source_session_id, target_session_id, first_chunk_index, chunk_count)
+
+    async def merge_chunks(self, upload_session_id: str, total_chunks: int, merged_file_path: str, progress: Optional[Callable[[int], None]] = None) -> str:
+        base_path = layout.chunk_dir(upload_session_id)
+        await merge_pool.run(self._merge_files, base_path, total_chunks, merged_file_path, progress)
         return merged_file_path
 
-    def _merge_files(self, base_path, total_chunks, merged_file_path):
-        with open(merged_file_path, "wb") as merged:
-            for i in range(total_chunks):
-                chunk_path = os.path.join(base_path, f"chunk_{i}")
-                with open(chunk_path, "rb") as chunk_file:
-                    shutil.copyfileobj(chunk_file, merged)
+    def _merge_files(self, base_path, total_chunks, merged_file_path, progress=None):
+        os.makedirs(os.path.dirname(merged_file_path), exist_ok=True)
+        chunk_paths = [os.path.join(base_path, f"chunk_{i}") for i in range(total_chunks)]
+        return merge_files(chunk_paths, merged_file_path, progress=progress)
 
-    async def upload_file(self, file_path: str, s3_key: str) -> str:
-        await asyncio.to_thread(self._upload_to_s3, file_path, s3_key)
+    async def upload_file(self, file_path: str, s3_key: str, progress: Optional[Callable[[int], None]] = None) -> str:
+        await s3_pool.run(self._upload_to_s3, file_path, s3_key, progress)
         return s3_key
 
-    def _upload_to_s3(self, file_path, s3_key):
+    def _upload_to_s3(self, file_path, s3_key, progress=None):
         try:
-            self.s3_client.upload_file(file_path, settings.S3_BUCKET_NAME, s3_key)
+            self.s3_client.upload_file(file_path, settings.S3_BUCKET_NAME, s3_key, Config=transfer_config, Callback=progress)
         except (BotoCoreError, ClientError) as e:
             raise Exception(f"S3 upload failed: {e}")
+        # The object now lives in S3, so the local merged copy is no longer needed
+        os.remove(file_path)
+
+    async def object_size(self, s3_key: str) -> Optional[int]:
+        try:
+            response = await s3_pool.run(self._head_object, s3_key, bounded=False)
+        except (BotoCoreError, ClientError):
+            return None
+        return response["ContentLength"]
+
+    def _head_object(self, s3_key: str) -> dict:
+        return self.s3_client.head_object(Bucket=settings.S3_BUCKET_NAME, Key=s3_key)
+
+    def _list_keys(self, prefix: str) -> list:
+        keys = []
+        paginator = self.s3_client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=settings.S3_BUCKET_NAME, Prefix=prefix):
+            keys.extend(obj['Key'] for obj in page.get('Contents', []))
+        return keys
+
+    async def list_keys(self, prefix: str) -> list:
+        return await s3_pool.run(self._list_keys, prefix, bounded=False)
 
     async def delete_file(self, file_path_or_key: str, storage_type: Optional[str] = None) -> None:
         # file_path_or_key is the S3 key
-        await asyncio.to_thread(self._delete_from_s3, file_path_or_key)
+        await self.delete_files([file_path_or_key])
 
-    def _delete_from_s3(self, s3_key):
-        try:
-            self.s3_client.delete_object(Bucket=settings.S3_BUCKET_NAME, Key=s3_key)
-        except (BotoCoreError, ClientError) as e:
-            pass  # Optionally log
+    async def delete_files(self, s3_keys: List[str]) -> int:
+        """Deletes keys with DeleteObjects, up to 1000 per request; returns how many were deleted"""
+        return await s3_pool.run(self._delete_from_s3, s3_keys, bounded=False)
+
+    def _delete_from_s3(self, s3_keys):
+        deleted = 0
+        for start in range(0, len(s3_keys), DELETE_BATCH_SIZE):
+            batch = s3_keys[start:start + DELETE_BATCH_SIZE]
+            try:
+                response = self.s3_client.delete_objects(
+                    Bucket=settings.S3_BUCKET_NAME,
+                    Delete={"Objects": [{"Key": key} for key in batch], "Quiet": True}
+                )
+            except (BotoCoreError, ClientError) as e:
+                logger.error(f"S3 batch delete of {len(batch)} keys failed: {e}")
+                continue
+            errors = response.get("Errors", [])
+            for error in errors:
+                logger.error(f"S3 delete failed for {error.get('Key')}: {error.get('Code')} {error.get('Message')}")
+            deleted += len(batch) - len(errors)
+        return deleted
 
     async def cleanup_session(self, upload_session_id: str) -> None:
-        base_path = os.path.join(settings.LOCAL_TEMP_CHUNK_PATH, upload_session_id)
-        await asyncio.to_thread(self._delete_dir, base_path)
+        await chunk_pool.run(self._delete_dir, upload_session_id, bounded=False)
 
-    def _delete_dir(self, path):
+    def _delete_dir(self, upload_session_id: str):
+        handles.drop(upload_session_id)
+        path = layout.chunk_dir(upload_session_id)
         if os.path.exists(path):
             shutil.rmtree(path) 
\ No newline at end of file
@@ -0,0 +1,94 @@
+import time
+import logging
+import threading
+from functools import lru_cache
+from typing import Dict
+import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+# S3 DeleteObjects accepts at most this many keys per request
+DELETE_BATCH_SIZE = 1000
+
+
+class S3PoolStats:
+    """
+    Counts S3 HTTP attempts in flight on the shared client. An attempt that starts while every pooled
+    connection is already busy has to wait for (or open past) the pool, so it is counted as saturated.
+    """
+
+    def __init__(self, max_connections: int, warn_interval_seconds: float = 60.0):
+        self.max_connections = max_connections
+        self.warn_interval_seconds = warn_interval_seconds
+        self._lock = threading.Lock()
+        self._last_warning = 0.0
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.requests = 0
+        self.saturated = 0
+
+    def on_send(self, **kwargs) -> None:
+        warn = False
+        with self._lock:
+            saturated = self.in_flight >= self.max_connections
+            self.in_flight += 1
+            self.requests += 1
+            if self.in_flight > self.peak_in_flight:
+                self.peak_in_flight = self.in_flight
+            if saturated:
+                self.saturated += 1
+                now = time.monotonic()
+                if now - self._last_warning >= self.warn_interval_seconds:
+                    self._last_warning = now
+                    warn = True
+        if warn:
+            logger.warning(
+                f"S3 connection pool saturated: {self.in_flight} requests in flight, "
+                f"S3_MAX_POOL_CONNECTIONS={self.max_connections}"
+            )
+
+    def on_response(self, **kwargs) -> None:
+        with self._lock:
+            self.in_flight -= 1
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "max_connections": self.max_connections,
+                "in_flight": self.in_flight,
+                "peak_in_flight": self.peak_in_flight,
+                "requests": self.requests,
+                "saturated": self.saturated,
+            }
+
+
+s3_pool_stats = S3PoolStats(settings.S3_MAX_POOL_CONNECTIONS)
+
+# Managed uploads never fan out wider than the connection pool they share with everything else
+transfer_config = TransferConfig(max_concurrency=min(10, settings.S3_MAX_POOL_CONNECTIONS))
+
+
+@lru_cache(maxsize=1)
+def get_s3_client():
+    """Returns the process-wide S3 client; boto3 clients are thread-safe and share one connection pool"""
+    client = boto3.client(
+        's3',
+        aws_access_key_id=settings.S3_ACCESS_KEY,
+        aws_secret_access_key=settings.S3_SECRET_KEY,
+        endpoint_url=settings.S3_ENDPOINT_URL,
+        region_name=settings.S3_REGION_NAME,
+        config=Config(
+            max_pool_connections=settings.S3_MAX_POOL_CONNECTIONS,
+            tcp_keepalive=settings.S3_TCP_KEEPALIVE,
+            connect_timeout=settings.S3_CONNECT_TIMEOUT,
+            read_timeout=settings.S3_READ_TIMEOUT,
+            retries={"max_attempts": settings.S3_MAX_ATTEMPTS, "mode": settings.S3_RETRY_MODE},
+        ),
+    )
+    # before-send/response-received fire once per HTTP attempt, including retries and failures
+    client.meta.events.register("before-send.s3", s3_pool_stats.on_send)
+    client.meta.events.register("response-received.s3", s3_pool_stats.on_response)
+    return client
@@ -0,0 +1,197 @@
+import logging
+from functools import partial
+from typing import BinaryIO, Callable, Optional
+from .base import BaseStorage
+from .s3 import S3Storage
+from .scheduler import s3_pool
+from app.core.config import settings
+from app.core.session import session_store
+from botocore.exceptions import BotoCoreError, ClientError
+
+logger = logging.getLogger(__name__)
+
+# S3 part numbers are 1-based and capped at 10000 per upload
+MAX_PART_NUMBER = 10000
+
+# CHECKSUM_ALGORITHM -> the S3 flexible checksum carrying the same digest; md5 goes in Content-MD5
+S3_CHECKSUM_ALGORITHMS = {"sha256": "SHA256", "crc32c": "CRC32C"}
+
+
+class S3MultipartStorage(S3Storage):
+    """
+    S3 backend that maps an upload session onto a native S3 multipart upload.
+    Every chunk is sent straight to S3 as a part, so nothing is staged or merged on local disk.
+    All parts except the last must be at least 5 MiB, as required by S3.
+    Each part carries the chunk's digest, so S3 itself rejects a part that was corrupted in transit.
+    """
+
+    digest_before_write = True
+    min_part_size = 5 * 1024 * 1024
+    # Parts go straight to S3 instead of the scratch disk
+    chunk_write_pool = s3_pool
+    # CHECKSUM_ALGORITHM values S3 verifies on every part besides md5
+    checksum_algorithms = S3_CHECKSUM_ALGORITHMS
+
+    async def init_session(self, upload_session_id: str, object_key: str, file_size: Optional[int] = None) -> dict:
+        extra = {}
+        if settings.CHECKSUM_ALGORITHM in self.checksum_algorithms:
+            extra["ChecksumAlgorithm"] = self.checksum_algorithms[settings.CHECKSUM_ALGORITHM]
+        response = await s3_pool.run(
+            partial(self.s3_client.create_multipart_upload, Bucket=settings.S3_BUCKET_NAME, Key=object_key, **extra)
+        )
+        return {"s3_key": object_key, "s3_upload_id": response["UploadId"]}
+
+    @staticmethod
+    def _upload_of(upload_session_id: str, session: Optional[dict]):
+        if not session or not session.get("s3_upload_id"):
+            raise ValueError(f"No multipart upload in progress for session {upload_session_id}")
+        return session["s3_key"], session["s3_upload_id"]
+
+    def _get_upload(self, upload_session_id: str):
+        # For code running on an s3 pool thread
+        return self._upload_of(upload_session_id, session_store.get(upload_session_id))
+
+    async def _aget_upload(self, upload_session_id: str):
+        return self._upload_of(upload_session_id, await session_store.aget(upload_session_id))
+
+    async def save_chunk(self, upload_session_id: str, chunk_index: int, chunk_file: BinaryIO, offset: Optional[int] = None, checksum: Optional[str] = None) -> str:
+        part_number = chunk_index + 1
+        if not 1 <= part_number <= MAX_PART_NUMBER:
+            raise ValueError(f"chunk_index must be between 0 and {MAX_PART_NUMBER - 1}")
+        s3_key, upload_id = await self._aget_upload(upload_session_id)
+        extra = {}
+        if checksum is not None:
+            if settings.CHECKSUM_ALGORITHM == "md5":
+                extra["ContentMD5"] = checksum
+            elif settings.CHECKSUM_ALGORITHM in self.checksum_algorithms:
+                extra[f"Checksum{self.checksum_algorithms[settings.CHECKSUM_ALGORITHM]}"] = checksum
+        response = await s3_pool.run(partial(
+            self.s3_client.upload_part,
+            Bucket=settings.S3_BUCKET_NAME,
+            Key=s3_key,
+            UploadId=upload_id,
+            PartNumber=part_number,
+            Body=chunk_file,
+            **extra
+        ))
+        return response["ETag"]
+
+    # Every part is its own S3 request, so a batch goes through save_chunk one part at a time
+    save_chunks = BaseStorage.save_chunks
+
+    def _list_parts(self, s3_key: str, upload_id: str) -> list:
+        parts = []
+        paginator = self.s3_client.get_paginator("list_parts")
+        for page in paginator.paginate(Bucket=settings.S3_BUCKET_NAME, Key=s3_key, UploadId=upload_id):
+            parts.extend(page.get("Parts", []))
+        return parts
+
+    def _complete_upload(self, s3_key: str, upload_id: str, total_chunks: int):
+        parts = self._list_parts(s3_key, upload_id)
+        received = {part["PartNumber"] for part in parts}
+        missing = [n - 1 for n in range(1, total_chunks + 1) if n not in received]
+        if missing:
+            raise ValueError(f"Missing chunks for multipart upload: {missing[:20]}")
+        completed = []
+        for part in parts:
+            if part["PartNumber"] > total_chunks:
+                continue
+            entry = {"PartNumber": part["PartNumber"], "ETag": part["ETag"]}
+            # Uploads created with a checksum algorithm must list each part's checksum on completion
+            for field in ("ChecksumSHA256", "ChecksumCRC32C"):
+                if part.get(field):
+                    entry[field] = part[field]
+            completed.append(entry)
+        parts = completed
+        try:
+            self.s3_client.complete_multipart_upload(
+                Bucket=settings.S3_BUCKET_NAME,
+                Key=s3_key,
+                UploadId=upload_id,
+                MultipartUpload={"Parts": parts}
+            )
+        except (BotoCoreError, ClientError) as e:
+            raise Exception(f"S3 multipart completion failed: {e}")
+
+    async def merge_chunks(self, upload_session_id: str, total_chunks: int, merged_file_path: str, progress: Optional[Callable[[int], None]] = None) -> str:
+        # Completing the multipart upload is the merge; S3 stitches the parts server-side
+        session = await session_store.aget(upload_session_id)
+        if session and session.get("s3_completed"):
+            # Completed by an earlier attempt that failed afterwards; the object is already there
+            return session["s3_key"]
+        s3_key, upload_id = self._upload_of(upload_session_id, session)
+        await s3_pool.run(self._complete_upload, s3_key, upload_id, total_chunks)
+        await session_store.aupdate(upload_session_id, s3_upload_id=None, s3_completed=True)
+        logger.info(f"Multipart upload completed for session {upload_session_id}: {s3_key}")
+        return s3_key
+
+    def _adopt_upload(self, source_session_id: str, target_session_id: str, first_chunk_index: int, chunk_count: int):
+        if first_chunk_index + chunk_count > MAX_PART_NUMBER:
+            raise ValueError(f"Concatenated upload exceeds {MAX_PART_NUMBER} parts")
+        source = session_store.get(source_session_id)
+        if not source:
+            raise ValueError(f"Upload session {source_session_id} not found")
+        target_key, target_upload_id = self._get_upload(target_session_id)
+        chunks = session_store.chunks(source_session_id)
+        source_key = source["s3_key"]
+        if source.get("s3_upload_id"):
+            # Parts of an unfinished upload can't be copied, so the source is completed into its own object
+            # first. The object stays until the source session is cleaned up after the target completes,
+            # so a concatenation that fails later can be retried.
+            self._complete_upload(source_key, source["s3_upload_id"], chunk_count)
+            session_store.update(source_session_id, s3_upload_id=None, s3_concat_source=True)
+        # Its parts are copied server-side, range by range, into the target upload
+        position = 0
+        for i in range(chunk_count):
+            size = chunks[i][0]
+            self.s3_client.upload_part_copy(
+                Bucket=settings.S3_BUCKET_NAME,
+                Key=target_key,
+                UploadId=target_upload_id,
+                PartNumber=first_chunk_index + i + 1,
+                CopySource={"Bucket": settings.S3_BUCKET_NAME, "Key": source_key},
+                CopySourceRange=f"bytes={position}-{position + size - 1}"
+            )
+            position += size
+
+    async def adopt_chunks(self, source_session_id: str, target_session_id: str, first_chunk_index: int,
+                           chunk_count: int, target_offset: int, source_size: int) -> None:
+        await s3_pool.run(self._adopt_upload, source_session_id, target_session_id, first_chunk_index, chunk_count)
+
+    async def upload_file(self, file_path: str, s3_key: str, progress: Optional[Callable[[int], None]] = None) -> str:
+        # The object was already assembled by merge_chunks
+        return s3_key
+
+    def _abort_upload(self, s3_key: str, upload_id: str):
+        try:
+            self.s3_client.abort_multipart_upload(
+                Bucket=settings.S3_BUCKET_NAME,
+                Key=s3_key,
+                UploadId=upload_id
+            )
+        except (BotoCoreError, ClientError) as e:
+            logger.warning(f"Failed to abort multipart upload {upload_id}: {e}")
+
+    async def abort_upload(self, s3_key: str, upload_id: str) -> None:
+        await s3_pool.run(self._abort_upload, s3_key, upload_id, bounded=False)
+
+    def _list_multipart_uploads(self, prefix: str = "") -> list:
+        uploads = []
+        paginator = self.s3_client.get_paginator("list_multipart_uploads")
+        for page in paginator.paginate(Bucket=settings.S3_BUCKET_NAME, Prefix=prefix):
+            uploads.extend(page.get("Uploads", []))
+        return uploads
+
+    async def list_multipart_uploads(self, prefix: str = "") -> list:
+        """Multipart uploads still open in the bucket under prefix, with Key, UploadId and Initiated"""
+        return await s3_pool.run(self._list_multipart_uploads, prefix, bounded=False)
+
+    async def cleanup_session(self, upload_session_id: str) -> None:
+        # Only uploads that were never completed still hold parts on S3
+        session = await session_store.aget(upload_session_id)
+        if session and session.get("s3_upload_id"):
+            await s3_pool.run(self._abort_upload, session["s3_key"], session["s3_upload_id"], bounded=False)
+            await session_store.aupdate(upload_session_id, s3_upload_id=None)
+        elif session and session.get("s3_concat_source"):
+            # A partial upload completed to be copied into a concatenated one
+            await self.delete_file(session["s3_key"])
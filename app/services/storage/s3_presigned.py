@@ -0,0 +1,74 @@
+import math
+import base64
+from typing import List, Optional
+from .s3_multipart import S3MultipartStorage, MAX_PART_NUMBER
+from .scheduler import s3_pool
+from app.core.config import settings
+from app.core.session import session_store
+
+
+class S3PresignedStorage(S3MultipartStorage):
+    """
+    S3 multipart backend where clients PUT parts straight to the bucket with presigned URLs.
+    The service only creates the multipart upload, signs part URLs and, on completion, checks the
+    parts S3 actually received before completing the upload; no chunk bytes pass through it.
+    Chunks sent through PUT /files/{file_id} still work and are forwarded as in multipart mode.
+    """
+
+    direct_upload = True
+    # A presigned part PUT carries no checksum header, so S3 can't require one on the upload;
+    # the md5 of every part still comes back as its ETag
+    checksum_algorithms = {}
+
+    async def init_session(self, upload_session_id: str, object_key: str, file_size: Optional[int] = None) -> dict:
+        part_size = settings.S3_PRESIGNED_PART_SIZE
+        planned_parts = max(1, math.ceil(file_size / part_size)) if file_size else None
+        if planned_parts is not None and planned_parts > MAX_PART_NUMBER:
+            raise ValueError(
+                f"A {file_size} byte file needs {planned_parts} parts of {part_size} bytes, "
+                f"more than the {MAX_PART_NUMBER} S3 allows"
+            )
+        fields = await super().init_session(upload_session_id, object_key, file_size)
+        fields.update(part_size=part_size, planned_parts=planned_parts)
+        return fields
+
+    async def presign_parts(self, upload_session_id: str, first_chunk_index: int, count: int) -> List[dict]:
+        """Upload URLs for chunks first_chunk_index..+count, clipped to the planned part count"""
+        session = await session_store.aget(upload_session_id)
+        if not session or not session.get("s3_upload_id"):
+            raise ValueError(f"No multipart upload in progress for session {upload_session_id}")
+        last = min(first_chunk_index + count, session.get("planned_parts") or MAX_PART_NUMBER, MAX_PART_NUMBER)
+        # Signing is a local HMAC computation, no request is sent to S3
+        return [
+            {
+                "chunk_index": chunk_index,
+                "url": self.s3_client.generate_presigned_url(
+                    "upload_part",
+                    Params={
+                        "Bucket": settings.S3_BUCKET_NAME,
+                        "Key": session["s3_key"],
+                        "UploadId": session["s3_upload_id"],
+                        "PartNumber": chunk_index + 1,
+                    },
+                    ExpiresIn=settings.S3_PRESIGNED_URL_EXPIRES,
+                ),
+            }
+            for chunk_index in range(max(first_chunk_index, 0), last)
+        ]
+
+    async def uploaded_parts(self, upload_session_id: str) -> List[dict]:
+        """
+        The parts S3 holds for the session as chunk_index, size, etag (without quotes) and, when the
+        ETag is the part's plain MD5, its base64 md5 digest.
+        """
+        s3_key, upload_id = await self._aget_upload(upload_session_id)
+        parts = await s3_pool.run(self._list_parts, s3_key, upload_id)
+        uploaded = []
+        for part in parts:
+            etag = part["ETag"].strip('"')
+            try:
+                md5 = base64.b64encode(bytes.fromhex(etag)).decode() if len(etag) == 32 else None
+            except ValueError:
+                md5 = None
+            uploaded.append({"chunk_index": part["PartNumber"] - 1, "size": part["Size"], "etag": etag, "md5": md5})
+        return uploaded
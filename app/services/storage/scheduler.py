@@ -0,0 +1,134 @@
+"""
+I/O scheduling for the storage backends.
+
+Blocking work runs on one of three bounded pools so a burst of one kind can't starve the others:
+"chunk" (writing chunk bodies and other scratch-disk I/O), "merge" (assembling files) and "s3"
+(network transfers). Each pool rejects new work with IOSaturatedError once IO_<POOL>_MAX_QUEUE jobs
+are already waiting, instead of letting requests pile up behind a few threads.
+
+inflight_bytes caps the request bodies the process holds at once; the admission middleware reserves
+a request's Content-Length before the body is read and answers 429 when the budget is spent.
+"""
+import time
+import asyncio
+import threading
+import concurrent.futures
+from typing import Callable, Dict
+from app.core.config import settings
+
+
+class IOSaturatedError(Exception):
+    def __init__(self, pool: str):
+        super().__init__(f"I/O pool '{pool}' is saturated")
+        self.pool = pool
+        self.retry_after = settings.IO_RETRY_AFTER_SECONDS
+
+
+class IOPool:
+    """ThreadPoolExecutor with a bounded wait queue and queue depth / wait time accounting"""
+
+    def __init__(self, name: str, workers: int, max_queue: int):
+        self.name = name
+        self.workers = workers
+        self.max_queue = max_queue
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f"io-{name}")
+        self._lock = threading.Lock()
+        self.queued = 0
+        self.running = 0
+        self.completed = 0
+        self.rejected = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+
+    def saturated(self) -> bool:
+        return self.queued >= self.max_queue
+
+    async def run(self, fn: Callable, *args, bounded: bool = True):
+        """
+        Runs fn(*args) on the pool. Cleanup work that must not be refused (e.g. removing a rejected
+        chunk) passes bounded=False and only waits its turn.
+        """
+        with self._lock:
+            if bounded and self.queued >= self.max_queue:
+                self.rejected += 1
+                raise IOSaturatedError(self.name)
+            self.queued += 1
+        submitted = time.monotonic()
+
+        def job():
+            waited = time.monotonic() - submitted
+            with self._lock:
+                self.queued -= 1
+                self.running += 1
+                self.wait_seconds_total += waited
+                self.wait_seconds_max = max(self.wait_seconds_max, waited)
+            try:
+                return fn(*args)
+            finally:
+                with self._lock:
+                    self.running -= 1
+                    self.completed += 1
+
+        future = self._executor.submit(job)
+        future.add_done_callback(self._on_done)
+        return await asyncio.wrap_future(future)
+
+    def _on_done(self, future: concurrent.futures.Future) -> None:
+        # A job cancelled before it started never runs, so it has to leave the queue here
+        if future.cancelled():
+            with self._lock:
+                self.queued -= 1
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            started = self.completed + self.running
+            return {
+                "workers": self.workers,
+                "max_queue": self.max_queue,
+                "queued": self.queued,
+                "running": self.running,
+                "completed": self.completed,
+                "rejected": self.rejected,
+                "wait_ms_avg": round(self.wait_seconds_total / started * 1000, 2) if started else 0.0,
+                "wait_ms_max": round(self.wait_seconds_max * 1000, 2),
+            }
+
+
+class InflightBytes:
+    """Byte budget for request bodies held by the process at once; a limit of 0 disables it"""
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.in_flight = 0
+        self.peak = 0
+        self.rejected = 0
+
+    def try_acquire(self, size: int) -> bool:
+        # Runs on the event loop only, so no lock is needed. A body larger than the whole budget is
+        # still admitted when nothing else is in flight, otherwise it could never be uploaded.
+        if self.limit and self.in_flight and self.in_flight + size > self.limit:
+            self.rejected += 1
+            return False
+        self.in_flight += size
+        self.peak = max(self.peak, self.in_flight)
+        return True
+
+    def release(self, size: int) -> None:
+        self.in_flight -= size
+
+    def stats(self) -> Dict[str, int]:
+        return {"limit": self.limit, "in_flight": self.in_flight, "peak": self.peak, "rejected": self.rejected}
+
+
+chunk_pool = IOPool("chunk", settings.IO_CHUNK_WORKERS, settings.IO_CHUNK_MAX_QUEUE)
+merge_pool = IOPool("merge", settings.IO_MERGE_WORKERS, settings.IO_MERGE_MAX_QUEUE)
+s3_pool = IOPool("s3", settings.IO_S3_WORKERS, settings.IO_S3_MAX_QUEUE)
+inflight_bytes = InflightBytes(settings.IO_MAX_INFLIGHT_BYTES)
+POOLS = (chunk_pool, merge_pool, s3_pool)
+
+
+def stats() -> dict:
+    return {
+        "pools": {pool.name: pool.stats() for pool in POOLS},
+        "inflight_bytes": inflight_bytes.stats(),
+    }
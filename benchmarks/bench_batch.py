@@ -0,0 +1,114 @@
+"""
+Small-chunk upload throughput: one PUT /files/{file_id} per chunk against POST /files/{file_id}/chunks
+with several chunks per request.
+
+Runs the real app in-process on local storage under a temporary directory, with a throwaway RSA key
+for the JWTs, so every request pays the same authentication, middleware and parsing costs as in
+production:
+
+    python -m benchmarks.bench_batch --chunks 2000 --chunk-kb 16 --batch-size 1 16 64
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+import jwt
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+_root = tempfile.mkdtemp(prefix="hayula_bench_batch_")
+os.environ["MAIN_SERVICE_JWT_PUBLIC_KEY"] = _key.public_key().public_bytes(
+    serialization.Encoding.PEM, serialization.PublicFormat.SubjectPublicKeyInfo
+).decode()
+os.environ["EXPECTED_JWT_ISSUER"] = "bench"
+os.environ["EXPECTED_JWT_AUDIENCE"] = "bench"
+os.environ["STORAGE_BACKEND"] = "local"
+os.environ["LOCAL_TEMP_CHUNK_PATH"] = os.path.join(_root, "chunks")
+os.environ["PERSISTENT_LOCAL_STORAGE_PATH"] = os.path.join(_root, "data")
+os.environ["JANITOR_ENABLED"] = "false"
+
+import httpx
+
+from app.main import app
+
+
+def token() -> str:
+    claims = {"sub": "bench", "iss": "bench", "aud": "bench", "exp": int(time.time()) + 3600}
+    return jwt.encode(claims, _key, algorithm="RS256")
+
+
+async def run(client: httpx.AsyncClient, file_id: int, chunks: int, chunk: bytes, batch_size: int) -> dict:
+    headers = {"Authorization": f"Bearer {token()}"}
+    response = await client.post(
+        "/files/", json={"file_id": file_id, "original_file_name": "bench.bin", "file_size": chunks * len(chunk)}, headers=headers
+    )
+    response.raise_for_status()
+
+    started = time.perf_counter()
+    requests = 0
+    for first in range(0, chunks, batch_size):
+        indices = range(first, min(first + batch_size, chunks))
+        if batch_size == 1:
+            response = await client.put(
+                f"/files/{file_id}", files={"chunk": ("chunk", chunk)}, data={"chunk_index": str(first)}, headers=headers
+            )
+        else:
+            parts = [
+                ("chunk", (f"chunk_{i}", chunk, "application/octet-stream", {"X-Chunk-Index": str(i)}))
+                for i in indices
+            ]
+            response = await client.post(f"/files/{file_id}/chunks", files=parts, headers=headers)
+        response.raise_for_status()
+        requests += 1
+    elapsed = time.perf_counter() - started
+
+    response = await client.patch(f"/files/{file_id}", json={"total_chunks": chunks, "main_service_file_id": file_id}, headers=headers)
+    response.raise_for_status()
+    await client.delete(f"/files/{file_id}", headers=headers)
+    return {
+        "batch_size": batch_size,
+        "requests": requests,
+        "seconds": elapsed,
+        "chunks_per_s": chunks / elapsed,
+        "throughput_mb_s": chunks * len(chunk) / 1024 / 1024 / elapsed,
+    }
+
+
+async def main_async(args) -> list:
+    chunk = os.urandom(args.chunk_kb * 1024)
+    results = []
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://bench") as client:
+        for file_id, batch_size in enumerate(args.batch_size, start=1):
+            results.append(await run(client, file_id, args.chunks, chunk, batch_size))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--chunks", type=int, default=2000)
+    parser.add_argument("--chunk-kb", type=int, default=16)
+    parser.add_argument("--batch-size", type=int, nargs="+", default=[1, 16, 64])
+    args = parser.parse_args()
+    # Per-request INFO logs would dominate the timings
+    logging.disable(logging.INFO)
+
+    try:
+        results = asyncio.run(main_async(args))
+    finally:
+        shutil.rmtree(_root, ignore_errors=True)
+
+    single = next((r for r in results if r["batch_size"] == 1), None)
+    for result in results:
+        if single:
+            result["speedup"] = result["chunks_per_s"] / single["chunks_per_s"]
+    print(json.dumps({"chunks": args.chunks, "chunk_kb": args.chunk_kb, "results": results}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+"""
+Chunk write throughput and latency under each DURABILITY_MODE.
+
+Several concurrent uploads write their chunks through the local storage backends, on the chunk I/O
+pool like the service does, then complete; each mode is run in turn against the same disk. Chunk and
+partial files are created under --dir, so point it at the device you care about:
+
+    python -m benchmarks.bench_durability --dir /mnt/nvme/bench --uploads 4 --parallel 4 --chunks 64 --chunk-kb 256
+
+Reports chunks/s, MB/s, p50/p99 chunk latency (what the client waits for before its PUT is answered),
+p50 completion latency and, for group-commit, how many writes shared a sync. On tmpfs every mode looks
+the same; fsync only costs something on a real device.
+"""
+import argparse
+import asyncio
+import io
+import json
+import logging
+import os
+import shutil
+import time
+
+os.environ.setdefault("MAIN_SERVICE_JWT_PUBLIC_KEY", "unused")
+os.environ.setdefault("EXPECTED_JWT_ISSUER", "bench")
+os.environ.setdefault("EXPECTED_JWT_AUDIENCE", "bench")
+
+from app.core.config import settings
+from app.services.storage import durability
+from app.services.storage.internal import InternalStorage
+from app.services.storage.internal_offset import InternalOffsetStorage
+
+# What a node crash can cost in each mode
+LOSES_ON_CRASH = {
+    durability.NONE: "acknowledged chunks and completed files",
+    durability.ON_COMPLETE: "acknowledged chunks of unfinished uploads",
+    durability.PER_CHUNK: "nothing acknowledged",
+    durability.GROUP_COMMIT: "nothing acknowledged",
+}
+
+
+def percentile(values: list, q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+async def upload(storage, session_id: str, chunks: int, parallel: int, chunk: bytes, latencies: list) -> float:
+    await storage.init_session(session_id, f"bench/{session_id}/bench.bin", chunks * len(chunk))
+    indices = iter(range(chunks))
+
+    async def sender():
+        # Like a client keeping `parallel` chunk PUTs of one file in flight
+        for index in indices:
+            started = time.perf_counter()
+            await storage.save_chunk(session_id, index, io.BytesIO(chunk), index * len(chunk))
+            latencies.append(time.perf_counter() - started)
+
+    await asyncio.gather(*[sender() for _ in range(parallel)])
+
+    started = time.perf_counter()
+    merged = os.path.join(settings.PERSISTENT_LOCAL_STORAGE_PATH, "merged", session_id, "bench.bin")
+    await storage.merge_chunks(session_id, chunks, merged)
+    await asyncio.to_thread(durability.complete, merged, settings.PERSISTENT_LOCAL_STORAGE_PATH)
+    completion = time.perf_counter() - started
+    await storage.cleanup_session(session_id)
+    os.remove(merged)
+    return completion
+
+
+async def run(mode: str, local_mode: str, args, chunk: bytes) -> dict:
+    settings.DURABILITY_MODE = mode
+    storage = InternalOffsetStorage() if local_mode == "offset" else InternalStorage()
+    groups_before = durability.committer.stats()
+    latencies = []
+    started = time.perf_counter()
+    completions = await asyncio.gather(*[
+        upload(storage, f"{mode}-{local_mode}-{n}", args.chunks, args.parallel, chunk, latencies) for n in range(args.uploads)
+    ])
+    seconds = time.perf_counter() - started
+    groups = durability.committer.stats()
+
+    total_chunks = args.uploads * args.chunks
+    result = {
+        "mode": mode,
+        "local_mode": local_mode,
+        "loses_on_crash": LOSES_ON_CRASH[mode],
+        "seconds": seconds,
+        "chunks_per_s": total_chunks / seconds,
+        "throughput_mb_s": total_chunks * len(chunk) / 1024 / 1024 / seconds,
+        "chunk_p50_ms": percentile(latencies, 0.5) * 1000,
+        "chunk_p99_ms": percentile(latencies, 0.99) * 1000,
+        "complete_p50_ms": percentile(completions, 0.5) * 1000,
+    }
+    if mode == durability.GROUP_COMMIT:
+        writes = groups["writes"] - groups_before["writes"]
+        result["writes_per_group"] = writes / max(1, groups["groups"] - groups_before["groups"])
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--dir", default="/tmp/hayula_bench_durability")
+    parser.add_argument("--uploads", type=int, default=4, help="concurrent uploads")
+    parser.add_argument("--chunks", type=int, default=64, help="chunks per upload")
+    parser.add_argument("--parallel", type=int, default=4, help="chunks of one upload in flight at once")
+    parser.add_argument("--chunk-kb", type=int, default=256)
+    parser.add_argument("--mode", nargs="+", default=list(durability.MODES), choices=durability.MODES)
+    parser.add_argument("--local-mode", nargs="+", default=["chunks", "offset"], choices=["chunks", "offset"])
+    parser.add_argument("--window-ms", type=float, default=settings.DURABILITY_GROUP_COMMIT_WINDOW_MS)
+    args = parser.parse_args()
+    logging.disable(logging.INFO)
+
+    settings.LOCAL_TEMP_CHUNK_PATH = os.path.join(args.dir, "chunks")
+    settings.PERSISTENT_LOCAL_STORAGE_PATH = os.path.join(args.dir, "data")
+    os.makedirs(settings.LOCAL_TEMP_CHUNK_PATH, exist_ok=True)
+    os.makedirs(settings.PERSISTENT_LOCAL_STORAGE_PATH, exist_ok=True)
+    durability.committer.window_seconds = args.window_ms / 1000
+    chunk = os.urandom(args.chunk_kb * 1024)
+
+    results = []
+    try:
+        for local_mode in args.local_mode:
+            for mode in args.mode:
+                results.append(asyncio.run(run(mode, local_mode, args, chunk)))
+    finally:
+        shutil.rmtree(args.dir, ignore_errors=True)
+
+    for result in results:
+        baseline = next((r for r in results if r["local_mode"] == result["local_mode"] and r["mode"] == durability.NONE), None)
+        if baseline:
+            result["relative_throughput"] = result["chunks_per_s"] / baseline["chunks_per_s"]
+    print(json.dumps({
+        "uploads": args.uploads, "chunks": args.chunks, "parallel": args.parallel, "chunk_kb": args.chunk_kb,
+        "window_ms": args.window_ms, "dir": args.dir, "results": results,
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
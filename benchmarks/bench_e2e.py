@@ -0,0 +1,362 @@
+"""
+End-to-end upload pipeline benchmark: init -> chunk PUTs -> PATCH -> GET, through the real app.
+
+Every cell of the backend x file size x chunk size x concurrency matrix runs in a fresh child
+process with the app in-process (httpx ASGITransport, lifespan included), a throwaway RSA key for
+the JWTs and its own temporary storage directories. The s3 backend talks to a moto server started
+in a separate process, so the bucket contents don't count towards the app's memory.
+
+Per cell it reports upload and download throughput, p50/p99/max latency per endpoint, admission
+rejections (429/503, retried after Retry-After), peak RSS and the bytes the process wrote (to
+the block layer and through write syscalls). Results are JSON; pass an earlier run with
+--baseline to get the throughput and p99 ratios per cell.
+
+    python -m benchmarks.bench_e2e --backend local s3 --file-mb 8 64 --chunk-kb 1024 8192 \\
+        --concurrency 1 8 --output results.json
+    python -m benchmarks.bench_e2e ... --baseline results.json
+
+GET is only measured where the backend serves downloads; otherwise its latency is reported as null.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import platform
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+ENDPOINTS = ("init", "chunk", "complete", "download")
+MOTO_KEYS = dict(S3_ACCESS_KEY="bench", S3_SECRET_KEY="bench", S3_REGION_NAME="us-east-1")
+S3_MIN_PART_SIZE = 5 * 1024 * 1024
+
+
+# ---------------------------------------------------------------- child: one matrix cell
+
+def read_proc_io() -> dict:
+    # Linux only; write_bytes is what reached the block layer, wchar everything passed to write()
+    try:
+        with open("/proc/self/io") as f:
+            return {key: int(value) for key, value in (line.split(": ") for line in f)}
+    except OSError:
+        return {}
+
+
+def percentile(values: list, pct: float):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, round(pct / 100 * len(values) + 0.5) - 1))]
+
+
+def latency_summary(values: list) -> dict:
+    to_ms = lambda v: round(v * 1000, 3) if v is not None else None
+    return {
+        "count": len(values),
+        "p50_ms": to_ms(percentile(values, 50)),
+        "p99_ms": to_ms(percentile(values, 99)),
+        "max_ms": to_ms(max(values) if values else None),
+    }
+
+
+def setup_environment(cell: dict, root: str):
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    os.environ.update(
+        MAIN_SERVICE_JWT_PUBLIC_KEY=key.public_key().public_bytes(
+            serialization.Encoding.PEM, serialization.PublicFormat.SubjectPublicKeyInfo
+        ).decode(),
+        EXPECTED_JWT_ISSUER="bench",
+        EXPECTED_JWT_AUDIENCE="bench",
+        STORAGE_BACKEND=cell["backend"],
+        LOCAL_TEMP_CHUNK_PATH=os.path.join(root, "chunks"),
+        PERSISTENT_LOCAL_STORAGE_PATH=os.path.join(root, "data"),
+        JANITOR_ENABLED="false",
+    )
+    if cell["backend"] == "local":
+        os.environ["LOCAL_WRITE_MODE"] = cell["mode"]
+    else:
+        os.environ.update(S3_UPLOAD_MODE=cell["mode"], S3_ENDPOINT_URL=cell["s3_endpoint"], **MOTO_KEYS)
+        import boto3
+        boto3.client(
+            "s3", endpoint_url=cell["s3_endpoint"], region_name=MOTO_KEYS["S3_REGION_NAME"],
+            aws_access_key_id=MOTO_KEYS["S3_ACCESS_KEY"], aws_secret_access_key=MOTO_KEYS["S3_SECRET_KEY"]
+        ).create_bucket(Bucket=os.environ.get("S3_BUCKET_NAME", "hayula-uploads"))
+    if cell.get("finalize_mode"):
+        os.environ["FINALIZE_MODE"] = cell["finalize_mode"]
+    return key
+
+
+class Client:
+    """Wraps the in-process client with auth, latency recording and retries on admission rejections"""
+
+    def __init__(self, http, key):
+        import jwt
+
+        claims = {"sub": "bench", "iss": "bench", "aud": "bench", "exp": int(time.time()) + 3600}
+        self.http = http
+        self.headers = {"Authorization": f"Bearer {jwt.encode(claims, key, algorithm='RS256')}"}
+        self.latencies = {endpoint: [] for endpoint in ENDPOINTS}
+        self.rejected = 0
+
+    async def call(self, endpoint: str, method: str, url: str, **kwargs):
+        headers = {**self.headers, **kwargs.pop("headers", {})}
+        while True:
+            started = time.perf_counter()
+            response = await self.http.request(method, url, headers=headers, **kwargs)
+            if response.status_code in (429, 503):
+                self.rejected += 1
+                await asyncio.sleep(float(response.headers.get("retry-after", 1)))
+                continue
+            self.latencies[endpoint].append(time.perf_counter() - started)
+            return response
+
+
+async def upload(client: Client, file_id: int, file_size: int, chunk_size: int, block: bytes) -> dict:
+    response = await client.call(
+        "init", "POST", "/files/", json={"file_id": file_id, "original_file_name": "bench.bin", "file_size": file_size}
+    )
+    response.raise_for_status()
+
+    total_chunks = -(-file_size // chunk_size)
+    for chunk_index in range(total_chunks):
+        start = chunk_index * chunk_size
+        body = block[:min(chunk_size, file_size - start)]
+        response = await client.call(
+            "chunk", "PUT", f"/files/{file_id}",
+            files={"chunk": ("chunk", body)},
+            data={"chunk_index": str(chunk_index)},
+            headers={"Content-Range": f"bytes {start}-{start + len(body) - 1}/{file_size}"},
+        )
+        response.raise_for_status()
+
+    started = time.perf_counter()
+    response = await client.call(
+        "complete", "PATCH", f"/files/{file_id}", json={"total_chunks": total_chunks, "main_service_file_id": file_id}
+    )
+    response.raise_for_status()
+    if response.status_code == 202:
+        # FINALIZE_MODE=async: completion latency is until the job reports a final state
+        status_url = response.headers["location"]
+        while True:
+            await asyncio.sleep(0.05)
+            state = (await client.http.get(status_url, headers=client.headers)).json()["data"]["state"]
+            if state in ("completed", "failed"):
+                break
+        client.latencies["complete"][-1] = time.perf_counter() - started
+        if state == "failed":
+            raise RuntimeError(f"Finalizing {file_id} failed")
+    return {"file_id": file_id}
+
+
+async def download(client: Client, file_id: int, file_size: int) -> bool:
+    started = time.perf_counter()
+    received = 0
+    async with client.http.stream("GET", f"/files/{file_id}", headers=client.headers) as response:
+        if response.status_code == 404:
+            return False
+        response.raise_for_status()
+        async for block in response.aiter_raw():
+            received += len(block)
+    client.latencies["download"].append(time.perf_counter() - started)
+    if received != file_size:
+        raise RuntimeError(f"Downloaded {received} of {file_size} bytes for {file_id}")
+    return True
+
+
+async def run_cell_async(cell: dict, key) -> dict:
+    import httpx
+    from app.main import app
+
+    file_size = cell["file_mb"] * 1024 * 1024
+    chunk_size = cell["chunk_kb"] * 1024
+    block = os.urandom(min(chunk_size, file_size))
+    file_ids = range(1, cell["concurrency"] + 1)
+
+    async with app.router.lifespan_context(app):
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://bench", timeout=None) as http:
+            client = Client(http, key)
+            io_before = read_proc_io()
+
+            started = time.perf_counter()
+            await asyncio.gather(*(upload(client, file_id, file_size, chunk_size, block) for file_id in file_ids))
+            upload_seconds = time.perf_counter() - started
+
+            started = time.perf_counter()
+            served = await asyncio.gather(*(download(client, file_id, file_size) for file_id in file_ids))
+            download_seconds = time.perf_counter() - started
+
+            io_after = read_proc_io()
+
+    total_bytes = file_size * cell["concurrency"]
+    return {
+        **{k: cell[k] for k in ("backend", "mode", "file_mb", "chunk_kb", "concurrency")},
+        "bytes": total_bytes,
+        "upload_seconds": round(upload_seconds, 4),
+        "upload_throughput_mb_s": round(total_bytes / 1024 / 1024 / upload_seconds, 2),
+        "download_throughput_mb_s": round(total_bytes / 1024 / 1024 / download_seconds, 2) if all(served) else None,
+        "latency": {endpoint: latency_summary(values) for endpoint, values in client.latencies.items()},
+        "rejected": client.rejected,
+        # ru_maxrss is in KiB on Linux
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "disk_write_bytes": io_after["write_bytes"] - io_before["write_bytes"] if io_before else None,
+        "write_syscall_bytes": io_after["wchar"] - io_before["wchar"] if io_before else None,
+    }
+
+
+def run_cell(cell: dict) -> dict:
+    root = tempfile.mkdtemp(prefix="hayula_bench_e2e_")
+    try:
+        key = setup_environment(cell, root)
+        # Per-request INFO logs would dominate the timings
+        logging.disable(logging.INFO)
+        return asyncio.run(run_cell_async(cell, key))
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+# ---------------------------------------------------------------- parent: matrix, moto, report
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_moto():
+    import httpx
+
+    port = free_port()
+    process = subprocess.Popen(
+        [sys.executable, "-m", "moto.server", "-p", str(port)], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    endpoint = f"http://127.0.0.1:{port}"
+    for _ in range(100):
+        try:
+            httpx.get(endpoint)
+            return process, endpoint
+        except httpx.TransportError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError("moto server did not start")
+
+
+def cell_key(result: dict) -> tuple:
+    return tuple(result[k] for k in ("backend", "mode", "file_mb", "chunk_kb", "concurrency"))
+
+
+def compare(results: list, baseline_path: str) -> None:
+    with open(baseline_path) as f:
+        baseline = {cell_key(result): result for result in json.load(f)["results"] if "error" not in result}
+    for result in results:
+        old = baseline.get(cell_key(result))
+        if old is None or "error" in result:
+            continue
+        ratio = lambda new, previous: round(new / previous, 3) if new and previous else None
+        result["vs_baseline"] = {
+            "upload_throughput": ratio(result["upload_throughput_mb_s"], old["upload_throughput_mb_s"]),
+            "download_throughput": ratio(result["download_throughput_mb_s"], old["download_throughput_mb_s"]),
+            "chunk_p99": ratio(result["latency"]["chunk"]["p99_ms"], old["latency"]["chunk"]["p99_ms"]),
+            "peak_rss": ratio(result["peak_rss_mb"], old["peak_rss_mb"]),
+        }
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--backend", nargs="+", choices=["local", "s3"], default=["local"])
+    parser.add_argument("--local-mode", choices=["chunks", "offset"], default="chunks")
+    parser.add_argument("--s3-mode", choices=["staged", "multipart"], default="staged")
+    parser.add_argument("--finalize-mode", choices=["sync", "async"], default=None)
+    parser.add_argument("--file-mb", type=int, nargs="+", default=[8, 64])
+    parser.add_argument("--chunk-kb", type=int, nargs="+", default=[1024, 8192])
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8])
+    parser.add_argument("--baseline", help="earlier --output file to compare against")
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    parser.add_argument("--cell", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.cell:
+        print(json.dumps(run_cell(json.loads(args.cell))))
+        return
+
+    moto = None
+    results = []
+    try:
+        if "s3" in args.backend:
+            moto, s3_endpoint = start_moto()
+        for backend, file_mb, chunk_kb, concurrency in itertools.product(
+            args.backend, args.file_mb, args.chunk_kb, args.concurrency
+        ):
+            cell = {
+                "backend": backend,
+                "mode": args.local_mode if backend == "local" else args.s3_mode,
+                "file_mb": file_mb,
+                "chunk_kb": chunk_kb,
+                "concurrency": concurrency,
+                "finalize_mode": args.finalize_mode,
+            }
+            if chunk_kb > file_mb * 1024:
+                continue
+            if backend == "s3":
+                cell["s3_endpoint"] = s3_endpoint
+                if cell["mode"] == "multipart" and chunk_kb * 1024 < S3_MIN_PART_SIZE < file_mb * 1024 * 1024:
+                    results.append({**cell, "error": "S3 multipart parts must be at least 5 MiB"})
+                    continue
+            print(f"running {json.dumps(cell)}", file=sys.stderr)
+            child = subprocess.run(
+                [sys.executable, "-m", "benchmarks.bench_e2e", "--cell", json.dumps(cell)], capture_output=True, text=True
+            )
+            if child.returncode != 0:
+                results.append({**cell, "error": child.stderr.strip().splitlines()[-1] if child.stderr.strip() else "failed"})
+            else:
+                results.append(json.loads(child.stdout.strip().splitlines()[-1]))
+            if moto is not None:
+                # Start every cell from an empty bucket
+                import httpx
+                httpx.post(f"{s3_endpoint}/moto-api/reset")
+    finally:
+        if moto is not None:
+            moto.terminate()
+            moto.wait()
+
+    for result in results:
+        result.pop("s3_endpoint", None)
+    if args.baseline:
+        compare(results, args.baseline)
+    report = {
+        "meta": {
+            "revision": git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        },
+        "results": results,
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
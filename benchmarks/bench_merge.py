@@ -0,0 +1,109 @@
+"""
+Compares the serial chunk merge against the parallel merge at several parallelism levels.
+
+Chunks are generated under --dir, so point it at the device you care about (an NVMe mount,
+a spinning disk) and run it once per device:
+
+    python -m benchmarks.bench_merge --dir /mnt/nvme/bench --size-mb 4096 --chunk-mb 8
+    python -m benchmarks.bench_merge --dir /mnt/hdd/bench --size-mb 4096 --chunk-mb 8 --drop-caches
+
+--drop-caches (root only) empties the page cache before every run so chunks are read from the
+device rather than from memory; without it the numbers mostly measure memory bandwidth.
+"""
+import argparse
+import json
+import os
+import shutil
+import time
+
+os.environ.setdefault("MAIN_SERVICE_JWT_PUBLIC_KEY", "unused")
+os.environ.setdefault("EXPECTED_JWT_ISSUER", "bench")
+os.environ.setdefault("EXPECTED_JWT_AUDIENCE", "bench")
+
+from app.core.config import settings
+from app.services.storage import merge
+
+
+def write_chunks(directory: str, size: int, chunk_size: int) -> list:
+    os.makedirs(directory, exist_ok=True)
+    block = os.urandom(min(chunk_size, 8 * 1024 * 1024))
+    paths = []
+    for index, start in enumerate(range(0, size, chunk_size)):
+        path = os.path.join(directory, f"chunk_{index}")
+        remaining = min(chunk_size, size - start)
+        with open(path, "wb") as f:
+            while remaining:
+                n = f.write(block[:min(remaining, len(block))])
+                remaining -= n
+        paths.append(path)
+    return paths
+
+
+def drop_caches() -> None:
+    os.sync()
+    with open("/proc/sys/vm/drop_caches", "w") as f:
+        f.write("3\n")
+
+
+def run(chunk_paths: list, output: str, parallelism: int, repeat: int, flush: bool) -> dict:
+    # The pool is sized once from settings, so rebuild it for every parallelism level
+    settings.MERGE_PARALLELISM = parallelism
+    if merge._merge_pool is not None:
+        merge._merge_pool.shutdown()
+        merge._merge_pool = None
+
+    seconds = []
+    stats = {}
+    for _ in range(repeat):
+        if os.path.exists(output):
+            os.remove(output)
+        if flush:
+            drop_caches()
+        started = time.perf_counter()
+        stats = merge.merge_files(chunk_paths, output, parallelism)
+        # Include writeback so a run isn't credited for data still sitting in the page cache
+        fd = os.open(output, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        seconds.append(time.perf_counter() - started)
+    best = min(seconds)
+    return {
+        "parallelism": parallelism,
+        "strategy": stats["strategy"],
+        "best_seconds": best,
+        "mean_seconds": sum(seconds) / len(seconds),
+        "throughput_mb_s": stats["total_size"] / 1024 / 1024 / best,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--dir", default="/tmp/hayula_bench_merge")
+    parser.add_argument("--size-mb", type=int, default=1024)
+    parser.add_argument("--chunk-mb", type=int, default=8)
+    parser.add_argument("--parallelism", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--drop-caches", action="store_true")
+    parser.add_argument("--keep", action="store_true", help="keep the generated chunks and output")
+    args = parser.parse_args()
+
+    chunk_dir = os.path.join(args.dir, "chunks")
+    output = os.path.join(args.dir, "merged.bin")
+    chunk_paths = write_chunks(chunk_dir, args.size_mb * 1024 * 1024, args.chunk_mb * 1024 * 1024)
+    try:
+        results = [run(chunk_paths, output, p, args.repeat, args.drop_caches) for p in args.parallelism]
+    finally:
+        if not args.keep:
+            shutil.rmtree(args.dir, ignore_errors=True)
+
+    serial = next((r for r in results if r["parallelism"] == 1), None)
+    for result in results:
+        if serial:
+            result["speedup"] = serial["best_seconds"] / result["best_seconds"]
+    print(json.dumps({"size_mb": args.size_mb, "chunk_mb": args.chunk_mb, "dir": args.dir, "results": results}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
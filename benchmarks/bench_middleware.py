@@ -0,0 +1,89 @@
+"""
+Measures per-request middleware overhead on a chunk-PUT shaped request.
+
+Compares the previous stack (two BaseHTTPMiddleware layers plus CORSMiddleware) against
+UploadGatewayMiddleware, both in front of the same trivial endpoint, in-process.
+
+    python -m benchmarks.bench_middleware --requests 5000 --body-size 262144
+"""
+import argparse
+import asyncio
+import json
+import os
+import time
+
+os.environ.setdefault("MAIN_SERVICE_JWT_PUBLIC_KEY", "unused")
+os.environ.setdefault("EXPECTED_JWT_ISSUER", "bench")
+os.environ.setdefault("EXPECTED_JWT_AUDIENCE", "bench")
+
+import httpx
+from starlette.applications import Starlette
+from starlette.middleware.base import BaseHTTPMiddleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import JSONResponse
+from starlette.routing import Route
+
+from app.core.middleware import UploadGatewayMiddleware
+
+CORS_OPTIONS = dict(
+    allow_origins=["*"],
+    allow_methods=["GET", "POST", "PUT", "DELETE", "PATCH", "OPTIONS"],
+    allow_headers=["Authorization", "Content-Type", "Content-Range"],
+)
+
+
+async def put_chunk(request):
+    size = 0
+    async for block in request.stream():
+        size += len(block)
+    return JSONResponse({"status": "success", "size": size})
+
+
+def build_app(stack: str):
+    app = Starlette(routes=[Route("/files/{file_id}", put_chunk, methods=["PUT"])])
+    if stack == "legacy":
+        async def passthrough(request, call_next):
+            return await call_next(request)
+
+        app.add_middleware(BaseHTTPMiddleware, dispatch=passthrough)
+        app.add_middleware(BaseHTTPMiddleware, dispatch=passthrough)
+        app.add_middleware(CORSMiddleware, allow_credentials=True, **CORS_OPTIONS)
+    elif stack == "gateway":
+        app.add_middleware(
+            UploadGatewayMiddleware,
+            expose_headers=["Content-Length", "Content-Range"],
+            **CORS_OPTIONS
+        )
+    return app
+
+
+async def run(stack: str, requests: int, body: bytes) -> dict:
+    transport = httpx.ASGITransport(app=build_app(stack))
+    headers = {"Origin": "https://example.com", "Content-Type": "application/octet-stream"}
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        for _ in range(50):
+            await client.put("/files/1", content=body, headers=headers)
+        started = time.perf_counter()
+        for _ in range(requests):
+            response = await client.put("/files/1", content=body, headers=headers)
+            response.raise_for_status()
+        elapsed = time.perf_counter() - started
+    return {"stack": stack, "requests": requests, "us_per_request": elapsed / requests * 1e6}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=3000)
+    parser.add_argument("--body-size", type=int, default=256 * 1024)
+    args = parser.parse_args()
+
+    body = os.urandom(args.body_size)
+    results = [asyncio.run(run(stack, args.requests, body)) for stack in ("none", "legacy", "gateway")]
+    baseline = results[0]["us_per_request"]
+    for result in results:
+        result["overhead_us"] = result["us_per_request"] - baseline
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
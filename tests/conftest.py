@@ -0,0 +1,39 @@
+import os
+import shutil
+import tempfile
+import pytest
+
+# Settings are read when app modules are first imported, so the environment is set up before any test imports them
+_root = tempfile.mkdtemp(prefix="hayula_tests_")
+os.environ.update(
+    MAIN_SERVICE_JWT_PUBLIC_KEY="unused",
+    EXPECTED_JWT_ISSUER="tests",
+    EXPECTED_JWT_AUDIENCE="tests",
+    LOCAL_TEMP_CHUNK_PATH=os.path.join(_root, "chunks"),
+    PERSISTENT_LOCAL_STORAGE_PATH=os.path.join(_root, "data"),
+    SESSION_STORE_SQLITE_PATH=os.path.join(_root, "sessions.db"),
+    JANITOR_ENABLED="false",
+    S3_ACCESS_KEY="testing",
+    S3_SECRET_KEY="testing",
+    S3_ENDPOINT_URL="https://s3.us-east-1.amazonaws.com",
+    S3_REGION_NAME="us-east-1",
+)
+
+
+@pytest.fixture
+def s3():
+    """The shared S3 client, talking to an in-process moto S3 with the configured bucket created"""
+    from moto import mock_aws
+    from app.core.config import settings
+    from app.services.storage.s3_client import get_s3_client
+
+    with mock_aws():
+        get_s3_client.cache_clear()
+        client = get_s3_client()
+        client.create_bucket(Bucket=settings.S3_BUCKET_NAME)
+        yield client
+    get_s3_client.cache_clear()
+
+
+def pytest_unconfigure(config):
+    shutil.rmtree(_root, ignore_errors=True)
@@ -0,0 +1,73 @@
+import asyncio
+import httpx
+from app.core.middleware import AdmissionMiddleware
+from app.services.storage.scheduler import InflightBytes, chunk_pool, s3_pool
+from app.services.storage.internal import InternalStorage
+from app.services.storage.s3_multipart import S3MultipartStorage
+
+
+class _IdlePool:
+    def saturated(self) -> bool:
+        return False
+
+
+async def _echo_size(scope, receive, send):
+    received = 0
+    while True:
+        message = await receive()
+        received += len(message.get("body", b""))
+        if not message.get("more_body"):
+            break
+    await send({"type": "http.response.start", "status": 200, "headers": []})
+    await send({"type": "http.response.body", "body": str(received).encode()})
+
+
+def _request(inflight, method, path, write_pool=None, **kwargs):
+    app = AdmissionMiddleware(_echo_size, inflight_bytes=inflight, write_pool=write_pool or _IdlePool(), retry_after=1)
+
+    async def send():
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+            return await client.request(method, path, **kwargs)
+
+    return asyncio.run(send())
+
+
+def test_upload_without_content_length_is_refused():
+    inflight = InflightBytes(limit=10)
+
+    async def body():
+        # A streamed body goes out with Transfer-Encoding: chunked and no Content-Length
+        yield b"x" * 100
+
+    response = _request(inflight, "PUT", "/files/7", content=body())
+    assert response.status_code == 411
+    assert inflight.in_flight == 0
+
+
+def test_upload_with_content_length_holds_the_budget():
+    inflight = InflightBytes(limit=10)
+    inflight.try_acquire(5)
+    assert _request(inflight, "PUT", "/files/7", content=b"x" * 100).status_code == 429
+    inflight.release(5)
+    response = _request(inflight, "PUT", "/files/7", content=b"x" * 100)
+    assert response.status_code == 200 and response.text == "100"
+    assert inflight.in_flight == 0
+
+
+def test_other_routes_are_not_checked():
+    async def body():
+        yield b"{}"
+
+    assert _request(InflightBytes(limit=10), "POST", "/files/", content=body()).status_code == 200
+
+
+def test_multipart_mode_is_refused_while_the_s3_pool_is_full(monkeypatch):
+    assert InternalStorage.chunk_write_pool is chunk_pool
+    assert S3MultipartStorage.chunk_write_pool is s3_pool
+    monkeypatch.setattr(s3_pool, "max_queue", 0)
+    inflight = InflightBytes(limit=1000)
+
+    response = _request(inflight, "PUT", "/files/7", write_pool=S3MultipartStorage.chunk_write_pool, content=b"x" * 100)
+    assert response.status_code == 503 and response.headers["retry-after"] == "1"
+    assert not chunk_pool.saturated()
+    assert inflight.in_flight == 0
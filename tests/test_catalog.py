@@ -0,0 +1,60 @@
+import asyncio
+import sqlite3
+from app.services.catalog import SQLiteFileCatalog
+
+
+def _record(file_id, size=10, checksum=None, storage_key=None, created_at=None):
+    return {
+        "user_id": "u",
+        "file_id": file_id,
+        "storage_key": storage_key or f"u/{file_id}/f.bin",
+        "file_name": "f.bin",
+        "size": size,
+        "checksum": checksum,
+        "created_at": created_at,
+    }
+
+
+def test_replace_all_keeps_checksums_of_unchanged_files(tmp_path):
+    catalog = SQLiteFileCatalog(path=str(tmp_path / "catalog.db"))
+    catalog.add(_record(1, checksum="sha256:one", created_at=100.0))
+    catalog.add(_record(2, checksum="sha256:two"))
+    catalog.add(_record(3, checksum="sha256:three"))
+
+    # 1 is unchanged, 2 was overwritten with a different size, 3 is gone and 4 is new
+    count = catalog.replace_all(iter([_record(1, created_at=200.0), _record(2, size=20), _record(4)]))
+
+    assert count == 3
+    assert catalog.get("u", 1)["checksum"] == "sha256:one"
+    assert catalog.get("u", 1)["created_at"] == 100.0
+    assert catalog.get("u", 2)["checksum"] is None
+    assert catalog.get("u", 3) is None
+    assert catalog.get("u", 4) is not None
+
+
+def test_replace_all_scans_before_taking_the_write_lock(tmp_path):
+    path = str(tmp_path / "catalog.db")
+    catalog = SQLiteFileCatalog(path=path)
+    other = sqlite3.connect(path, isolation_level=None)
+
+    def records():
+        # Another worker completes an upload while the scan is still running
+        other.execute("INSERT INTO files VALUES ('u', '9', 'u/9/f.bin', 'f.bin', 1, NULL, 1, 1)")
+        yield _record(1)
+
+    catalog.replace_all(records())
+    other.close()
+    assert [record["file_id"] for record in catalog.list_user_files("u")] == ["1"]
+
+
+def test_async_variants(tmp_path):
+    catalog = SQLiteFileCatalog(path=str(tmp_path / "catalog.db"))
+
+    async def scenario():
+        await catalog.aadd(_record(1))
+        listed = await catalog.alist_user_files("u")
+        found = await catalog.aget("u", 1)
+        deleted = await catalog.adelete("u", 1)
+        return len(listed), found["file_id"], deleted["file_id"], await catalog.aget("u", 1)
+
+    assert asyncio.run(scenario()) == (1, "1", "1", None)
@@ -0,0 +1,88 @@
+import asyncio
+import os
+import time
+import httpx
+import pytest
+from fastapi import FastAPI
+from app.api.endpoints.files import router
+from app.core.config import settings
+from app.core.security import get_current_user_id
+from app.services.download_cache import DownloadCache
+from app.services.file_service import file_service
+
+DATA = bytes(range(256)) * 64
+
+app = FastAPI()
+app.include_router(router, prefix="/files")
+app.dependency_overrides[get_current_user_id] = lambda: "u1"
+
+
+@pytest.fixture
+def stored(s3, tmp_path, monkeypatch):
+    """An object in the bucket and its catalog record, served through a fresh download cache"""
+    monkeypatch.setattr(settings, "STORAGE_BACKEND", "s3")
+    s3.put_object(Bucket=settings.S3_BUCKET_NAME, Key="u1/201/f.bin", Body=DATA)
+    file_service.catalog.add({
+        "user_id": "u1", "file_id": "201", "storage_key": "u1/201/f.bin", "file_name": "f.bin",
+        "size": len(DATA), "checksum": None, "created_at": time.time(),
+    })
+
+    def use_cache(max_bytes):
+        cache = DownloadCache(s3, root=str(tmp_path / "cache"), max_bytes=max_bytes)
+        monkeypatch.setattr(file_service, "download_cache", cache)
+        return cache
+
+    yield use_cache
+    file_service.catalog.delete("u1", "201")
+
+
+def _get(headers, before=None):
+    async def main():
+        if before is not None:
+            before()
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+            return await client.get("/files/201", headers=headers)
+
+    return asyncio.run(main())
+
+
+def test_range_of_a_cached_object(stored):
+    cache = stored(len(DATA))
+    assert _get({}).content == DATA
+
+    response = _get({"Range": "bytes=100-199"})
+    assert response.status_code == 206
+    assert response.headers["content-range"] == f"bytes 100-199/{len(DATA)}"
+    assert response.content == DATA[100:200]
+    assert cache.stats()["hits"] == 1
+
+
+def test_range_waits_for_a_fill_that_is_kept(stored):
+    cache = stored(len(DATA))
+
+    # Another request's fetch is already running when the Range request arrives
+    response = _get({"Range": "bytes=-10"}, before=lambda: cache.get("u1/201/f.bin", len(DATA)))
+    assert response.status_code == 206
+    assert response.content == DATA[-10:]
+    assert cache.stats()["coalesced"] == 1
+    assert cache.cached_path("u1/201/f.bin") is not None
+
+
+def test_range_of_an_oversized_object_is_fetched_from_s3(stored):
+    cache = stored(len(DATA) - 1)
+
+    response = _get({"Range": "bytes=1000-"})
+    assert response.status_code == 206
+    assert response.headers["content-range"] == f"bytes 1000-{len(DATA) - 1}/{len(DATA)}"
+    assert response.content == DATA[1000:]
+
+    response = _get({"Range": f"bytes={len(DATA) + 10}-"})
+    assert response.status_code == 416
+    assert response.headers["content-range"] == f"bytes */{len(DATA)}"
+
+    # A stale If-Range gets the whole object
+    response = _get({"Range": "bytes=0-9", "If-Range": '"stale"'})
+    assert response.status_code == 200 and response.content == DATA
+
+    assert cache.stats()["entries"] == 0
+    assert not [name for name in os.listdir(cache.root) if name.endswith(".part")]
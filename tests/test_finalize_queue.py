@@ -0,0 +1,42 @@
+import asyncio
+from app.core.session import session_store
+from app.services.file_service import file_service
+from app.services.finalize_queue import FinalizeQueue
+
+
+def _submit_after_session_vanishes(delete_before_claim: bool):
+    session = {"user_id": "u1", "main_service_file_id": 7, "original_file_name": "a.bin"}
+    session_store.set("7", session)
+    session_store.record_chunks("7", [(0, 10, None)])
+    queue = FinalizeQueue(file_service)
+
+    async def scenario():
+        queue.start()
+        try:
+            if delete_before_claim:
+                # Another worker completes the upload between the chunk check and the claim
+                mutate = session_store.mutate
+
+                def vanish_then_mutate(session_id, fn):
+                    session_store.delete(session_id)
+                    return mutate(session_id, fn)
+
+                session_store.mutate = vanish_then_mutate
+                try:
+                    return await queue.submit("7", session, "u1", 1, 7)
+                finally:
+                    del session_store.mutate
+            session_store.delete("7")
+            return await queue.submit("7", session, "u1", 1, 7)
+        finally:
+            await queue.stop()
+
+    return asyncio.run(scenario())
+
+
+def test_submit_reports_a_vanished_session_as_none():
+    assert _submit_after_session_vanishes(delete_before_claim=False) is None
+
+
+def test_submit_reports_a_session_vanishing_before_the_claim_as_none():
+    assert _submit_after_session_vanishes(delete_before_claim=True) is None
@@ -0,0 +1,50 @@
+import asyncio
+from app.core.config import settings
+from app.core.session import session_store
+from app.services.janitor import Janitor
+from app.services.storage.s3_multipart import S3MultipartStorage
+
+
+def _open_keys(s3):
+    return sorted(upload["Key"] for upload in s3.list_multipart_uploads(Bucket=settings.S3_BUCKET_NAME).get("Uploads", []))
+
+
+def test_only_this_services_dangling_uploads_are_aborted(s3, monkeypatch):
+    monkeypatch.setattr(settings, "JANITOR_MIN_IDLE_SECONDS", 0)
+    bucket = settings.S3_BUCKET_NAME
+    live = s3.create_multipart_upload(Bucket=bucket, Key="u1/7/live.bin")["UploadId"]
+    session_store.set("7", {"user_id": "u1", "s3_key": "u1/7/live.bin", "s3_upload_id": live})
+    for key in (
+        "u1/8/orphan.bin",
+        "u1/0123456789abcdef0123456789abcdef/partial",
+        # Other services' uploads in the same bucket
+        "backups/db.dump",
+        "exports/u1/7/live.bin",
+        "u1/0123456789abcdef0123456789abcdef/report.csv",
+        "media/thumbnails/large.png",
+    ):
+        s3.create_multipart_upload(Bucket=bucket, Key=key)
+
+    try:
+        result = asyncio.run(Janitor(S3MultipartStorage())._abort_dangling_uploads(float("inf")))
+    finally:
+        session_store.delete("7")
+
+    assert result == 2
+    assert _open_keys(s3) == [
+        "backups/db.dump",
+        "exports/u1/7/live.bin",
+        "media/thumbnails/large.png",
+        "u1/0123456789abcdef0123456789abcdef/report.csv",
+        "u1/7/live.bin",
+    ]
+
+
+def test_key_prefix_limits_the_candidates(s3, monkeypatch):
+    monkeypatch.setattr(settings, "JANITOR_MIN_IDLE_SECONDS", 0)
+    monkeypatch.setattr(settings, "JANITOR_MULTIPART_KEY_PREFIX", "tenant-a")
+    s3.create_multipart_upload(Bucket=settings.S3_BUCKET_NAME, Key="tenant-a/8/orphan.bin")
+    s3.create_multipart_upload(Bucket=settings.S3_BUCKET_NAME, Key="tenant-b/8/orphan.bin")
+
+    assert asyncio.run(Janitor(S3MultipartStorage())._abort_dangling_uploads(float("inf"))) == 1
+    assert _open_keys(s3) == ["tenant-b/8/orphan.bin"]
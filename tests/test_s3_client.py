@@ -0,0 +1,41 @@
+import asyncio
+from app.core.config import settings
+from app.services.storage.s3 import S3Storage
+from app.services.storage.s3_client import S3PoolStats, get_s3_client, s3_pool_stats, DELETE_BATCH_SIZE
+
+
+def test_client_is_shared_and_counted(s3):
+    assert get_s3_client() is s3
+    assert S3Storage().s3_client is s3
+
+    before = s3_pool_stats.stats()
+    s3.list_objects_v2(Bucket=settings.S3_BUCKET_NAME)
+    after = s3_pool_stats.stats()
+
+    assert after["requests"] == before["requests"] + 1
+    assert after["in_flight"] == before["in_flight"]
+
+
+def test_attempts_past_the_pool_are_saturated():
+    stats = S3PoolStats(max_connections=2)
+    for _ in range(3):
+        stats.on_send()
+    stats.on_response()
+
+    assert stats.stats() == {"max_connections": 2, "in_flight": 2, "peak_in_flight": 3, "requests": 3, "saturated": 1}
+
+
+def test_delete_files_batches_requests(s3):
+    bucket = settings.S3_BUCKET_NAME
+    keys = [f"u1/{i}/f.bin" for i in range(DELETE_BATCH_SIZE * 2 + 5)]
+    for key in keys:
+        s3.put_object(Bucket=bucket, Key=key, Body=b"x")
+    requests = []
+    s3.meta.events.register("before-call.s3.DeleteObjects", lambda params, **kwargs: requests.append(params))
+
+    deleted = asyncio.run(S3Storage().delete_files(keys + ["u1/missing/f.bin"]))
+
+    # Deleting a key that doesn't exist succeeds on S3 as well
+    assert deleted == len(keys) + 1
+    assert len(requests) == 3
+    assert s3.list_objects_v2(Bucket=bucket).get("KeyCount") == 0
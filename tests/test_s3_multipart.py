@@ -0,0 +1,102 @@
+import asyncio
+import io
+import pytest
+from app.core.config import settings
+from app.core.session import session_store
+from app.services.storage.s3_multipart import S3MultipartStorage
+
+PART = 5 * 1024 * 1024
+
+
+def _parts(*sizes):
+    return [bytes([i + 1]) * size for i, size in enumerate(sizes)]
+
+
+def _start(storage, session_id, key):
+    session = asyncio.run(storage.init_session(session_id, key))
+    session_store.set(session_id, {"user_id": "u1", **session})
+    return session
+
+
+def _upload(storage, session_id, parts):
+    for index, data in enumerate(parts):
+        asyncio.run(storage.save_chunk(session_id, index, io.BytesIO(data)))
+    session_store.record_chunks(session_id, [(index, len(data), None) for index, data in enumerate(parts)])
+
+
+def _open_uploads(s3):
+    return s3.list_multipart_uploads(Bucket=settings.S3_BUCKET_NAME).get("Uploads", [])
+
+
+@pytest.fixture
+def storage(s3):
+    storage = S3MultipartStorage()
+    yield storage
+    for session_id in ("1", "2", "3"):
+        session_store.delete(session_id)
+
+
+def test_merge_completes_the_object_once(s3, storage):
+    _start(storage, "1", "u1/1/f.bin")
+    parts = _parts(PART, 10)
+    _upload(storage, "1", parts)
+
+    assert asyncio.run(storage.merge_chunks("1", 2, "")) == "u1/1/f.bin"
+    # A retry after a failure later in finalization finds the object already there
+    assert asyncio.run(storage.merge_chunks("1", 2, "")) == "u1/1/f.bin"
+
+    body = s3.get_object(Bucket=settings.S3_BUCKET_NAME, Key="u1/1/f.bin")["Body"].read()
+    assert body == b"".join(parts)
+    assert session_store.get("1")["s3_completed"] is True
+    assert _open_uploads(s3) == []
+
+
+def test_merge_with_a_missing_part_leaves_the_upload_open(s3, storage):
+    _start(storage, "1", "u1/1/f.bin")
+    _upload(storage, "1", _parts(PART))
+
+    with pytest.raises(ValueError, match=r"\[1\]"):
+        asyncio.run(storage.merge_chunks("1", 2, ""))
+    assert len(_open_uploads(s3)) == 1
+
+
+def test_chunk_index_past_the_part_limit_is_refused(s3, storage):
+    _start(storage, "1", "u1/1/f.bin")
+
+    with pytest.raises(ValueError):
+        asyncio.run(storage.save_chunk("1", 10000, io.BytesIO(b"data")))
+    assert s3.list_parts(Bucket=settings.S3_BUCKET_NAME, Key="u1/1/f.bin",
+                         UploadId=session_store.get("1")["s3_upload_id"]).get("Parts", []) == []
+
+
+def test_cleanup_aborts_an_unfinished_upload(s3, storage):
+    _start(storage, "1", "u1/1/f.bin")
+    _upload(storage, "1", _parts(10))
+
+    asyncio.run(storage.cleanup_session("1"))
+
+    assert _open_uploads(s3) == []
+    assert session_store.get("1")["s3_upload_id"] is None
+
+
+def test_adopted_upload_is_copied_and_kept_until_cleanup(s3, storage):
+    _start(storage, "1", "u1/1/partial")
+    _start(storage, "2", "u1/2/partial")
+    _start(storage, "3", "u1/3/f.bin")
+    first, second = _parts(PART, PART), _parts(7)
+    _upload(storage, "1", first)
+    _upload(storage, "2", second)
+
+    asyncio.run(storage.adopt_chunks("1", "3", 0, 2, 0, 2 * PART))
+    asyncio.run(storage.adopt_chunks("2", "3", 2, 1, 2 * PART, 7))
+    asyncio.run(storage.merge_chunks("3", 3, ""))
+
+    bucket = settings.S3_BUCKET_NAME
+    assert s3.get_object(Bucket=bucket, Key="u1/3/f.bin")["Body"].read() == b"".join(first + second)
+    # The sources were completed into their own objects, which stay until their sessions are cleaned up
+    assert session_store.get("1")["s3_concat_source"] is True
+    s3.head_object(Bucket=bucket, Key="u1/1/partial")
+    asyncio.run(storage.cleanup_session("1"))
+    asyncio.run(storage.cleanup_session("2"))
+    keys = [obj["Key"] for obj in s3.list_objects_v2(Bucket=bucket).get("Contents", [])]
+    assert keys == ["u1/3/f.bin"]
@@ -0,0 +1,90 @@
+import asyncio
+import socket
+import httpx
+import pytest
+from moto.server import ThreadedMotoServer
+from app.core.config import settings
+from app.core.session import session_store
+from app.services import checksum
+from app.services.file_service import FileService, IncompleteUploadError
+from app.services.storage import factory
+from app.services.storage.s3_client import get_s3_client
+
+PART = 5 * 1024 * 1024
+
+
+@pytest.fixture
+def presigned(monkeypatch):
+    """A FileService in presigned mode against a moto S3 server, which the presigned URLs can reach over HTTP"""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    server = ThreadedMotoServer(ip_address="127.0.0.1", port=port, verbose=False)
+    server.start()
+    monkeypatch.setattr(settings, "S3_ENDPOINT_URL", f"http://127.0.0.1:{port}")
+    monkeypatch.setattr(settings, "STORAGE_BACKEND", "s3")
+    monkeypatch.setattr(settings, "S3_UPLOAD_MODE", "presigned")
+    monkeypatch.setattr(settings, "S3_PRESIGNED_PART_SIZE", PART)
+    monkeypatch.setattr(factory, "_storage_instance", None)
+    get_s3_client.cache_clear()
+    try:
+        get_s3_client().create_bucket(Bucket=settings.S3_BUCKET_NAME)
+        yield FileService()
+    finally:
+        session_store.delete("5")
+        get_s3_client.cache_clear()
+        server.stop()
+
+
+def _put_parts(service, data):
+    session = asyncio.run(service.create_session(5, "u1", "f.bin", len(data)))
+    urls = asyncio.run(service.presigned_parts("5", 0, session["planned_parts"]))
+    etags = []
+    for part in urls:
+        start = part["chunk_index"] * PART
+        response = httpx.put(part["url"], content=data[start:start + PART])
+        response.raise_for_status()
+        etags.append((part["chunk_index"], response.headers["etag"]))
+    return session, etags
+
+
+def _finalize(service, session, total_chunks, parts):
+    return asyncio.run(service.finalize_upload("5", session, "u1", total_chunks, 5, parts))
+
+
+def test_parts_put_to_presigned_urls_complete_the_upload(presigned):
+    data = b"a" * PART + b"b" * 10
+    session, etags = _put_parts(presigned, data)
+
+    _finalize(presigned, session, 2, etags)
+
+    s3 = get_s3_client()
+    assert s3.get_object(Bucket=settings.S3_BUCKET_NAME, Key="u1/5/f.bin")["Body"].read() == data
+    record = presigned.catalog.get("u1", 5)
+    assert record["size"] == len(data)
+    # The whole-file checksum is built from the md5s S3 reported as part ETags
+    assert record["checksum"].startswith("md5:")
+    assert session_store.get("5") is None
+
+
+def test_etag_mismatch_leaves_the_upload_open(presigned):
+    session, etags = _put_parts(presigned, b"a" * PART + b"b" * 10)
+    wrong = [(0, '"00000000000000000000000000000000"'), etags[1]]
+
+    with pytest.raises(checksum.ChecksumMismatchError):
+        _finalize(presigned, session, 2, wrong)
+    assert session_store.get("5")["s3_upload_id"]
+
+    _finalize(presigned, session, 2, etags)
+    assert presigned.catalog.get("u1", 5) is not None
+
+
+def test_part_that_never_reached_s3_is_missing(presigned):
+    data = b"a" * PART + b"b" * 10
+    session = asyncio.run(presigned.create_session(5, "u1", "f.bin", len(data)))
+    url = asyncio.run(presigned.presigned_parts("5", 1, 1))[0]["url"]
+    httpx.put(url, content=data[PART:]).raise_for_status()
+
+    with pytest.raises(IncompleteUploadError) as excinfo:
+        _finalize(presigned, session, 2, [])
+    assert excinfo.value.missing == [0]
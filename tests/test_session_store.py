@@ -0,0 +1,130 @@
+import asyncio
+import sqlite3
+import threading
+import time
+import fakeredis
+import pytest
+from app.core.session import MemorySessionStore, SQLiteSessionStore, RedisSessionStore
+
+
+@pytest.fixture(params=["memory", "sqlite", "redis"])
+def store(request, tmp_path):
+    if request.param == "memory":
+        return MemorySessionStore(ttl_seconds=60)
+    if request.param == "sqlite":
+        return SQLiteSessionStore(path=str(tmp_path / "sessions.db"), ttl_seconds=60)
+    return RedisSessionStore(client=fakeredis.FakeRedis(), ttl_seconds=60)
+
+
+def test_set_get_delete(store):
+    assert store.get("1") is None
+    store.set("1", {"user_id": "u", "main_service_file_id": 1})
+    assert store.get("1") == {"user_id": "u", "main_service_file_id": 1}
+    assert store.count() == 1
+    store.delete("1")
+    assert store.get("1") is None
+    assert store.count() == 0
+
+
+def test_update_and_mutate(store):
+    store.set("1", {"user_id": "u", "n": 0})
+    assert store.update("1", extra=True) == {"user_id": "u", "n": 0, "extra": True}
+    assert store.mutate("1", lambda session: session.update(n=session["n"] + 1))["n"] == 1
+    assert store.get("1")["n"] == 1
+    assert store.mutate("missing", lambda session: session.update(n=1)) is None
+    assert store.get("missing") is None
+
+
+def test_mutate_is_atomic_across_threads(store):
+    store.set("1", {"n": 0})
+
+    def increment():
+        for _ in range(50):
+            store.mutate("1", lambda session: session.update(n=session["n"] + 1))
+
+    threads = [threading.Thread(target=increment) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert store.get("1")["n"] == 200
+
+
+def test_sessions_expire(store):
+    store.ttl_seconds = 1
+    store.set("1", {"n": 0})
+    store.touch("1")
+    time.sleep(1.1)
+    assert store.get("1") is None
+    assert store.update("1", n=1) is None
+
+
+def test_async_variants(store):
+    async def scenario():
+        await store.aset("1", {"n": 0})
+        await store.amutate("1", lambda session: session.update(n=session["n"] + 1))
+        await store.aupdate("1", done=True)
+        await store.atouch("1")
+        session = await store.aget("1")
+        await store.adelete("1")
+        return session, await store.aget("1")
+
+    assert asyncio.run(scenario()) == ({"n": 1, "done": True}, None)
+
+
+def test_sqlite_lock_wait_does_not_block_the_event_loop(tmp_path):
+    path = str(tmp_path / "sessions.db")
+    store = SQLiteSessionStore(path=path, ttl_seconds=60)
+    store.set("1", {"n": 0})
+    # Another worker process holding the write lock
+    holder = sqlite3.connect(path, isolation_level=None)
+    holder.execute("BEGIN IMMEDIATE")
+
+    async def scenario():
+        mutation = asyncio.create_task(store.amutate("1", lambda session: session.update(n=1)))
+        ticks = 0
+        while ticks < 20:
+            await asyncio.sleep(0.01)
+            ticks += 1
+        assert not mutation.done()
+        holder.execute("COMMIT")
+        return await mutation
+
+    assert asyncio.run(scenario())["n"] == 1
+    holder.close()
+
+
+def test_chunks_are_recorded_beside_the_session(store):
+    store.set("1", {"n": 0})
+    assert store.record_chunks("1", [(0, 10, "a"), (2, 5, None)])
+    assert store.record_chunks("1", [(0, 10, "b")])
+    assert store.chunks("1") == {0: (10, "b"), 2: (5, None)}
+    # Chunks don't count as sessions, and session updates leave them alone
+    assert store.count() == 1
+    store.update("1", n=1)
+    assert store.chunks("1") == {0: (10, "b"), 2: (5, None)}
+
+    assert not store.record_chunks("missing", [(0, 1, None)])
+    assert store.chunks("missing") == {}
+
+    # A new session under the same id starts without chunks
+    store.set("1", {"n": 0})
+    assert store.chunks("1") == {}
+    store.record_chunks("1", [(0, 1, None)])
+    store.delete("1")
+    assert store.chunks("1") == {}
+
+
+def test_concurrent_chunk_records_are_all_kept(store):
+    store.set("1", {})
+
+    def record(first):
+        for chunk_index in range(first, first + 50):
+            store.record_chunks("1", [(chunk_index, 1, None)])
+
+    threads = [threading.Thread(target=record, args=(first,)) for first in range(0, 200, 50)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(store.chunks("1")) == list(range(200))
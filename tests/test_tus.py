@@ -0,0 +1,165 @@
+import asyncio
+import base64
+import hashlib
+import os
+import httpx
+import pytest
+from fastapi import FastAPI
+from app.api.endpoints.tus import router
+from app.core.security import get_current_user_id
+from app.services.file_service import file_service
+from app.services.storage import layout
+from app.services.storage.internal import InternalStorage
+from app.services.storage.internal_offset import InternalOffsetStorage
+
+TUS = {"Tus-Resumable": "1.0.0"}
+PATCH = {**TUS, "Content-Type": "application/offset+octet-stream"}
+
+app = FastAPI()
+app.include_router(router, prefix="/tus")
+app.dependency_overrides[get_current_user_id] = lambda: "u1"
+
+
+def _metadata(file_id, filename="f.bin"):
+    return ",".join(f"{key} {base64.b64encode(str(value).encode()).decode()}"
+                    for key, value in (("file_id", file_id), ("filename", filename)))
+
+
+def _run(scenario):
+    async def main():
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+            return await scenario(client)
+
+    return asyncio.run(main())
+
+
+async def _create(client, length, file_id=None, concat=None):
+    headers = {**TUS, "Upload-Length": str(length)}
+    if concat:
+        headers["Upload-Concat"] = concat
+    else:
+        headers["Upload-Metadata"] = _metadata(file_id)
+    response = await client.post("/tus/", headers=headers)
+    assert response.status_code == 201, response.text
+    return response.headers["location"]
+
+
+async def _patch(client, url, offset, data, **headers):
+    return await client.patch(url, content=data, headers={**PATCH, "Upload-Offset": str(offset), **headers})
+
+
+def _stored(file_id):
+    record = file_service.catalog.get("u1", file_id)
+    with open(file_service.local_path(record), "rb") as f:
+        return f.read()
+
+
+@pytest.fixture(params=["chunks", "offset"])
+def local_storage(request, monkeypatch):
+    storage = InternalStorage() if request.param == "chunks" else InternalOffsetStorage()
+    monkeypatch.setattr(file_service, "storage", storage)
+    return storage
+
+
+def test_patches_append_at_the_offset_and_complete(local_storage):
+    async def scenario(client):
+        url = await _create(client, 10, file_id=101)
+        assert (await _patch(client, url, 0, b"hello")).headers["upload-offset"] == "5"
+        head = await client.head(url, headers=TUS)
+        assert head.headers["upload-offset"] == "5" and head.headers["upload-length"] == "10"
+        mismatch = await _patch(client, url, 3, b"world")
+        assert mismatch.status_code == 409
+        done = await _patch(client, url, 5, b"world")
+        assert done.status_code == 204 and done.headers["upload-offset"] == "10"
+        # The session is gone; the catalog answers for the finished upload
+        return (await client.head(url, headers=TUS)).headers["upload-offset"]
+
+    assert _run(scenario) == "10"
+    assert _stored(101) == b"helloworld"
+
+
+def test_checksum_mismatch_is_460_and_the_offset_stays(local_storage):
+    async def scenario(client):
+        url = await _create(client, 4, file_id=102)
+        wrong = base64.b64encode(hashlib.sha1(b"nope").digest()).decode()
+        response = await _patch(client, url, 0, b"data", **{"Upload-Checksum": f"sha1 {wrong}"})
+        head = await client.head(url, headers=TUS)
+        right = base64.b64encode(hashlib.sha1(b"data").digest()).decode()
+        retry = await _patch(client, url, 0, b"data", **{"Upload-Checksum": f"sha1 {right}"})
+        return response.status_code, head.headers["upload-offset"], retry.status_code
+
+    assert _run(scenario) == (460, "0", 204)
+    assert _stored(102) == b"data"
+
+
+def test_termination_removes_the_upload(local_storage):
+    async def scenario(client):
+        url = await _create(client, 10, file_id=103)
+        await _patch(client, url, 0, b"hello")
+        deleted = await client.delete(url, headers=TUS)
+        return deleted.status_code, (await client.head(url, headers=TUS)).status_code
+
+    assert _run(scenario) == (204, 404)
+
+
+def test_final_upload_follows_the_order_of_its_partials(local_storage):
+    async def scenario(client):
+        first = await _create(client, 6, concat="partial")
+        second = await _create(client, 3, concat="partial")
+        # Parallel uploads finish in any order
+        await _patch(client, second, 0, b"def")
+        await _patch(client, first, 0, b"abc")
+        await _patch(client, first, 3, b"123")
+        response = await client.post("/tus/", headers={
+            **TUS, "Upload-Metadata": _metadata(104), "Upload-Concat": f"final;{second} {first}",
+        })
+        return response.status_code, (await client.head(first, headers=TUS)).status_code
+
+    assert _run(scenario) == (201, 404)
+    assert _stored(104) == b"defabc123"
+
+
+def test_unfinished_partial_is_refused(local_storage):
+    async def scenario(client):
+        partial = await _create(client, 6, concat="partial")
+        await _patch(client, partial, 0, b"abc")
+        response = await client.post("/tus/", headers={
+            **TUS, "Upload-Metadata": _metadata(105), "Upload-Concat": f"final;{partial}",
+        })
+        return response.status_code, (await client.head(partial, headers=TUS)).headers["upload-offset"]
+
+    assert _run(scenario) == (400, "3")
+
+
+def test_failed_final_upload_can_be_posted_again(local_storage, monkeypatch):
+    add = file_service.catalog.aadd
+    failures = []
+
+    async def add_failing_once(record):
+        if not failures:
+            failures.append(record)
+            raise OSError("catalog is unavailable")
+        return await add(record)
+
+    monkeypatch.setattr(file_service.catalog, "aadd", add_failing_once)
+
+    async def scenario(client):
+        first = await _create(client, 3, concat="partial")
+        second = await _create(client, 3, concat="partial")
+        await _patch(client, first, 0, b"abc")
+        await _patch(client, second, 0, b"def")
+        headers = {**TUS, "Upload-Metadata": _metadata(106), "Upload-Concat": f"final;{first} {second}"}
+        failed = await client.post("/tus/", headers=headers)
+        # The partial uploads are untouched until the final one completes
+        kept = (await client.head(first, headers=TUS)).headers["upload-offset"]
+        retried = await client.post("/tus/", headers=headers)
+        gone = (await client.head(second, headers=TUS)).status_code
+        return failed.status_code, kept, retried.status_code, gone, [first, second]
+
+    *statuses, partials = _run(scenario)
+    assert statuses == [500, "3", 201, 404]
+    assert _stored(106) == b"abcdef"
+    for url in partials:
+        partial_id = url.rsplit("/", 1)[-1]
+        assert not os.path.exists(layout.chunk_dir(partial_id))
+        assert not os.path.exists(layout.partial_path(partial_id))